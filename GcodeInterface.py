@@ -7,9 +7,17 @@ G-code commands from reprap.org/wiki/G-code
 and https://en.wikipedia.org/wiki/G-code
 """
 
+import math
 import re
+import time
+import gcodeFile
 from HardwareManager import HardwareManager
 
+# I/J arcs whose end radius differs from their start radius by more than both
+# of these are rejected, same as Grbl
+ARC_RADIUS_TOL = 0.005  # mm
+ARC_RADIUS_TOL_RATIO = 0.001  # of the start radius
+
 # TODO Implement custom error classes
 # HardwareError
 #   EstopError
@@ -22,13 +30,14 @@ class GcodeInterface(HardwareManager):
     a G-code style interface in terms of the hardware access functions.
     """
 
-    def __init__(self):
+    def __init__(self, dry_run=False):
         # super(self.__class__, self).__init__(self)  # super doesn't work
-        HardwareManager.__init__(self)
+        HardwareManager.__init__(self, dry_run)
         self.relative = False
         self.las_on = False
         self.cmd_list = [
             "G0 X Y F", "G1 X Y F",  # Move
+            "G2 X Y I J R F", "G3 X Y I J R F",  # Arc move
             # "G20", "G21",  # Set units # not implemented
             "G28",  # Home
             "G90", "G91", "G92 X Y",  # Set abs/rel, position
@@ -36,6 +45,7 @@ class GcodeInterface(HardwareManager):
             "M3 S", "M5",  # las on/off
             "M17", "M18",  # mot en/disable
             # "M42", "M72",  # not implemented
+            "M78",  # job stats
             "M92 X Y",  # Set step cal (mm/min)
             # "M106 P S", "M107",  # fan control # not implemented
             "M114", "M115", "M119"  # diagnostics, return values
@@ -47,7 +57,7 @@ class GcodeInterface(HardwareManager):
         HardwareManager.__del__(self)
 
 
-    def parse_gcode(self, filename):
+    def parse_gcode(self, filename, profile_file=None):
         """ Read gcode from a filepath, and execute the commands.
 
         Raises IOError if file cannot be opened.
@@ -56,22 +66,375 @@ class GcodeInterface(HardwareManager):
         either to the file being formatted incorrectly or the parser behaving
         unexpectedly.
 
+        Raises a RuntimeError before anything moves if the job would leave the
+        bed limits.
+
         Passes along the StandardError sub-exception of some kind if there is an
         issue with executing the commands.
 
+        Times each stage and command type of the job in self.profile, see M78.
+
         :param filename: Directory path of the G-code file, absolute or relative
         :type: string
+        :param profile_file: If given, write the job's profile here when the
+        job ends, as CSV if it ends in .csv, else JSON. If the job fails, an
+        error writing it is only printed.
+        :type: string
+        :return: void, exceptions for errors.
+        """
+
+        self.profile.reset(filename)
+        try:
+            start = time.time()
+            program = self._read_gcode(filename)
+            self.profile.add("parse", time.time() - start)
+
+            start = time.time()
+            self.check_bounds(program)
+            self.profile.add("bounds", time.time() - start)
+
+            self.run_program(program)
+        except:
+            if profile_file is not None:
+                self.profile.export_after_error(profile_file)
+            raise
+        if profile_file is not None:
+            self.profile.export(profile_file)
+
+
+    def run_program(self, program):
+        """ Execute an already parsed and bounds checked program.
+
+        Raises the same exceptions as parse_gcode while executing commands.
+        Times each command type in self.profile, without resetting it.
+        Publishes the job progress after each command, see start_telemetry.
+
+        With a motion process running (see start_motion), returns once every
+        queued move has finished, and a switch triggered by a queued move
+        raises in whichever command comes after it.
+
+        :param program: Parsed program, from _read_gcode
+        :type: list[(string, dict)]
         :return: void, exceptions for errors.
         """
 
+        # TODO should this be changed to execute line by line? Parses whole file
+        n_cmds, done = len(program), 0
+        self.publish_state(done, n_cmds, True)
+        try:
+            for cmd, params in program:
+                try:
+                    # debug
+                    print(cmd, params)
+                    start = time.time()
+                    self.cmd_index = done
+                    getattr(self, cmd)(**params)
+                    self.profile.add_cmd(cmd, time.time() - start)
+                # TODO Catch exceptions and fail correctly
+                except RuntimeError:
+                    self.M1()
+                    raise
+                done += 1
+                self.publish_state(done, n_cmds, True)
+
+            # Moves queued for the motion process are waited for here, so the
+            # job only returns once the head has stopped
+            retval = self.wait_motion()
+            if retval != 0:
+                self.M1()
+                raise RuntimeError("Switch was triggered: " + bin(retval))
+        finally:
+            self.publish_state(done, n_cmds, False)
+
+
+    def estimate_gcode(self, filename):
+        """ Dry run a G-code file, and estimate how long it will take to run.
+
+        Parses and plans the file with the same step, laser and timing rules
+        as parse_gcode, without touching GPIO. Machine state (position,
+        speeds, modes) is restored afterwards. Uses the current las_mask.
+
+        Raises the same exceptions as parse_gcode.
+
+        :param filename: Directory path of the G-code file, absolute or relative
+        :type: string
+        :return: Estimated times in seconds, with keys "total", "cut",
+        "travel" and "home"
+        :rtype: dict
+        """
+
+        program = self._read_gcode(filename)
+        self.check_bounds(program)
+
+        saved = (self.x, self.y, self.homed, self.mots_enabled, self.cut_spd,
+                 self.travel_spd, self.step_cal, self.relative, self.las_on,
+                 self.dry_run)
+        self.dry_run = True
+        self.dry_run_times = {"cut": 0.0, "travel": 0.0, "home": 0.0}
+        try:
+            for cmd, params in program:
+                getattr(self, cmd)(**params)
+        finally:
+            (self.x, self.y, self.homed, self.mots_enabled, self.cut_spd,
+             self.travel_spd, self.step_cal, self.relative, self.las_on,
+             self.dry_run) = saved
+
+        times = dict(self.dry_run_times)
+        times["total"] = times["cut"] + times["travel"] + times["home"]
+        return times
+
+
+    def plan_gcode(self, filename, plan_filename):
+        """ Plan a G-code file into a plan file, to replay later with
+        replay_plan, maybe on another machine. Needs no GPIO.
+
+        Parses, bounds checks and plans the file the same as parse_gcode,
+        from the current machine state, recording every planned move instead
+        of stepping it. Replaying the plan needs the same step_cal, speeds
+        and bed limits as this has. Machine state is restored afterwards.
+        Uses the current las_mask.
+
+        Raises the same exceptions as parse_gcode, and IOError if the plan
+        file can't be written.
+
+        :param filename: Directory path of the G-code file, absolute or relative
+        :type: string
+        :param plan_filename: Plan file to write
+        :type: string
+        :return: Number of moves planned
+        :rtype: int
+        """
+
+        import planFile
+        program = self._read_gcode(filename)
+        self.check_bounds(program)
+
+        saved = (self.x, self.y, self.homed, self.mots_enabled, self.cut_spd,
+                 self.travel_spd, self.step_cal, self.relative, self.las_on,
+                 self.dry_run)
+        plan = planFile.PlanWriter(self)
+        self.dry_run, self.plan = True, plan
+        try:
+            for cmd, params in program:
+                getattr(self, cmd)(**params)
+        finally:
+            (self.x, self.y, self.homed, self.mots_enabled, self.cut_spd,
+             self.travel_spd, self.step_cal, self.relative, self.las_on,
+             self.dry_run) = saved
+            self.plan = None
+
+        plan.write(plan_filename)
+        return plan.n_moves
+
+
+    def check_bounds(self, program):
+        """ Check a whole parsed program against the bed limits before
+        running it.
+
+        Follows G90/G91 modes and G28/G92 position resets to find every
+        position the head is sent to, relative to the homed origin.
+
+        Raises a RuntimeError if any move would leave 0 to bed_xmax or
+        0 to bed_ymax.
+
+        :param program: Parsed program, from _read_gcode
+        :type: list[(string, dict)]
+        :return: Job bounding box (xmin, ymin, xmax, ymax) in mm
+        :rtype: (double, double, double, double)
+        """
+
+        xmin, ymin, xmax, ymax = self.job_bounds(program)
+        if xmin < 0 or ymin < 0 or xmax > self.bed_xmax \
+                or ymax > self.bed_ymax:
+            raise RuntimeError("Job out of bed limits: X {:.2f} to {:.2f}, "
+                               "Y {:.2f} to {:.2f} (bed {} x {})".format(
+                                   xmin, xmax, ymin, ymax,
+                                   self.bed_xmax, self.bed_ymax))
+        return xmin, ymin, xmax, ymax
+
+
+    def job_bounds(self, program):
+        """ Find the bounding box of every position a parsed program sends
+        the head to, relative to the homed origin, without running it.
+
+        The program is split into blocks at each G28/G92, which reset the
+        coordinates. Positions within a block are found with numpy cumulative
+        sums from the last absolute position given on each axis. Arcs add
+        the points where they cross the X/Y axes through their center.
+
+        Raises a RuntimeError if an arc's radius is too small for its ends.
+
+        :param program: Parsed program, from _read_gcode
+        :type: list[(string, dict)]
+        :return: Bounding box (xmin, ymin, xmax, ymax) in mm, including the
+        starting position
+        :rtype: (double, double, double, double)
+        """
+
+        import numpy as np  # Not needed until a job is run, slow to import
+
+        # Machine position, and offset of G-code coordinates from it
+        pos = np.array([self.x, self.y], dtype=float)
+        offset = np.zeros(2)
+        relative = self.relative
+        lo, hi = pos.copy(), pos.copy()
+
+        block, rel_flags, arcs = [], [], []
+        for cmd, params in program + [("G28", {})]:  # G28 ends the last block
+            if cmd in ("G2", "G3"):
+                arcs.append((len(block), params, cmd == "G2"))
+            if cmd in ("G0", "G1", "G2", "G3"):
+                block.append([params.get("X", np.nan), params.get("Y", np.nan)])
+                rel_flags.append(relative)
+            elif cmd == "G90":
+                relative = False
+            elif cmd == "G91":
+                relative = True
+            elif cmd in ("G28", "G92"):
+                if block:
+                    targets = np.array(block)
+                    rel = np.array(rel_flags)[:, np.newaxis]
+                    given = ~np.isnan(targets)
+                    steps = np.where(rel & given, targets, 0)
+                    # Last absolute position given on each axis, per move
+                    anchor = np.where(given & ~rel,
+                                      np.arange(len(block))[:, np.newaxis], -1)
+                    anchor = np.maximum.accumulate(anchor, axis=0)
+                    csum = np.cumsum(steps, axis=0)
+                    cols = np.arange(2)
+                    abs_pos = np.where(
+                        anchor >= 0,
+                        targets[np.maximum(anchor, 0), cols]
+                        + csum - csum[np.maximum(anchor, 0), cols],
+                        pos - offset + csum) + offset
+                    lo = np.minimum(lo, abs_pos.min(axis=0))
+                    hi = np.maximum(hi, abs_pos.max(axis=0))
+                    for k, arc, cw in arcs:
+                        start = abs_pos[k - 1] if k else pos
+                        delta = abs_pos[k] - start
+                        i, j = self._arc_center(delta[0], delta[1], cw, **arc)
+                        for point in self._arc_extremes(delta[0], delta[1],
+                                                        i, j, cw):
+                            lo = np.minimum(lo, start + point)
+                            hi = np.maximum(hi, start + point)
+                    pos = abs_pos[-1]
+                    block, rel_flags, arcs = [], [], []
+                if cmd == "G28":
+                    pos, offset = np.zeros(2), np.zeros(2)
+                else:
+                    offset = pos - [params.get("X", 0), params.get("Y", 0)]
+
+        return lo[0], lo[1], hi[0], hi[1]
+
+
+    def _arc_center(self, x_delta, y_delta, cw, X=None, Y=None, I=None,
+                    J=None, R=None, F=None):
+        """ Find the center of a G2/G3 arc, relative to its start.
+
+        The center is I, J from the start, or if R is given, the center of the
+        radius R circle through both ends. Positive R gives the arc of 180
+        degrees or less, negative R the longer one.
+
+        Raises a RuntimeError if neither I/J nor R are given, if the end of an
+        I/J arc isn't on its circle (see ARC_RADIUS_TOL), if R is used for a
+        full circle, or if R is too small to reach from one end to the other.
+
+        :param x_delta: X position change in mm
+        :type: double
+        :param y_delta: Y position change in mm
+        :type: double
+        :param cw: True for clockwise (G2), False for counterclockwise (G3)
+        :type: bool
+        :param I, J, R: Arc parameters of the G2/G3 command, X, Y and F
+        are ignored
+        :return: Center X and Y offset from the start of the arc in mm
+        :rtype: (double, double)
+        """
+
+        if R is None:
+            if I is None and J is None:
+                raise RuntimeError("Arc needs I and J or R")
+            i, j = I or 0., J or 0.
+            start_r = math.hypot(i, j)
+            end_r = math.hypot(x_delta - i, y_delta - j)
+            if abs(end_r - start_r) > max(ARC_RADIUS_TOL,
+                                          ARC_RADIUS_TOL_RATIO * start_r):
+                raise RuntimeError("Arc end radius " + str(end_r)
+                                   + " doesn't match start radius "
+                                   + str(start_r))
+            return i, j
+
+        chord = math.hypot(x_delta, y_delta)
+        if chord == 0:
+            raise RuntimeError("Arc with R can't be a full circle")
+        # Allow a little rounding error on half circles
+        if chord > 2 * abs(R) * (1 + 1e-6):
+            raise RuntimeError("Arc radius " + str(R) + " too small for "
+                               "chord " + str(chord))
+        # Center is to the right of the chord for short clockwise arcs
+        h = math.sqrt(max(R*R - chord*chord / 4, 0)) / chord
+        if cw != (R > 0):
+            h = -h
+        return x_delta / 2 + h * y_delta, y_delta / 2 - h * x_delta
+
+
+    def _arc_extremes(self, x_delta, y_delta, i, j, cw):
+        """ Find the points where an arc crosses the X/Y axes through its
+        center, which are its furthest points in each direction.
+
+        :param x_delta: X position change in mm
+        :type: double
+        :param y_delta: Y position change in mm
+        :type: double
+        :param i: X offset of the arc center from the start in mm
+        :type: double
+        :param j: Y offset of the arc center from the start in mm
+        :type: double
+        :param cw: True for clockwise (G2), False for counterclockwise (G3)
+        :type: bool
+        :return: Points on the arc, relative to its start
+        :rtype: list[(double, double)]
+        """
+
+        radius = math.hypot(i, j)
+        start = math.atan2(-j, -i)
+        turn = -1 if cw else 1
+        sweep = turn * (math.atan2(y_delta - j, x_delta - i) - start) \
+            % (2 * math.pi)
+        if sweep == 0:  # Ends where it starts, full circle
+            sweep = 2 * math.pi
+
+        points = []
+        for quarter in range(4):
+            angle = quarter * math.pi / 2
+            if turn * (angle - start) % (2 * math.pi) <= sweep:
+                points.append((i + radius * math.cos(angle),
+                               j + radius * math.sin(angle)))
+        return points
+
+
+    def _read_gcode(self, filename):
+        """ Read gcode from a filepath, and parse it into a list of calls to
+        the G-code functions. Files ending in .gz or .zst are decompressed
+        as they are read, see gcodeFile.
+
+        Raises IOError if file cannot be opened.
+        Raises a SyntaxError if the G-code could not be parsed.
+
+        :param filename: Directory path of the G-code file, absolute or relative
+        :type: string
+        :return: List of (function name, {parameter: value}), one per G-code
+        command
+        :rtype: list[(string, dict)]
+        """
+
         try:
-            infile = open(filename)  # mode 'r'
+            infile = gcodeFile.open_gcode(filename)
         except:
             print("Could not open file")
             raise
 
-        lines = infile.readlines()
-        execlist = []
+        program = []
 
         # Gcode parsing rules:
         # Ex: N3 G1 X10.3 Y23.4 *34 ; comment
@@ -80,7 +443,7 @@ class GcodeInterface(HardwareManager):
         # Strip any line number (N) fields
         # Strip checksums
         # Parse actual command
-        for j, i in enumerate(lines):
+        for j, i in enumerate(infile):
             orig_line = i
             i = i.upper()
             i = i[0:i.find(";")]  # strip comments
@@ -93,33 +456,29 @@ class GcodeInterface(HardwareManager):
             i = i.strip()
 
 
-            # Parse command into python code
+            # Parse command into function name and parameters
             line = i.split()  # G-code line split list
             if not line:  # No commands in this line
                 continue
 
-            execstr = "self."
             for cmd in self.cmd_list:
                 cmd = cmd.split()  # cmd is command string split list
 
                 if line[0] == cmd[0]:  # line command is in cmd_list
-                    execstr += cmd[0] + "("  # construct direct python call
-                    cmd.pop(0)
+                    params = {}
+                    cmd_name = cmd.pop(0)
                     line.pop(0)
 
                     # Parse command arguements
                     for param in line:  # param: "X123.45"
                         if param[0] in cmd:  # If first char in cmd param list
                             try:  # Check if it's a number
-                                float(param[1:])
+                                params[param[0]] = float(param[1:])
                             except ValueError:
                                 raise SyntaxError("G-code file parsing error: "
                                                   "Command argument not a"
                                                   " number at line" + str(j) +
                                                   ": \n" + orig_line)
-                            if execstr[-1] != "(":
-                                execstr += ", "
-                            execstr += param[0] + "=" + param[1:]
                             cmd.remove(param[0])
                         else:  # Command param not accepted in cmd args
                             raise SyntaxError("G-code file parsing error: "
@@ -127,8 +486,7 @@ class GcodeInterface(HardwareManager):
                                               " at line " + str(j) + ": \n"
                                               + orig_line)
 
-                    execstr += ")"
-                    execlist.append(execstr)
+                    program.append((cmd_name, params))
                     break  # done making command for this line
             else:  # call not found in cmd_list
                 raise SyntaxError("G-code file parsing error: Command not found"
@@ -136,22 +494,15 @@ class GcodeInterface(HardwareManager):
         # Finished parsing file
         infile.close()
 
-        # TODO should this be changed to execute line by line? Parses whole file
-        for execstr in execlist:
-            try:
-                # debug
-                print(execstr)
-                exec(execstr)
-            # TODO Catch exceptions and fail correctly
-            except RuntimeError:
-                self.M1()
-                raise
+        return program
 
 
 
 ################### G code functions ###############################
     """ G0: Rapid move
         G1: Controlled Move
+        G2: Clockwise Arc Move
+        G3: Counterclockwise Arc Move
         G20: Set Units to Inches
         G21: Set Units to mm
         G28: Move to origin (Home)
@@ -239,6 +590,87 @@ class GcodeInterface(HardwareManager):
             raise RuntimeError("G1 Command failed")
 
 
+    def G2(self, X=None, Y=None, I=None, J=None, R=None, F=None):
+        """ G2: Clockwise Arc Move
+
+        Moves along an arc to X, Y, about a center given by I, J offsets from
+        the current position, or by a radius R. The arc is a full circle if
+        it ends where it starts. Lasing and feedrate are the same as G1.
+
+        If an endstop is triggered or the safety switches are triggered, or the
+        arc can't be made, a RuntimeError exception will be raised.
+
+        :param x: X value
+        :param y: Y value
+        :param i: X offset of the center from the current position
+        :param j: Y offset of the center from the current position
+        :param r: Radius, negative for the arc longer than 180 degrees
+        :param f: New feedrate in mm/min (Optional)
+        :return: void
+        """
+
+        self._arc("G2", True, X=X, Y=Y, I=I, J=J, R=R, F=F)
+
+
+    def G3(self, X=None, Y=None, I=None, J=None, R=None, F=None):
+        """ G3: Counterclockwise Arc Move
+
+        Same as G2, counterclockwise.
+
+        :param x: X value
+        :param y: Y value
+        :param i: X offset of the center from the current position
+        :param j: Y offset of the center from the current position
+        :param r: Radius, negative for the arc longer than 180 degrees
+        :param f: New feedrate in mm/min (Optional)
+        :return: void
+        """
+
+        self._arc("G3", False, X=X, Y=Y, I=I, J=J, R=R, F=F)
+
+
+    def _arc(self, cmd, cw, **params):
+        """ Shared G2/G3 arc move.
+
+        :param cmd: Command name for errors
+        :type: string
+        :param cw: True for clockwise, False for counterclockwise
+        :type: bool
+        :param params: G2/G3 parameters
+        :return: void
+        """
+
+        X, Y, F = params["X"], params["Y"], params["F"]
+        if F is not None:
+            if self.las_on:
+                self.set_spd(cut_spd=F / 60.)
+            else:
+                self.set_spd(travel_spd=F / 60.)
+
+        if X is not None:
+            x_delta = X
+            if not self.relative:
+                x_delta -= self.x
+        else:
+            x_delta = 0
+
+        if Y is not None:
+            y_delta = Y
+            if not self.relative:
+                y_delta -= self.y
+        else:
+            y_delta = 0
+
+        i, j = self._arc_center(x_delta, y_delta, cw, **params)
+        las_setting = "default" if self.las_on else "blank"
+        retval = self.laser_arc(x_delta, y_delta, i, j, cw,
+                                las_setting=las_setting)
+        if retval > 0:
+            raise RuntimeError(cmd + " Switch was triggered: " + bin(retval))
+        elif retval < 0:
+            raise RuntimeError(cmd + " Command failed")
+
+
     def G20(self):
         """ G20: Set Units to Inches
 
@@ -304,6 +736,8 @@ class GcodeInterface(HardwareManager):
             raise RuntimeError("G92: Position parameter not a number:" + str(X))
 
         self.x, self.y = X, Y
+        if self.plan is not None:
+            self.plan.add_position(X, Y)
 
 ####################### M Code Functions ################################
     """ M0: Unconditional Stop
@@ -314,6 +748,7 @@ class GcodeInterface(HardwareManager):
         M18: Disable All Stepper Motors
         M42: Switch I/O Pin
         M72: Play a Tone or Song
+        M78: Show Job Statistics
         M92: Set Axis Steps Per Unit
         M106: Fan On
         M107: Fan Off
@@ -367,7 +802,7 @@ class GcodeInterface(HardwareManager):
 
         Adapted from standard G-code M3: Spindle On at S(RPM).
         Currently sets laser power to on or off, no in-between.
-        Laser only fires while moving with G1.
+        Laser only fires while moving with G1, G2 or G3.
 
         :param s: Laser power
         :type: int
@@ -434,6 +869,20 @@ class GcodeInterface(HardwareManager):
         raise NotImplementedError("M72 Play a Tone or Song not implemented")
 
 
+    def M78(self):
+        """ M78: Show Job Statistics
+
+        Adapted from Marlin M78: Show statistical information about the print
+        jobs. Shows the current job's counts and times for each stage and
+        command type, see StageProfiler, and the run cache hit rate.
+
+        :return: Job statistics
+        :rtype: String
+        """
+
+        return str(self.profile) + "\n" + str(self.run_cache)
+
+
     def M92(self, X=None, Y=None):
         """ M92: Set Axis Steps Per Unit
 
@@ -485,7 +934,7 @@ class GcodeInterface(HardwareManager):
         :rtype: String
         """
 
-        return "X:{.2f} Y:{.2f}".format(self.x,self.y)
+        return "X:{:.2f} Y:{:.2f}".format(self.x, self.y)
 
 
     def M115(self):
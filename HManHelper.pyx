@@ -5,9 +5,19 @@ class. Primarily for the laser control algorithm.
 """
 
 cimport hardwareDriver as hd
+from libc.stdlib cimport malloc, free
+from cpython cimport array
 from math import *
 import time
 
+# Homing cycle settings
+HOME_SPD = 100  # mm/s
+ALIGN_SPD = 3  # mm/s
+HOME_OFFSET = 2  # mm from limit switches
+# Warm start touch-off settings, see warm_home
+TOUCH_CLEAR = 0.5  # mm short of the switch edge to start the approach from
+TOUCH_TOLERANCE = 0.2  # mm the switch edge may be off by
+
 cpdef laser_cut(hman, double x_delta, double y_delta,
                 las_setting="default"):
     """ Perform a single straight-line motion of the laser head
@@ -19,25 +29,28 @@ cpdef laser_cut(hman, double x_delta, double y_delta,
     Uses image bitmap from las_mask as the masking bits, or quick options
     from las_setting.
 
+    If hman.motion is running, the move is queued for the motion process and
+    this returns right away, with the switch values of an earlier queued move
+    that failed, if any. If hman.plan is set, the move is only recorded to
+    it, see planFile.pyx.
+
     :param hman: Hardware Manager object
     :type: HardwareManager
     :param x_delta: X position change in mm
     :type: double
     :param y_delta: Y position change in mm
     :type: double
-    :param las_setting: _gen_las_list quick options
+    :param las_setting: _gen_runs quick options
     :type: string
     """
 
     # Algorithm:
-    # 1. Create pathing step list
-    # 1a. Make pixelized line from (x_start,y_start) to (x_end,y_end)
-    # 1b. Convert line into a list of A,B coordinates (algo)
-    # 2. Create laser spot list from pathing step position vs image
-    # 3. Create timing list from speeds and laser spot list
+    # 1. Convert line into A,B steps delta
+    # 2. Create laser runs from pixel crossings of the line vs image
+    # 3. Add step times to runs from speeds and laser state
     # 4. Initialize and check things, clear interrupts?
-    # 5. Main movement loop, iterate on lists (in hardwareDriver.pyx)
-    #   5a. Step X,Y, set las
+    # 5. Main movement loop, iterate on runs (in hardwareDriver.pyx)
+    #   5a. Step X,Y with Bresenham's algo (algo), set las
     #   5b. Poll switches
     #       if switches: Fail out, return switches as error code
     #   5c. Timing idle until next timing delta on list is passed
@@ -70,26 +83,25 @@ cpdef laser_cut(hman, double x_delta, double y_delta,
     if a_delta == 0 and b_delta == 0:  # this kind of works
         return 0
 
-    # Create step list, lasing list, timing list
-    # Diagnostics
-    # start = time.time()
-
-    step_list = _gen_step_list(a_delta, b_delta)
-    # step_time = time.time()
-    # print "gen_step_list time: ", step_time - start
-
-    las_list = _gen_las_list(hman, step_list, setting=las_setting)
-    # las_time = time.time()
-    # print "las_step_list time: ", las_time - step_time
-    # time_time = time.time()
-
+    # Create laser/timing runs, timed for hman.profile
     # TODO Check speed against max toggle rate (~<1kHz) and limit
-    time_list = _gen_time_list(hman, las_list)
-    # print "gen_time_list time: ", time_time - las_time
+    start = time.time()
+    runs = _cached_runs(hman, a_delta, b_delta, las_setting)
+    plan_end = time.time()
 
     # TODO break up command into multiple cuts so OS can schedule interrupts?
-    # Move laser head, with precise timings
-    retval = hd.move_laser(step_list, las_list, time_list)
+    # Move laser head, with precise timings, or queue the move for the motion
+    # process and carry on
+    hman.profile.add("plan", plan_end - start)
+    if hman.plan is not None:
+        retval = hman.plan.add_line(a_delta, b_delta, runs)
+    elif hman.motion is not None:
+        retval = hman.motion.queue_line(a_delta, b_delta, runs,
+                                        hman.cmd_index)
+        hman.profile.add("queue", time.time() - plan_end)
+    else:
+        retval = hd.move_laser(a_delta, b_delta, runs)
+        hman.profile.add("motion", time.time() - plan_end)
     if retval != 0:
         # TODO Track current position if interrupted by switch (How?)
         return retval
@@ -102,194 +114,694 @@ cpdef laser_cut(hman, double x_delta, double y_delta,
     return 0
 
 
+cpdef laser_arc(hman, double x_delta, double y_delta, double i, double j,
+                bint cw, las_setting="default"):
+    """ Perform a single arc motion of the laser head while firing the laser
+    according to the mask image.
+
+    Same as laser_cut, but the head follows an arc about a center point.
+    Steps come straight from an integer arc stepper inside the motion loop,
+    see hd.arc_next(), so an arc is one motion, not a series of chords.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :param x_delta: X position change in mm
+    :type: double
+    :param y_delta: Y position change in mm
+    :type: double
+    :param i: X offset of the arc center from the current position in mm
+    :type: double
+    :param j: Y offset of the arc center from the current position in mm
+    :type: double
+    :param cw: True for clockwise (G2), False for counterclockwise (G3)
+    :type: bint
+    :param las_setting: _gen_runs quick options
+    :type: string
+    """
+
+    # Check if hardware was initialized
+    if not hman.homed or not hman.mots_enabled:
+        return -1
+
+    # Convert to A,B steps delta
+    cdef int a_delta = int(round((x_delta + y_delta) * hman.step_cal))
+    cdef int b_delta = int(round((x_delta - y_delta) * hman.step_cal))
+    cdef hd.ArcStepper arc = _init_arc(hman, a_delta, b_delta, i, j, cw)
+
+    # Create laser/timing runs, timed for hman.profile
+    start = time.time()
+    runs = _gen_arc_runs(hman, arc, setting=las_setting)
+    plan_end = time.time()
+
+    # Move laser head, with precise timings, or queue the move for the motion
+    # process and carry on
+    hman.profile.add("plan", plan_end - start)
+    if hman.plan is not None:
+        retval = hman.plan.add_arc(arc.p, arc.q, arc.end_p, arc.end_q,
+                                   arc.turn, runs)
+    elif hman.motion is not None:
+        retval = hman.motion.queue_arc(arc.p, arc.q, arc.end_p, arc.end_q,
+                                       arc.turn, runs, hman.cmd_index)
+        hman.profile.add("queue", time.time() - plan_end)
+    else:
+        retval = hd.move_arc(arc, runs)
+        hman.profile.add("motion", time.time() - plan_end)
+    if retval != 0:
+        return retval
+
+    # Update position tracking
+    hman.x += 0.5*(a_delta + b_delta) / hman.step_cal
+    hman.y += 0.5*(a_delta - b_delta) / hman.step_cal
+
+    return 0
+
+
 cpdef home_xy(hman):
-    home_spd = 100  # mm/s
-    align_spd = 3  # mm/s
-    offset = 2  # mm from limit switches
+    """ Initialize laser position by moving to endstop min position (0,0).
+
+    Seeks both axes to their min endstops at HOME_SPD, releases and backs off,
+    then re-approaches both axes at ALIGN_SPD in one continuous move that
+    stops each axis on its switch edge. (0,0) is HOME_OFFSET mm out from the
+    switch release edges.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :return: 0 if successful, -1 if a switch was not found, else the switch
+    values that stopped the homing cycle
+    """
 
     # Hardware config
     if not hman.mots_enabled:
         hman.mots_en(1)
-    hman.set_spd(travel_spd=home_spd)
+    hman.set_spd(travel_spd=HOME_SPD)
     hman.homed = True
 
-    # Move XY to -bedmax, until an switch is triggered
-    # If it's safety feet, stop
-    # If it's either, move it back out (ignoring endstops here)
-    x_flag, y_flag = 1, 1
-    while x_flag or y_flag:
-        status = hman.laser_cut(-x_flag * hman.bed_xmax,
-                                -y_flag * hman.bed_ymax, "blank")
-        # print "status", status  # debug
-        if status == 0 or (status & (0x1 << hd.SAFE_FEET)):
-            # If no endstops triggered after the move or safety is engaged
-            hman.homed = False
-            hman.mots_en(0)
-            return status if status != 0 else -1
-        elif status & (0x1 << hd.YMAX + 0x1 << hd.XMAX):
-            hman.mots_en(0)
-            hman.homed = False
-            return status
-
-        # If hit minstop, use a while to back away overriding switch interrupt
-        # TODO Test how repeatable this is
-        # TODO What if both endstops are hit?
-        if status & (0x1 << hd.YMIN):
-            # Back off, move in slowly, then back off again
-            hman.set_spd(travel_spd=align_spd)
-            while hman.laser_cut(0, offset, "blank") & (0x1 << hd.YMIN):
-                hd.delay_micros(hd.USEC_PER_SEC /
-                                (hman.step_cal * hman.travel_spd))
-            hman.laser_cut(0, -hman.bed_ymax, "blank")
-            while hman.laser_cut(0, offset, "blank") & (0x1 << hd.YMIN):
-                hd.delay_micros(hd.USEC_PER_SEC /
-                                (hman.step_cal * hman.travel_spd))
-
-            hman.set_spd(travel_spd=home_spd)
-            y_flag = 0
-
-        if status & (0x1 << hd.XMIN):
-            hman.set_spd(travel_spd=align_spd)
-            while hman.laser_cut(offset, 0, "blank") & (0x1 << hd.XMIN):
-                hd.delay_micros(hd.USEC_PER_SEC /
-                                (hman.step_cal * hman.travel_spd))
-            hman.laser_cut(-hman.bed_xmax, 0, "blank")
-            while hman.laser_cut(offset, 0, "blank") & (0x1 << hd.XMIN):
-                hd.delay_micros(hd.USEC_PER_SEC /
-                                (hman.step_cal * hman.travel_spd))
-
-            hman.set_spd(travel_spd=home_spd)
-            x_flag = 0
+    cdef int home_period = int(hd.USEC_PER_SEC / (HOME_SPD * hman.step_cal))
+    cdef int align_period = int(hd.USEC_PER_SEC / (ALIGN_SPD * hman.step_cal))
+    # Diagonal moves take 2 A/B steps per mm of each axis
+    cdef long seek_steps = int(2 * (hman.bed_xmax + hman.bed_ymax)
+                               * hman.step_cal)
+    cdef long align_steps = int(4 * HOME_OFFSET * hman.step_cal)
+
+    # Seek
+    status = hd.home_axes(-1, -1, seek_steps, home_period, 1)
+    # Release and back off
+    if status == 0:
+        status = hd.home_axes(1, 1, align_steps, align_period, 0)
+    if status == 0:
+        status = hman.laser_cut(HOME_OFFSET, HOME_OFFSET, "blank")
+    # Align on the switch edges
+    if status == 0:
+        status = hd.home_axes(-1, -1, align_steps, align_period, 1)
+    # Release and back off to (0,0)
+    if status == 0:
+        status = hd.home_axes(1, 1, align_steps, align_period, 0)
+    if status == 0:
+        status = hman.laser_cut(HOME_OFFSET, HOME_OFFSET, "blank")
+
+    if status != 0:
+        hman.homed = False
+        hman.mots_en(0)
+        return status
 
     hman.x, hman.y = 0, 0
 
     return 0
 
 
+cpdef warm_home(hman, bint touch_off=False):
+    """ Return to (0,0) without homing, trusting the position from the last
+    homing cycle. Only valid while the motors have stayed enabled since.
+
+    With touch_off, the position is checked against the XMIN switch first:
+    X approaches the switch at ALIGN_SPD from TOUCH_CLEAR mm short of where
+    homing found its release edge, and releases it again. If the edge is
+    within TOUCH_TOLERANCE of HOME_OFFSET out from (0,0), X is set from it,
+    same as homing; else the position can't be trusted.
+
+    Leaves hman in the same state home_xy would.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :param touch_off: Check the position on the XMIN switch
+    :type: bint
+    :return: 0 if at (0,0), -1 if the touch-off didn't find the switch edge
+    where expected, else the switch values that stopped a move
+    """
+
+    hman.set_spd(travel_spd=HOME_SPD)
+    if not touch_off:
+        return hman.laser_cut(-hman.x, -hman.y, "blank")
+
+    cdef int align_period = int(hd.USEC_PER_SEC / (ALIGN_SPD * hman.step_cal))
+    cdef long max_steps = int(HOME_OFFSET * hman.step_cal)
+    cdef long steps_in = 0, steps_out = 0
+
+    status = hman.laser_cut(TOUCH_CLEAR - HOME_OFFSET - hman.x, -hman.y,
+                            "blank")
+    # X only steps of 1/step_cal mm, to the switch and back off its edge
+    if status == 0:
+        status = hd.home_axes(-1, 0, max_steps, align_period, 1, &steps_in)
+    if status == 0:
+        status = hd.home_axes(1, 0, max_steps, align_period, 0, &steps_out)
+    if status != 0:
+        return status
+
+    hman.x += (steps_out - steps_in) / float(hman.step_cal)
+    if abs(hman.x + HOME_OFFSET) > TOUCH_TOLERANCE:
+        return -1
+    hman.x = -HOME_OFFSET
+    return hman.laser_cut(HOME_OFFSET, 0, "blank")
+
+
+cpdef estimate_cut(hman, double x_delta, double y_delta,
+                   las_setting="default"):
+    """ Dry run version of laser_cut. Adds the time the cut would take to
+    hman.dry_run_times without moving the laser head or touching GPIO.
+
+    Uses the same step, laser and timing rules as laser_cut, but counts the
+    lasing steps of the whole segment at once instead of generating per step
+    lists.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :param x_delta: X position change in mm
+    :type: double
+    :param y_delta: Y position change in mm
+    :type: double
+    :param las_setting: _gen_runs quick options
+    :type: string
+    :return: 0 if successful, -1 if laser_cut would fail for not being homed
+    """
+
+    if not hman.homed or not hman.mots_enabled:
+        return -1
+
+    cdef int a_delta = int(round((x_delta + y_delta) * hman.step_cal))
+    cdef int b_delta = int(round((x_delta - y_delta) * hman.step_cal))
+
+    if a_delta == 0 and b_delta == 0:
+        return 0
+
+    cdef long n_steps = max(abs(a_delta), abs(b_delta))
+    cdef long n_las = _count_las_steps(hman, a_delta, b_delta, las_setting)
+
+    # Same integer step periods as _gen_runs
+    cut_period = int(hd.USEC_PER_SEC / (hman.cut_spd * hman.step_cal))
+    travel_period = int(hd.USEC_PER_SEC / (hman.travel_spd * hman.step_cal))
+    hman.dry_run_times["cut"] += n_las * cut_period / float(hd.USEC_PER_SEC)
+    hman.dry_run_times["travel"] += (n_steps - n_las) * travel_period \
+                                    / float(hd.USEC_PER_SEC)
+
+    hman.x += 0.5*(a_delta + b_delta) / hman.step_cal
+    hman.y += 0.5*(a_delta - b_delta) / hman.step_cal
+
+    return 0
+
+
+cpdef estimate_arc(hman, double x_delta, double y_delta, double i,
+                   double j, bint cw, las_setting="default"):
+    """ Dry run version of laser_arc. Adds the time the arc would take to
+    hman.dry_run_times without moving the laser head or touching GPIO.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :param x_delta: X position change in mm
+    :type: double
+    :param y_delta: Y position change in mm
+    :type: double
+    :param i: X offset of the arc center from the current position in mm
+    :type: double
+    :param j: Y offset of the arc center from the current position in mm
+    :type: double
+    :param cw: True for clockwise (G2), False for counterclockwise (G3)
+    :type: bint
+    :param las_setting: _gen_runs quick options
+    :type: string
+    :return: 0 if successful, -1 if laser_arc would fail for not being homed
+    """
+
+    if not hman.homed or not hman.mots_enabled:
+        return -1
+
+    cdef int a_delta = int(round((x_delta + y_delta) * hman.step_cal))
+    cdef int b_delta = int(round((x_delta - y_delta) * hman.step_cal))
+    runs = _gen_arc_runs(hman, _init_arc(hman, a_delta, b_delta, i, j, cw),
+                         setting=las_setting)
+    cdef long k
+    for k in range(0, len(runs), 3):
+        hman.dry_run_times["cut" if runs[k + 1] else "travel"] += \
+            runs[k] * runs[k + 2] / float(hd.USEC_PER_SEC)
+
+    hman.x += 0.5*(a_delta + b_delta) / hman.step_cal
+    hman.y += 0.5*(a_delta - b_delta) / hman.step_cal
+
+    return 0
+
+
+cpdef estimate_warm_home(hman, bint touch_off=False):
+    """ Dry run version of warm_home. Adds an estimate of the time to
+    hman.dry_run_times, assuming the touch-off finds the switch edge exactly
+    where expected.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :param touch_off: Check the position on the XMIN switch
+    :type: bint
+    :return: 0
+    """
+
+    hman.set_spd(travel_spd=HOME_SPD)
+    if not touch_off:
+        return estimate_cut(hman, -hman.x, -hman.y, "blank")
+
+    estimate_cut(hman, TOUCH_CLEAR - HOME_OFFSET - hman.x, -hman.y, "blank")
+    align_period = int(hd.USEC_PER_SEC / (ALIGN_SPD * hman.step_cal))
+    hman.dry_run_times["home"] += 2 * TOUCH_CLEAR * hman.step_cal \
+        * align_period / float(hd.USEC_PER_SEC)
+    hman.x = -HOME_OFFSET
+    return estimate_cut(hman, HOME_OFFSET, 0, "blank")
+
+
+cpdef estimate_home(hman):
+    """ Dry run version of home_xy. Adds an estimate of the homing cycle time
+    to hman.dry_run_times, and leaves hman in the same state home_xy would.
+
+    Assumes the switch edges are exactly HOME_OFFSET out from (0,0), and that
+    both axes back off and re-approach by HOME_OFFSET at once.
+
+    :param hman: Hardware Manager object
+    :type: HardwareManager
+    :return: 0
+    """
+
+    # Seek: 2 A/B steps per mm while both axes move, 1 once only one does
+    x, y = abs(hman.x) + HOME_OFFSET, abs(hman.y) + HOME_OFFSET
+    seek_steps = int(round((2 * min(x, y) + abs(x - y)) * hman.step_cal))
+    # Two diagonal back offs at HOME_SPD, one diagonal approach at ALIGN_SPD
+    offset_steps = int(round(2 * HOME_OFFSET * hman.step_cal))
+    home_period = int(hd.USEC_PER_SEC / (HOME_SPD * hman.step_cal))
+    align_period = int(hd.USEC_PER_SEC / (ALIGN_SPD * hman.step_cal))
+    hman.dry_run_times["home"] += ((seek_steps + 2 * offset_steps)
+                                   * home_period
+                                   + offset_steps * align_period) \
+                                  / float(hd.USEC_PER_SEC)
+
+    hman.mots_enabled = True
+    hman.homed = True
+    hman.set_spd(travel_spd=HOME_SPD)
+    hman.x, hman.y = 0, 0
+
+    return 0
+
+
 ############################# INTERNAL FUNCTIONS ############################
-cdef _gen_step_list(int a_delta, int b_delta):
-    """ Create a list of A/B steps from X/Y coordinates and step size.
+cdef struct StepLine:
+    # Bresenham line from hd.move_laser, in closed form
+    long long n_steps  # Major axis steps
+    long long n_minor  # Minor axis steps
+    bint ab_flip  # B is the major axis
+    int a_sign, b_sign
+    double x0, y0, step_cal, las_dpmm
+
+
+cdef inline long long _step_px(StepLine *line, long long step, int axis):
+    """ Mask pixel column (axis 0) or row (axis 1) the laser head is over
+    after a 0-based step of a line. After k steps along the major axis, the
+    minor axis has taken k * minor // major steps."""
+
+    cdef long long major = step + 1
+    cdef long long minor = major * line.n_minor // line.n_steps
+    cdef long long a_now = minor if line.ab_flip else major
+    cdef long long b_now = major if line.ab_flip else minor
+    a_now *= line.a_sign
+    b_now *= line.b_sign
+    # steps / (steps/mm) * px/mm
+    if axis == 0:
+        return <long long>((line.x0 + 0.5*(a_now + b_now) / line.step_cal)
+                           * line.las_dpmm)
+    return <long long>((line.y0 + 0.5*(a_now - b_now) / line.step_cal)
+                       * line.las_dpmm)
+
+
+cdef void _pixel_events(StepLine *line, int axis, long long first,
+                        long long last, long long *events):
+    """ Fill events with the first step each pixel boundary between first
+    and last is crossed on, along one axis. Boundaries are usually only a few
+    steps apart, so gallop forward from the last one found, then bisect."""
+
+    cdef int sign = 1 if last > first else -1
+    cdef long long target = first
+    cdef long long lo = 0, hi, mid, stride
+    cdef long long n = 0
+    while target != last:
+        target += sign
+        # Gallop: find hi past the boundary, lo before it
+        stride = 1
+        hi = lo
+        while sign * _step_px(line, hi, axis) < sign * target:
+            lo = hi + 1
+            hi = min(hi + stride, line.n_steps - 1)
+            stride *= 2
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sign * _step_px(line, mid, axis) >= sign * target:
+                hi = mid
+            else:
+                lo = mid + 1
+        events[n] = lo
+        n += 1
+
+
+cdef _gen_runs(hman, int a_delta, int b_delta, setting="default"):
+    """ Create run-length encoded laser and timing runs for a cutting path,
+    for move_laser.
+
+    Has options for generating stock runs quickly. Currently supports:
+    "blank" - All white, no cut
+    "dark" - All black, cut everything
+    "default" - Compares projected position against laser darkfield bitmask
 
-    Uses Bresenhem line rasterization algorithm.
+    Laser moves at cut_spd when laser is on, travel_spd else.
 
     :param a_delta: Number of steps to take on A axis
     :type: int
     :param b_delta: Number of steps to take on B axis
     :type: int
-    :return: list of A/B steps (+/- 1 or 0)
-    :rtype: list[n][2]
+    :param setting: Run generation settings.
+    :return: Flat (count, laser, period) runs: number of steps, laser on/off
+    (0 or 1), and time (us) to spend at each step
+    :rtype: array.array('i')
     """
 
-    # Divide into quadrants by reversing directions as needed
-    cdef bint a_flip_flag = False
-    cdef bint b_flip_flag = False
-    cdef bint ab_flip_flag = False
-
-    if a_delta < 0:
-        a_delta = -a_delta
-        a_flip_flag = True
-    if b_delta < 0:
-        b_delta = -b_delta
-        b_flip_flag = True
-
-    # Divide into octants by swapping so A > B
-    if b_delta > a_delta:
-        a_delta, b_delta = b_delta, a_delta # yep, that's safe and portable /s
-        ab_flip_flag = True
-
-    # Generate step list for line in first octant. Bresenham's algo here
-    # TODO Optimize gen_step_list by using C arrays
-    step_list = []
-    cdef int a_now = 0
-    cdef int error = b_delta - a_delta
-    while a_now < a_delta:
-        ab_list = [1,0]
-        if error >= 0:
-            ab_list[1] = 1
-            error -= a_delta
-        a_now += 1
-        error += b_delta
-        step_list.append(ab_list)
-
-    # Reverse octants, quadrants
-    if ab_flip_flag:
-        step_list = [[ab[1], ab[0]] for ab in step_list]
-
-    if a_flip_flag:
-        step_list = [[-ab[0], ab[1]] for ab in step_list]
-    if b_flip_flag:
-        step_list = [[ab[0], -ab[1]] for ab in step_list]
-
-    return step_list
-
-
-cdef _gen_las_list(hman, step_list, setting="default"):
-    """ Create a list of 1-bit laser power (on/off) for cutting path.
-
-    Has options for generating stock las_list's quickly. Currently supports:
-    "blank" - All white, no cut
-    "dark" - All black, cut everything
-    "default" - Compares projected position against laser darkfield bitmask
+    # TODO do 8 bit laser power settings and timings
+    cdef int periods[2]
+    periods[0] = int(hd.USEC_PER_SEC / (hman.travel_spd * hman.step_cal))
+    periods[1] = int(hd.USEC_PER_SEC / (hman.cut_spd * hman.step_cal))
+
+    cdef long long *starts
+    cdef char *las
+    cdef long long n_runs = _las_runs(hman, a_delta, b_delta, setting,
+                                      &starts, &las)
+    cdef long long n_steps = max(abs(a_delta), abs(b_delta))
+    runs = array.array('i', [0]) * (3 * n_runs)
+    cdef int[:] run_arr = runs
+    cdef long long i
+    for i in range(n_runs):
+        run_arr[3*i] = (starts[i + 1] if i + 1 < n_runs else n_steps) \
+            - starts[i]
+        run_arr[3*i + 1] = las[i]
+        run_arr[3*i + 2] = periods[las[i]]
+    free(starts)
+
+    return runs
+
+
+cdef _cached_runs(hman, int a_delta, int b_delta, setting):
+    """ _gen_runs through hman.run_cache, so repeated segments reuse their
+    runs instead of generating them again.
 
-    :param step_list: List of A/B steps to take for cut operation
-    :type: list[n][2] of int(+/-1 or 0)
-    :param setting: las_list generation settings.
-    :return: laser cutting bit list
-    :rtype: list[n] of [0 or 1]
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param setting: Run generation settings, same as _gen_runs
+    :return: Flat (count, laser, period) runs, shared, not to be modified
+    :rtype: array.array('i')
     """
 
-    if setting == "blank":
-        return [0 for i in range(len(step_list))]
-    if setting == "dark":
-        return [1 for i in range(len(step_list))]
+    cache = hman.run_cache
+    key = _runs_key(hman, a_delta, b_delta, setting)
+    runs = cache.get(key)
+    if runs is None:
+        runs = _gen_runs(hman, a_delta, b_delta, setting=setting)
+        cache.put(key, runs)
+    return runs
+
+
+cdef tuple _runs_key(hman, int a_delta, int b_delta, setting):
+    """ Everything the runs of a segment depend on, for hman.run_cache.
+
+    Blank and dark runs only depend on the segment and speeds. Runs over the
+    mask also depend on where the segment starts, in steps, rounded so float
+    drift from repeating a path doesn't change the key, and on the mask.
+
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param setting: Run generation settings, same as _gen_runs
+    :return: Cache key
+    :rtype: tuple
+    """
+
+    cdef double step_cal = hman.step_cal
+    if setting != "default":
+        return (a_delta, b_delta, setting, hman.travel_spd, hman.cut_spd,
+                step_cal)
+    # Start position in millionths of a step
+    cdef double x = hman.x, y = hman.y
+    return (a_delta, b_delta, setting, hman.travel_spd, hman.cut_spd,
+            step_cal, <long long>(x * step_cal * 1e6 + 0.5),
+            <long long>(y * step_cal * 1e6 + 0.5), id(hman.las_mask),
+            hman.las_dpmm)
+
 
-    cdef double x_now = hman.x
-    cdef double y_now = hman.y
-    # cdef int mask_xsize = len(hman.las_mask)
-    # cdef int mask_ysize = len(hman.las_mask[0])
-    cdef int mask_xsize = hman.las_mask.shape[0]
-    cdef int mask_ysize = hman.las_mask.shape[1]
-    cdef int x_px, y_px
-    # TODO Cast las_mask as a C array for speed and compatibility
-    # las_mask currently a numpy array
+cdef long long _las_runs(hman, int a_delta, int b_delta, setting,
+                         long long **run_starts, char **run_las) except -1:
+    """ Find the steps where the laser turns on or off along a line. Runs
+    are written to a buffer allocated here which the caller frees with
+    free(run_starts[0]).
 
-    las_list = []
+    The laser can only change where the path enters a new mask pixel. Pixel
+    column and row are each monotonic along a line, so the step where each
+    pixel boundary is crossed is found by searching over the step index,
+    carrying on from the last boundary found. The mask is only looked up at
+    those steps, so cost scales with pixels crossed, not steps taken.
 
-    for i in step_list:
-        x_now += 0.5*(i[0] + i[1]) / hman.step_cal  # steps / (steps/mm)
-        y_now += 0.5*(i[0] - i[1]) / hman.step_cal
+    Same settings as _gen_runs.
 
-        # Sets laser power to 0 if mask is 255 (blank = don't cut)
-        x_px = int(x_now * hman.las_dpmm)  # mm * px/mm
-        y_px = int(y_now * hman.las_dpmm)
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param setting: Run generation settings.
+    :param run_starts: Set to the step index each run starts at
+    :param run_las: Set to the laser value (0 or 1) of each run
+    :return: Number of runs
+    :rtype: long long
+    """
 
-        if  y_px >= hman.las_mask.shape[0] or x_px >= hman.las_mask.shape[1]:
-            las_list.append(0)
-            continue
+    cdef long long n_steps = max(abs(a_delta), abs(b_delta))
+    cdef StepLine line
+    line.n_steps = n_steps
+    line.n_minor = min(abs(a_delta), abs(b_delta))
+    line.ab_flip = abs(b_delta) > abs(a_delta)
+    line.a_sign = -1 if a_delta < 0 else 1
+    line.b_sign = -1 if b_delta < 0 else 1
+    line.x0, line.y0 = hman.x, hman.y
+    line.step_cal, line.las_dpmm = hman.step_cal, hman.las_dpmm
+
+    # Steps where the pixel column (axis 0) or row (axis 1) changes
+    cdef long long first[2]
+    cdef long long last[2]
+    cdef long long n_events[2]
+    n_events[0] = n_events[1] = 0
+    cdef int axis
+    if setting not in ("blank", "dark") and n_steps != 0:
+        for axis in range(2):
+            first[axis] = _step_px(&line, 0, axis)
+            last[axis] = _step_px(&line, n_steps - 1, axis)
+            n_events[axis] = abs(last[axis] - first[axis])
+
+    # One block: run starts, x events, y events, run laser values
+    cdef long long n_max = n_events[0] + n_events[1] + 1
+    cdef long long *starts = <long long *>malloc(
+        n_max * (2 * sizeof(long long) + sizeof(char)))
+    if starts == NULL:
+        raise MemoryError()
+    cdef long long *x_events = starts + n_max
+    cdef long long *y_events = x_events + n_events[0]
+    cdef char *las_vals = <char *>(starts + 2 * n_max)
+    run_starts[0] = starts
+    run_las[0] = las_vals
+    starts[0] = 0
+    if setting == "blank" or n_steps == 0:
+        las_vals[0] = 0
+        return 1
+    if setting == "dark":
+        las_vals[0] = 1
+        return 1
+
+    _pixel_events(&line, 0, first[0], last[0], x_events)
+    _pixel_events(&line, 1, first[1], last[1], y_events)
+
+    # Merge the event lists, look up the mask only where the pixel changes,
+    # and merge events that don't change the laser into runs
+    cdef unsigned char[:, :] mask
+    cdef long long n_runs = 0
+    cdef long long i = 0, j = 0, step = 0
+    cdef long long x_px, y_px
+    cdef char las
+    try:
+        try:
+            mask = hman.las_mask  # uint8 array from set_las_mask
+        except (TypeError, ValueError):
+            import numpy as np
+            mask = np.asarray(hman.las_mask, dtype=np.uint8)
+        while True:
+            # y - row, x - column. Pixels off the mask are never lased
+            x_px = _step_px(&line, step, 0)
+            y_px = _step_px(&line, step, 1)
+            if y_px >= mask.shape[0] or x_px >= mask.shape[1]:
+                las = 0
+            else:
+                las = mask[y_px, x_px] != 255
+            # TODO do 8 bit laser power settings and gamma curve
+
+            if n_runs == 0 or las != las_vals[n_runs - 1]:
+                starts[n_runs] = step
+                las_vals[n_runs] = las
+                n_runs += 1
+
+            # Next step either pixel index changes on
+            if i < n_events[0] and (j >= n_events[1]
+                                    or x_events[i] <= y_events[j]):
+                step = x_events[i]
+            elif j < n_events[1]:
+                step = y_events[j]
+            else:
+                break
+            while i < n_events[0] and x_events[i] == step:
+                i += 1
+            while j < n_events[1] and y_events[j] == step:
+                j += 1
+    except:
+        free(starts)
+        raise
+
+    return n_runs
+
+
+cdef hd.ArcStepper _init_arc(hman, int a_delta, int b_delta, double i,
+                             double j, bint cw):
+    """ Set up the arc stepper for an arc from the current position, see
+    hd.arc_init(). The center is rounded to the nearest step.
+
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param i: X offset of the arc center from the current position in mm
+    :type: double
+    :param j: Y offset of the arc center from the current position in mm
+    :type: double
+    :param cw: True for clockwise in X/Y, False for counterclockwise
+    :type: bint
+    :return: Arc stepper at the start of the arc
+    :rtype: hd.ArcStepper
+    """
 
-        # y - row, x - column
-        las_list.append(1 if hman.las_mask[y_px][x_px] != 255 else 0)
-        # las_list.append(255-hman.las_mask[x_px][y_px]) # 8b power settings
-        # TODO do 8 bit laser power settings and gamma curve
+    cdef long long a_center = int(round((i + j) * hman.step_cal))
+    cdef long long b_center = int(round((i - j) * hman.step_cal))
+    # X/Y clockwise is A/B counterclockwise
+    return hd.arc_init(-a_center, -b_center, a_delta - a_center,
+                       b_delta - b_center, 1 if cw else -1)
 
-    return las_list
 
+cdef _gen_arc_runs(hman, hd.ArcStepper arc, setting="default"):
+    """ Create run-length encoded laser and timing runs for an arc, for
+    hd.move_arc. Steps through a copy of the arc, looking up the mask each
+    time the head enters a new pixel.
 
-cdef _gen_time_list(hman, las_list):
-    """ Create a list of times to stay at each step for laser cutting
-    or moving.
+    Same settings and runs as _gen_runs.
 
-    :param las_list: laser cutting bit list
-    :type: list[n] of 0 or 1
-    :return: List of times
-    :rtype: list[n] <integer>
+    :param arc: Arc stepper at the start of the arc
+    :type: hd.ArcStepper
+    :param setting: Run generation settings.
+    :return: Flat (count, laser, period) runs
+    :rtype: array.array('i')
     """
 
-    # TODO do 8 bit timings
-    return [int(hd.USEC_PER_SEC / (hman.cut_spd * hman.step_cal)) if i
-            else int(hd.USEC_PER_SEC / (hman.travel_spd * hman.step_cal))
-            for i in las_list]
+    # TODO do 8 bit laser power settings and timings
+    cdef int periods[2]
+    periods[0] = int(hd.USEC_PER_SEC / (hman.travel_spd * hman.step_cal))
+    periods[1] = int(hd.USEC_PER_SEC / (hman.cut_spd * hman.step_cal))
+
+    cdef unsigned char[:, :] mask
+    if setting == "default":
+        try:
+            mask = hman.las_mask  # uint8 array from set_las_mask
+        except (TypeError, ValueError):
+            import numpy as np
+            mask = np.asarray(hman.las_mask, dtype=np.uint8)
+    cdef bint use_mask = setting == "default"
+    cdef int las = setting == "dark"
+    cdef double x0 = hman.x, y0 = hman.y
+    cdef double step_cal = hman.step_cal, las_dpmm = hman.las_dpmm
+    cdef long long a_now = 0, b_now = 0
+    cdef long long x_px, y_px, x_last = -1, y_last = -1
+    cdef long count = 0
+    cdef int las_prev = -1
+    run_list = []
+
+    cdef int code = hd.arc_next(&arc)
+    while code:
+        if code & hd.A_STEP:
+            a_now += 1 if code & hd.A_FWD else -1
+        if code & hd.B_STEP:
+            b_now += 1 if code & hd.B_FWD else -1
+
+        if use_mask:
+            # steps / (steps/mm) * px/mm, same as _step_px
+            x_px = <long long>((x0 + 0.5*(a_now + b_now) / step_cal)
+                               * las_dpmm)
+            y_px = <long long>((y0 + 0.5*(a_now - b_now) / step_cal)
+                               * las_dpmm)
+            if x_px != x_last or y_px != y_last:
+                # y - row, x - column. Pixels off the mask are never lased
+                if y_px >= mask.shape[0] or x_px >= mask.shape[1]:
+                    las = 0
+                else:
+                    las = mask[y_px, x_px] != 255
+                x_last, y_last = x_px, y_px
+
+        if las != las_prev and count:
+            run_list.extend((count, las_prev, periods[las_prev]))
+            count = 0
+        las_prev = las
+        count += 1
+        code = hd.arc_next(&arc)
+
+    if count:
+        run_list.extend((count, las_prev, periods[las_prev]))
+    return array.array('i', run_list)
+
+
+cdef long _count_las_steps(hman, int a_delta, int b_delta,
+                           setting="default") except -1:
+    """ Count the number of steps _gen_runs would turn the laser on for,
+    from the laser runs, without generating any per step lists.
+
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param setting: Run generation settings, same as _gen_runs
+    :return: Number of steps with the laser on
+    :rtype: long
+    """
 
-    # # Accel code doesn't really work with 8 bit timings
-    # time_list = []
-    # for l in las_list:
\ No newline at end of file
+    cdef long long *starts
+    cdef char *las
+    cdef long long n_runs = _las_runs(hman, a_delta, b_delta, setting,
+                                      &starts, &las)
+    cdef long long n_steps = max(abs(a_delta), abs(b_delta))
+    cdef long las_steps = 0
+    cdef long long i
+    for i in range(n_runs):
+        if las[i]:
+            las_steps += (starts[i + 1] if i + 1 < n_runs else n_steps) \
+                - starts[i]
+    free(starts)
+    return las_steps
@@ -4,12 +4,13 @@ The HardwareManager object class, for maintaining laser cutter state and
 control and setting interfaces
 """
 
-import numpy as np
-
 import HManHelper as HMH
 import hardwareDriver as hd
+from RunCache import RunCache
+from StageProfiler import StageProfiler
 # import hardwareDriverPigpio as hd
 import sys
+import time
 
 
 class HardwareManager(object):
@@ -23,8 +24,12 @@ class HardwareManager(object):
     """
 
 
-    def __init__(self):
+    def __init__(self, dry_run=False):
         """ Instantiate and initialize default settings for HardwareManager.
+
+        :param dry_run: If True, never touch GPIO. Motions only add their
+        estimated times to dry_run_times.
+        :type: bool
         """
 
         # Default vals and settings
@@ -34,14 +39,26 @@ class HardwareManager(object):
         self.bed_xmax = 250     # mm
         self.bed_ymax = 280     # mm
         self.skew = 0           # degrees
+        self.warm_start = False  # Skip homing while still homed, see home_xy
+        self.touch_off = False   # Check warm starts on the XMIN switch
 
-        self.las_mask = np.array([[255]])  # 255: White - PIL Image 0-255 vals
+        self.las_mask = [[255]]  # 255: White - PIL Image 0-255 vals
         self.las_dpmm = 0.00000001  # ~0 Dots Per mm, 1 pixel for whole space
 
         # Vals on init
         self.homed = False
         self.mots_enabled = False
         self.x, self.y = 0.0, 0.0
+        self.dry_run = dry_run
+        self.dry_run_times = {"cut": 0.0, "travel": 0.0, "home": 0.0}  # s
+        self.profile = StageProfiler()  # Per job stage/command timers
+        self.run_cache = RunCache()  # Laser/timing runs of repeated moves
+        self.motion = None  # MotionProcess stepping queued moves, if started
+        self.telemetry = None  # TelemetryRecord published to, if started
+        self.cmd_index = 0  # Job command being run, for telemetry
+        self.plan = None  # planFile.PlanWriter recording moves, in plan mode
+        if dry_run:
+            return
         if hd.gpio_init() != 0:
             if "hardwareDriverPigpio" in sys.modules.keys():
                 raise IOError("GPIO not initialized correctly; "
@@ -56,7 +73,9 @@ class HardwareManager(object):
         """ Disable the laser upon quitting, and close the GPIO access.
         """
         self.mots_en(0)
-        hd.gpio_close()
+        self.stop_motion()
+        if not self.dry_run:
+            hd.gpio_close()
 
 
     ################### SETTINGS INTERFACE FUNCTIONS #####################
@@ -103,10 +122,12 @@ class HardwareManager(object):
 
         :return: void
         """
-        self.las_mask = np.array(img)
+        import numpy as np  # Only needed for masks, slow to import
+        self.las_mask = np.array(img, dtype=np.uint8)
         # Workaround for numpy not liking "1" mode images
         # self.las_mask = np.array(list(img.getdata())).reshape(img.size)
         self.las_dpmm = scale
+        self.run_cache.clear()  # Cached runs were for the old mask
 
 
     def set_step_cal(self, step_cal):
@@ -154,6 +175,22 @@ class HardwareManager(object):
         self.skew = angle
 
 
+    def set_warm_start(self, en, touch_off=False):
+        """ Enable or disable warm starts: homing while still homed, with the
+        motors enabled ever since, moves straight back to (0,0) instead of
+        running the homing cycle. For running jobs back to back.
+
+        :param en: True to enable warm starts
+        :type: bool
+        :param touch_off: Check the position on the XMIN switch edge before
+        trusting it, falling back to the homing cycle if it's off
+        :type: bool
+        :return: void
+        """
+        self.warm_start = en
+        self.touch_off = touch_off
+
+
     #################### HW INTERFACE FUNCTIONS ########################
 
     # TODO Write functions for calibration and getting hardware shape (bed size)
@@ -161,10 +198,40 @@ class HardwareManager(object):
     def home_xy(self):
         """ Initialize laser position by moving to endstop min position (0,0).
 
-        This is a wrapper for the HManHelper function.
+        This is a wrapper for the HManHelper function. With warm starts
+        enabled, see set_warm_start, the homing cycle is skipped if the
+        position from the last one can still be trusted.
 
         :return: 0 if successful, -1 if an error occured
         """
+        warm = self.warm_start and self.homed and self.mots_enabled
+        if self.plan is not None:
+            # Replay homes for real, warm or not, on the replaying machine
+            self.plan.add_home()
+            return HMH.estimate_home(self)
+        if self.dry_run:
+            if warm:
+                return HMH.estimate_warm_home(self, self.touch_off)
+            return HMH.estimate_home(self)
+        if self.motion is None:
+            return self._home_xy(warm)
+
+        # Homing steps in this process, so the motion process has to be idle
+        status = self.wait_motion()
+        if status != 0:
+            return status
+        motion, self.motion = self.motion, None
+        try:
+            return self._home_xy(warm)
+        finally:
+            self.motion = motion
+
+
+    def _home_xy(self, warm):
+        """ Warm start if asked to, else or if that fails, run the homing
+        cycle. """
+        if warm and HMH.warm_home(self, self.touch_off) == 0:
+            return 0
         return HMH.home_xy(self)
 
 
@@ -178,6 +245,9 @@ class HardwareManager(object):
         :return: void/null
         """
 
+        if self.dry_run:
+            return
+        self.wait_motion()
         hd.las_pulse(time)
 
 
@@ -191,9 +261,182 @@ class HardwareManager(object):
         :rtype: int
         """
 
+        if self.dry_run:
+            return 0
         return hd.read_switches()
 
 
+    def set_realtime(self, en, cpu=-1):
+        """ Enable or disable real-time step timing. Runs under SCHED_FIFO with
+        locked memory, optionally pinned to one CPU, and sleeps until each
+        step deadline instead of busy waiting.
+
+        This is a wrapper for a hardwareDriver function.
+
+        Raises IOError if real-time scheduling could not be set up.
+
+        :param en: 1 to enable, 0 to disable
+        :type: bint (bool)
+        :param cpu: CPU to pin to, -1 to leave affinity alone. Disabling
+        always unpins.
+        :type: int
+        :return: void
+        """
+
+        if self.dry_run:
+            return
+        if hd.set_realtime(en, cpu) != 0:
+            raise IOError("Real-time mode not set up correctly; "
+                          "Do you have root?")
+
+
+    def start_motion(self, cpu=-1, realtime=True):
+        """ Start stepping in a separate motion process, see motionProcess.py.
+
+        Moves are then queued for the motion process instead of stepped in
+        this one, and the laser_cut/laser_arc calls return once the move is
+        queued. A move that fails is reported by the next move or
+        wait_motion() instead. Does nothing in dry run mode. Start telemetry
+        first to have the motion process publish its steps.
+
+        Raises IOError if real-time mode could not be set up.
+
+        :param cpu: CPU to pin the motion process to, -1 to leave affinity
+        alone
+        :type: int
+        :param realtime: Run the motion process in real-time mode, see
+        set_realtime
+        :type: bool
+        :return: void
+        """
+
+        if self.dry_run or self.motion is not None:
+            return
+        from motionProcess import MotionProcess
+        self.motion = MotionProcess(cpu, realtime)
+
+
+    def stop_motion(self):
+        """ Finish the queued moves and stop the motion process, going back
+        to stepping in this process.
+
+        :return: void
+        """
+
+        if self.motion is not None:
+            self.motion.close()
+            self.motion = None
+
+
+    def start_telemetry(self, path=None):
+        """ Start publishing live machine state to a shared memory record,
+        for monitoring tools in other processes, see telemetry.pyx and
+        publish_state. The head position, laser and switches are published
+        by the step loops on every step, in the motion process if one is
+        running.
+
+        Raises IOError if the record can't be made, and a RuntimeError if the
+        motion process was already started, since it couldn't publish.
+
+        :param path: Record file, telemetry.TELEMETRY_PATH if not given
+        :type: string
+        :return: void
+        """
+
+        if self.motion is not None:
+            raise RuntimeError("Start telemetry before the motion process")
+        import telemetry
+        self.telemetry = telemetry.TelemetryRecord(
+            path or telemetry.TELEMETRY_PATH, writer=True)
+        if not self.dry_run:
+            self.telemetry.publish_steps()
+        self.publish_state()
+
+
+    def publish_state(self, cmd=0, n_cmds=0, running=False):
+        """ Update the telemetry record, if started, with the job progress
+        and the laser, homing and motor state. While nothing is stepping,
+        also sets the head position to self.x, self.y, with the switch
+        values; the step loops count on from there.
+
+        :param cmd: Commands of the job run so far
+        :type: int
+        :param n_cmds: Commands in the job
+        :type: int
+        :param running: True while a job is running
+        :type: bool
+        :return: void
+        """
+
+        if self.telemetry is None:
+            return
+        import telemetry
+        flags = (telemetry.FLAG_LASER if getattr(self, "las_on", False)
+                 else 0) \
+            | (telemetry.FLAG_HOMED if self.homed else 0) \
+            | (telemetry.FLAG_MOTORS if self.mots_enabled else 0) \
+            | (telemetry.FLAG_RUNNING if running else 0)
+        self.telemetry.publish(cmd, n_cmds, flags, self.step_cal)
+        # Only this process writes the ring, so once it's empty the motion
+        # process stays idle until the next move is queued
+        if self.motion is None or self.motion.ring.empty():
+            self.telemetry.publish_head(
+                int(round((self.x + self.y) * self.step_cal)),
+                int(round((self.x - self.y) * self.step_cal)), cmd,
+                self.read_sws())
+
+
+    def wait_motion(self):
+        """ Wait for all queued moves to finish, timed as the "motion" stage
+        in self.profile.
+
+        :return: 0 if they finished, else the switch values that stopped one,
+        same as laser_cut
+        :rtype: int
+        """
+
+        if self.motion is None:
+            return 0
+        start = time.time()
+        status = self.motion.wait()
+        self.profile.add("motion", time.time() - start)
+        return status
+
+
+    def replay_plan(self, filename):
+        """ Run a plan file made by GcodeInterface.plan_gcode, stepping its
+        planned moves with no planning work, see planFile.pyx. Reading the
+        file is timed as the "load" stage in self.profile, and running it as
+        the "replay" stage.
+
+        Raises IOError if the file can't be read or isn't a valid plan file,
+        and a RuntimeError if it was planned with other step_cal, speed or
+        bed limit settings than this machine has.
+
+        :param filename: Plan file name
+        :type: string
+        :return: 0 if successful, -1 for a move while not homed, else the
+        switch values that stopped a move or homing. Motors are disabled if
+        the plan didn't finish.
+        :rtype: int
+        """
+
+        import planFile
+        start = time.time()
+        plan = planFile.read_plan(filename)
+        plan.check(self)
+        self.profile.add("load", time.time() - start)
+
+        start = time.time()
+        status = plan.replay(self)
+        self.profile.add("replay", time.time() - start)
+        if status == 0:
+            status = self.wait_motion()
+        if status != 0:
+            self.mots_en(0)
+        return status
+
+
     def mots_en(self, en):
         """ Enable or disable stepper motors.
 
@@ -204,11 +447,17 @@ class HardwareManager(object):
         :return: void
         """
 
+        if self.plan is not None:
+            self.plan.add_motors(en)
         if en:
-            hd.motor_enable()
+            if not self.dry_run:
+                hd.motor_enable()
             self.mots_enabled = True
         else:
-            hd.motor_disable()
+            if self.motion is not None:
+                self.motion.abort()  # Stop the head first
+            if not self.dry_run:
+                hd.motor_disable()
             self.mots_enabled = False
             self.homed = False
 
@@ -226,4 +475,28 @@ class HardwareManager(object):
         :return:
         """
 
+        if self.dry_run and self.plan is None:
+            return HMH.estimate_cut(self, x_delta, y_delta, las_setting)
         return HMH.laser_cut(self, x_delta, y_delta, las_setting)
+
+
+    def laser_arc(self, x_delta, y_delta, i, j, cw, las_setting="default"):
+        """ Perform a single arc motion of the laser head while firing the
+        laser according to the mask image.
+
+        This is a wrapper for the HManHelper function.
+
+        :param x_delta: X position change in mm
+        :param y_delta: Y position change in mm
+        :param i: X offset of the arc center from the current position in mm
+        :param j: Y offset of the arc center from the current position in mm
+        :param cw: True for clockwise (G2), False for counterclockwise (G3)
+        :param las_setting:
+
+        :return:
+        """
+
+        if self.dry_run and self.plan is None:
+            return HMH.estimate_arc(self, x_delta, y_delta, i, j, cw,
+                                    las_setting)
+        return HMH.laser_arc(self, x_delta, y_delta, i, j, cw, las_setting)
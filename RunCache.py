@@ -0,0 +1,117 @@
+"""
+RunCache.py
+Least recently used cache of laser/timing runs for motion segments, so
+repeated moves skip run generation.
+"""
+
+# Rough size of a cache entry besides its runs: key tuple, dict slot
+ENTRY_OVERHEAD = 200  # bytes
+# Fraction of max_bytes to evict down to when full, so evicting is rare
+EVICT_TO = 0.75
+
+
+class RunCache(object):
+    """ LRU cache of run arrays from HManHelper._gen_runs, keyed by
+    everything the runs depend on, see HManHelper._runs_key.
+
+    Lookups only stamp the entry with a use count, since a lookup has to cost
+    less than the few microseconds generating the runs takes. Least recently
+    used entries are evicted in batches when the cache is full.
+
+    Cached runs are shared between every move that hits them, and must not
+    be modified.
+    """
+
+    def __init__(self, max_bytes=4 * 2**20):
+        """ Instantiate an empty cache.
+
+        :param max_bytes: Memory cap for cached runs, 0 to disable caching
+        :type: int
+        """
+
+        self.max_bytes = max_bytes
+        self.clear()
+
+
+    def clear(self):
+        """ Drop all cached runs and reset the counters, e.g. when the laser
+        mask changes.
+
+        :return: void
+        """
+
+        self.entries = {}  # key: [runs, use count when last used]
+        self.uses = 0
+        self.size = 0  # bytes
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        """ Look up the runs for a segment, and mark them as recently used.
+
+        :param key: Segment key
+        :type: tuple
+        :return: Cached runs, or None if not cached
+        :rtype: array.array('i')
+        """
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.uses += 1
+        entry[1] = self.uses
+        return entry[0]
+
+
+    def put(self, key, runs):
+        """ Cache the runs for a segment. If that fills the cache past
+        max_bytes, the least recently used runs are evicted until it is
+        down to EVICT_TO of max_bytes.
+
+        Runs bigger than max_bytes on their own are not cached.
+
+        :param key: Segment key
+        :type: tuple
+        :param runs: Runs to cache
+        :type: array.array('i')
+        :return: void
+        """
+
+        size = _entry_size(runs)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= _entry_size(self.entries[key][0])
+        self.uses += 1
+        self.entries[key] = [runs, self.uses]
+        self.size += size
+        if self.size <= self.max_bytes:
+            return
+
+        by_use = sorted(self.entries.items(), key=lambda item: item[1][1])
+        for old_key, (old_runs, _) in by_use:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            del self.entries[old_key]
+            self.size -= _entry_size(old_runs)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "Run cache: {} hits, {} misses ({:.0%}), {} entries, " \
+               "{:.0f} kB".format(self.hits, self.misses,
+                                  self.hits / float(lookups) if lookups else 0,
+                                  len(self.entries), self.size / 1024.)
+
+
+def _entry_size(runs):
+    """ Bytes a cache entry takes up, roughly."""
+
+    return len(runs) * runs.itemsize + ENTRY_OVERHEAD
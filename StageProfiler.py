@@ -0,0 +1,154 @@
+"""
+StageProfiler.py
+Low overhead counters and cumulative timers for each stage of running a job,
+and for each G-code command type, for finding out where a slow job's time went.
+"""
+
+import csv
+import json
+import time
+
+
+class StageProfiler(object):
+    """ Counts and total times for each pipeline stage (parse, bounds, plan,
+    motion) and each command type (G0, G1, ...) of the current job.
+
+    Timing is done by the caller, which passes in the elapsed seconds, so
+    adding a sample is only a dict lookup and two additions.
+    """
+
+    def __init__(self, enabled=True):
+        """ Instantiate an empty profile.
+
+        :param enabled: If False, add and add_cmd do nothing
+        :type: bool
+        """
+
+        self.enabled = enabled
+        self.reset()
+
+
+    def reset(self, job=None):
+        """ Clear all counters and timers, for the start of a new job.
+
+        :param job: Name of the job, e.g. the G-code file name
+        :type: string
+        :return: void
+        """
+
+        self.job = job
+        self.start = time.time()
+        self.stages = {}  # stage: [count, seconds]
+        self.commands = {}  # command: [count, seconds]
+
+
+    def add(self, stage, seconds):
+        """ Add one sample of a pipeline stage.
+
+        :param stage: Stage name
+        :type: string
+        :param seconds: Time spent in the stage
+        :type: double
+        :return: void
+        """
+
+        if not self.enabled:
+            return
+        try:
+            entry = self.stages[stage]
+        except KeyError:
+            entry = self.stages[stage] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+
+    def add_cmd(self, cmd, seconds):
+        """ Add one sample of a G-code command type.
+
+        :param cmd: Command name, e.g. "G1"
+        :type: string
+        :param seconds: Time spent running the command
+        :type: double
+        :return: void
+        """
+
+        if not self.enabled:
+            return
+        try:
+            entry = self.commands[cmd]
+        except KeyError:
+            entry = self.commands[cmd] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+
+    def summary(self):
+        """ Summarize the current job's counters and timers.
+
+        :return: Job name, wall time since reset in seconds, and count and
+        time in seconds for each stage and command type
+        :rtype: dict
+        """
+
+        return {
+            "job": self.job,
+            "wall": time.time() - self.start,
+            "stages": dict((k, {"count": v[0], "time": v[1]})
+                           for k, v in self.stages.items()),
+            "commands": dict((k, {"count": v[0], "time": v[1]})
+                             for k, v in self.commands.items())
+        }
+
+
+    def export(self, filename):
+        """ Write the job summary to a file, as CSV if the file name ends in
+        .csv, else as JSON.
+
+        Raises IOError if the file cannot be written.
+
+        :param filename: Path of the file to write
+        :type: string
+        :return: void
+        """
+
+        summary = self.summary()
+        with open(filename, "w") as outfile:
+            if not filename.lower().endswith(".csv"):
+                json.dump(summary, outfile, indent=2, sort_keys=True)
+                return
+
+            writer = csv.writer(outfile)
+            writer.writerow(["group", "name", "count", "time"])
+            writer.writerow(["job", summary["job"], "", summary["wall"]])
+            for group in ("stages", "commands"):
+                for name in sorted(summary[group]):
+                    entry = summary[group][name]
+                    writer.writerow([group, name, entry["count"],
+                                     entry["time"]])
+
+
+    def __str__(self):
+        summary = self.summary()
+        lines = ["Job: {} {:.3f}s".format(summary["job"], summary["wall"])]
+        for group in ("stages", "commands"):
+            for name in sorted(summary[group]):
+                entry = summary[group][name]
+                lines.append("{}: {} {:.3f}s".format(name, entry["count"],
+                                                     entry["time"]))
+        return "\n".join(lines)
+
+
+    def export_after_error(self, filename):
+        """ Write the job summary like export, for a job that failed. An error
+        writing it is printed instead of raised, so it never replaces the
+        job's own exception.
+
+        :param filename: Path of the file to write
+        :type: string
+        :return: void
+        """
+
+        try:
+            self.export(filename)
+        except Exception as e:
+            print("Could not write profile " + filename + ": " + str(e))
@@ -0,0 +1,163 @@
+"""
+batchRunner.py
+For running a queue of G-code jobs back to back.
+
+While one job is cutting, the next one is read, parsed, bounds checked and has
+its laser mask loaded in a background process, so the machine doesn't sit idle
+between jobs.
+"""
+
+from multiprocessing import Pool
+import time
+
+import hardwareDriver as hd
+from GcodeInterface import GcodeInterface
+
+
+def run_batch(gman, jobs):
+    """ Run a list of G-code jobs in order, preparing each job in a background
+    worker process while the job before it runs.
+
+    Each job is a G-code file name, or a (G-code file name, mask image file
+    name, mask dots per mm) tuple for raster jobs. Jobs without a mask keep
+    gman's current las_mask, same as parse_gcode.
+
+    A job that can't be prepared raises the same exceptions parse_gcode would
+    before anything moves, when it's that job's turn; the jobs before it have
+    already run. Commands raise the same exceptions as parse_gcode.
+
+    gman.profile is reset for each job. The worker's parse, bounds and mask
+    times are added as stages, and the time spent waiting for the worker at
+    the start of the job as the "handoff" stage.
+
+    :param gman: Gcode interface to laser cutter hardware
+    :type: GcodeInterface
+    :param jobs: Jobs to run
+    :type: list[string or (string, string, double)]
+    :return: Time in seconds each job waited for its preparation to finish
+    :rtype: list[double]
+    """
+
+    bed_limits = (gman.bed_xmax, gman.bed_ymax)
+    waits = []
+    pool = Pool(1, initializer=_init_worker)
+    try:
+        if jobs:
+            pending = pool.apply_async(_prepare_job, (jobs[0], bed_limits))
+        for i in range(len(jobs)):
+            start = time.time()
+            job = pending.get()
+            waits.append(time.time() - start)
+            if i + 1 < len(jobs):  # Next job gets ready while this one runs
+                pending = pool.apply_async(_prepare_job,
+                                           (jobs[i + 1], bed_limits))
+
+            _run_prepared(gman, job, waits[-1])
+    finally:
+        pool.terminate()
+
+    return waits
+
+
+def run_job(gman, job):
+    """ Prepare and run a single job in this process, same as one job of
+    run_batch without the background preparation.
+
+    :param gman: Gcode interface to laser cutter hardware
+    :type: GcodeInterface
+    :param job: G-code file name, or (G-code file name, mask image file name,
+    mask dots per mm)
+    :type: string or (string, string, double)
+    :return: void
+    """
+
+    _run_prepared(gman, _prepare_job(job, (gman.bed_xmax, gman.bed_ymax)), 0)
+
+
+def _init_worker():
+    """ Drop the real-time scheduling and CPU pinning a worker inherits from
+    the motion process, so preparing jobs never competes with stepping."""
+
+    hd.set_realtime(0)
+
+
+def _run_prepared(gman, job, wait):
+    """ Run a job from _prepare_job, timing it in gman.profile.
+
+    :param gman: Gcode interface to laser cutter hardware
+    :type: GcodeInterface
+    :param job: Prepared job, from _prepare_job
+    :type: dict
+    :param wait: Time in seconds the job waited for its preparation
+    :type: double
+    :return: void
+    """
+
+    gman.profile.reset(job["name"])
+    for stage, seconds in job["times"].items():
+        gman.profile.add(stage, seconds)
+    gman.profile.add("handoff", wait)
+
+    # Bounds were checked from the homed origin; recheck from here if
+    # the job moves before homing
+    if not job["homes_first"]:
+        start = time.time()
+        gman.check_bounds(job["program"])
+        gman.profile.add("bounds", time.time() - start)
+
+    if job["mask"] is not None:
+        gman.set_las_mask(job["mask"], job["scaling"])
+    gman.run_program(job["program"])
+
+
+def _prepare_job(job, bed_limits):
+    """ Read, parse and bounds check a job, and load its mask. Runs in the
+    worker process.
+
+    Raises the same exceptions as parse_gcode does before anything moves.
+
+    :param job: G-code file name, or (G-code file name, mask image file name,
+    mask dots per mm)
+    :type: string or (string, string, double)
+    :param bed_limits: Bed Xmax and Ymax in mm
+    :type: (double, double)
+    :return: Job name, program, whether it homes before moving, mask array and
+    scaling (None if no mask), and the time each step took
+    :rtype: dict
+    """
+
+    if isinstance(job, basestring):
+        job = (job, None, None)
+    gcode, mask_file, scaling = job
+    gi = GcodeInterface(dry_run=True)
+    gi.set_bed_limits(*bed_limits)
+    times = {}
+
+    start = time.time()
+    program = gi._read_gcode(gcode)
+    times["parse"] = time.time() - start
+
+    # Positions are only known ahead of time once the job homes
+    homes_first = False
+    for cmd, params in program:
+        if cmd in ("G0", "G1", "G2", "G3", "G92"):
+            break
+        if cmd == "G28":
+            homes_first = True
+            break
+
+    if homes_first:
+        start = time.time()
+        gi.check_bounds(program)
+        times["bounds"] = time.time() - start
+
+    mask = None
+    if mask_file is not None:
+        from PIL import Image
+        start = time.time()
+        gi.set_las_mask(Image.open(mask_file).convert("L"), scaling)
+        mask = gi.las_mask
+        times["mask"] = time.time() - start
+
+    return {"name": gcode, "program": program, "homes_first": homes_first,
+            "mask": mask, "scaling": scaling, "times": times}
@@ -0,0 +1,316 @@
+"""
+cutter.py
+Command line entry point for the laser cutter, for running jobs without an
+interactive dbgImport.py session.
+
+Only imports what each command needs: running a G-code file or homing doesn't
+wait on PIL, ipsRaster or the camera.
+
+Usage:
+    sudo python cutter.py run job.gcode [--mask job.png] [--profile out.json]
+    sudo python cutter.py run job.gcode --motion 3
+    python cutter.py run job.gcode --estimate
+    sudo python cutter.py batch job1.gcode job2.gcode:job2.png [--scaling 10]
+    sudo python cutter.py batch job1.gcode job2.gcode --warm-start [--touch-off]
+    python cutter.py plan job.gcode job.plan [--mask job.png]
+    sudo python cutter.py replay job.plan [--motion 3] [--warm-start]
+    sudo python cutter.py home
+    python cutter.py status [--watch 0.5]
+    python cutter.py raster image.png job.gcode [--pad X Y] [--run]
+    python cutter.py raster image.png job.gcode.zst
+"""
+
+import argparse
+
+
+def main(argv=None):
+    """ Parse the command line and run the command.
+
+    :param argv: Command line arguments, sys.argv[1:] if not given
+    :type: list[string]
+    :return: Exit status
+    :rtype: int
+    """
+
+    parser = argparse.ArgumentParser(description="Sketch 'n' Etch laser "
+                                                 "cutter")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="Run a G-code file")
+    run.add_argument("gcode", help="G-code file, gzip or zstd compressed "
+                                   "if it ends in .gz or .zst")
+    run.add_argument("--mask", help="Laser mask image the G-code was "
+                                    "generated from (raster jobs)")
+    run.add_argument("--scaling", type=float, default=10,
+                     help="Mask dots per mm (default 10)")
+    run.add_argument("--estimate", action="store_true",
+                     help="Only estimate the job time, don't touch GPIO")
+    run.add_argument("--profile", help="Write the job profile here, CSV if "
+                                       "it ends in .csv, else JSON")
+    run.add_argument("--realtime", type=int, nargs="?", const=-1,
+                     metavar="CPU", help="Real-time step timing, optionally "
+                                         "pinned to CPU")
+    run.add_argument("--motion", type=int, nargs="?", const=-1,
+                     metavar="CPU", help="Step in a separate real-time "
+                                         "motion process, optionally pinned "
+                                         "to CPU")
+    run.add_argument("--telemetry", nargs="?", const="", metavar="PATH",
+                     help="Publish live machine state for 'status', "
+                          "optionally to PATH")
+    _add_warm_start_args(run)
+    run.set_defaults(func=_run)
+
+    batch = commands.add_parser("batch", help="Run G-code files back to back, "
+                                              "preparing each during the last")
+    batch.add_argument("jobs", nargs="+", metavar="gcode[:mask]",
+                       help="G-code file, with its laser mask image for "
+                            "raster jobs")
+    batch.add_argument("--scaling", type=float, default=10,
+                       help="Mask dots per mm (default 10)")
+    batch.add_argument("--motion", type=int, nargs="?", const=-1,
+                       metavar="CPU", help="Step in a separate real-time "
+                                           "motion process, optionally "
+                                           "pinned to CPU")
+    batch.add_argument("--telemetry", nargs="?", const="", metavar="PATH",
+                       help="Publish live machine state for 'status', "
+                            "optionally to PATH")
+    _add_warm_start_args(batch)
+    batch.set_defaults(func=_batch)
+
+    plan = commands.add_parser("plan", help="Plan a G-code file into a plan "
+                                            "file for 'replay', without GPIO")
+    plan.add_argument("gcode", help="G-code file, gzip or zstd compressed "
+                                    "if it ends in .gz or .zst")
+    plan.add_argument("plan", help="Plan file to write")
+    plan.add_argument("--mask", help="Laser mask image the G-code was "
+                                     "generated from (raster jobs)")
+    plan.add_argument("--scaling", type=float, default=10,
+                      help="Mask dots per mm (default 10)")
+    plan.set_defaults(func=_plan)
+
+    replay = commands.add_parser("replay", help="Run a plan file")
+    replay.add_argument("plan", help="Plan file from 'plan'")
+    replay.add_argument("--profile", help="Write the job profile here, CSV "
+                                          "if it ends in .csv, else JSON")
+    replay.add_argument("--motion", type=int, nargs="?", const=-1,
+                        metavar="CPU", help="Step in a separate real-time "
+                                            "motion process, optionally "
+                                            "pinned to CPU")
+    _add_warm_start_args(replay)
+    replay.set_defaults(func=_replay)
+
+    home = commands.add_parser("home", help="Home the laser head")
+    home.set_defaults(func=_home)
+
+    status = commands.add_parser("status", help="Show the live machine state "
+                                                "published by a running job")
+    status.add_argument("--path", help="Telemetry record (default "
+                                       "/dev/shm/sketchnetch_state)")
+    status.add_argument("--watch", type=float, metavar="SECONDS",
+                        help="Keep showing it every SECONDS")
+    status.set_defaults(func=_status)
+
+    raster = commands.add_parser("raster", help="Dither an image and write "
+                                                "G-code to engrave it")
+    raster.add_argument("image", help="Image to engrave")
+    raster.add_argument("gcode", help="G-code file to write, compressed "
+                                      "with gzip or zstd if it ends in .gz "
+                                      "or .zst")
+    raster.add_argument("--scaling", type=float, default=10,
+                        help="Dots per mm (default 10)")
+    raster.add_argument("--pad", type=float, nargs=2, default=(0, 0),
+                        metavar=("X", "Y"), help="Top left of the image on "
+                                                 "the bed in mm")
+    raster.add_argument("--blackwhite", action="store_true",
+                        help="Image is already black and white")
+    raster.add_argument("--dither", default="pil",
+                        choices=("pil", "floyd", "atkinson", "stucki",
+                                 "bayer"),
+                        help="Dithering engine (default pil)")
+    raster.add_argument("--travel-feed", type=float, default=100 * 60,
+                        help="Travel speed in mm/min")
+    raster.add_argument("--cut-feed", type=float, default=5 * 60,
+                        help="Cutting speed in mm/min")
+    raster.add_argument("--bed", type=float, nargs=2, default=(250, 280),
+                        metavar=("XMAX", "YMAX"), help="Bed size in mm")
+    raster.add_argument("--run", action="store_true",
+                        help="Run the G-code after writing it")
+    raster.set_defaults(func=_raster)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+def _add_warm_start_args(parser):
+    """ Add the warm start options to a job command's parser."""
+
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Skip homing while the head is still homed from "
+                             "the last G28, with the motors on since")
+    parser.add_argument("--touch-off", action="store_true",
+                        help="Warm start, checking the position on the XMIN "
+                             "switch first")
+
+
+def _run(args):
+    """ run: Run or estimate a G-code file."""
+
+    import GcodeInterface as GI
+    gman = GI.GcodeInterface(dry_run=args.estimate)
+    gman.set_warm_start(args.warm_start or args.touch_off, args.touch_off)
+    if args.mask is not None:
+        from PIL import Image
+        gman.set_las_mask(Image.open(args.mask).convert("L"), args.scaling)
+
+    if args.estimate:
+        times = gman.estimate_gcode(args.gcode)
+        print("Estimated time: {total:.1f}s (cut {cut:.1f}s, travel "
+              "{travel:.1f}s, home {home:.1f}s)".format(**times))
+        return 0
+
+    if args.realtime is not None:
+        gman.set_realtime(1, args.realtime)
+    if args.telemetry is not None:
+        gman.start_telemetry(args.telemetry or None)
+    if args.motion is not None:
+        gman.start_motion(args.motion)
+    try:
+        gman.parse_gcode(args.gcode, profile_file=args.profile)
+    except Exception:
+        gman.M1()  # STOP
+        raise
+    return 0
+
+
+def _batch(args):
+    """ batch: Run G-code files back to back."""
+
+    import GcodeInterface as GI
+    import batchRunner
+    jobs = []
+    for job in args.jobs:
+        gcode, _, mask = job.partition(":")
+        jobs.append((gcode, mask, args.scaling) if mask else gcode)
+
+    gman = GI.GcodeInterface()
+    if args.telemetry is not None:
+        gman.start_telemetry(args.telemetry or None)
+    if args.motion is not None:
+        gman.start_motion(args.motion)
+    gman.set_warm_start(args.warm_start or args.touch_off, args.touch_off)
+    try:
+        batchRunner.run_batch(gman, jobs)
+    except Exception:
+        gman.M1()  # STOP
+        raise
+    return 0
+
+
+def _plan(args):
+    """ plan: Plan a G-code file into a plan file."""
+
+    import GcodeInterface as GI
+    gman = GI.GcodeInterface(dry_run=True)
+    if args.mask is not None:
+        from PIL import Image
+        gman.set_las_mask(Image.open(args.mask).convert("L"), args.scaling)
+    n_moves = gman.plan_gcode(args.gcode, args.plan)
+    print("Planned {} moves into {}".format(n_moves, args.plan))
+    return 0
+
+
+def _replay(args):
+    """ replay: Run a plan file."""
+
+    import GcodeInterface as GI
+    gman = GI.GcodeInterface()
+    gman.set_warm_start(args.warm_start or args.touch_off, args.touch_off)
+    if args.motion is not None:
+        gman.start_motion(args.motion)
+    gman.profile.reset(args.plan)
+    try:
+        status = gman.replay_plan(args.plan)
+        if status != 0:
+            raise RuntimeError("Plan replay stopped (Error: " + bin(status)
+                               + ")")
+    except Exception:
+        gman.M1()  # STOP
+        if args.profile is not None:
+            gman.profile.export_after_error(args.profile)
+        raise
+    if args.profile is not None:
+        gman.profile.export(args.profile)
+    return 0
+
+
+def _home(args):
+    """ home: Home the laser head."""
+
+    import GcodeInterface as GI
+    gman = GI.GcodeInterface()
+    gman.M17()
+    gman.G28()
+    return 0
+
+
+def _status(args):
+    """ status: Show the machine state published by a running job."""
+
+    import time
+    import telemetry
+    record = telemetry.TelemetryRecord(args.path or telemetry.TELEMETRY_PATH)
+    while True:
+        state = record.read()
+        if state is None:
+            print("No machine state published yet")
+        else:
+            fields = dict(state,
+                          running="running" if state["running"] else "idle",
+                          laser=("firing" if state["firing"] else "on")
+                          if state["laser"] else "off",
+                          homed="homed" if state["homed"] else "not homed",
+                          motors="on" if state["motors"] else "off",
+                          switches=bin(state["switches"]),
+                          age=time.time() - state["stamp"])
+            print("X:{x:.2f} Y:{y:.2f} command {cmd}/{n_cmds} ({progress:.1%})"
+                  " {running}, stepping command {head_cmd}, laser {laser}, "
+                  "{homed}, motors {motors}, "
+                  "switches {switches}, {age:.1f}s ago (pid {pid})"
+                  .format(**fields))
+        if args.watch is None:
+            return 0
+        time.sleep(args.watch)
+
+
+def _raster(args):
+    """ raster: Dither an image, write its G-code, and optionally run it."""
+
+    import ipsRaster as ipsR
+    pic = ipsR.raster_dither(args.image, args.scaling, pad=tuple(args.pad),
+                             blackwhite=args.blackwhite, dither=args.dither)
+    settings = {
+        "scaling": args.scaling,
+        "travel_feed": args.travel_feed,
+        "cut_feed": args.cut_feed,
+        "bed_xmax": args.bed[0],
+        "bed_ymax": args.bed[1]
+    }
+    ipsR.gen_gcode(args.gcode, pic, settings)
+    if not args.run:
+        return 0
+
+    import GcodeInterface as GI
+    gman = GI.GcodeInterface()
+    gman.set_bed_limits(*args.bed)
+    gman.set_las_mask(pic, args.scaling)
+    try:
+        gman.parse_gcode(args.gcode)
+    except Exception:
+        gman.M1()  # STOP
+        raise
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
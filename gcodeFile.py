@@ -0,0 +1,122 @@
+"""
+gcodeFile.py
+For opening G-code files, plain or compressed, by file name: ".gz" files are
+gzip compressed, ".zst" files zstd compressed. Big raster jobs are mostly
+I/O on the Pi's SD card, and their G-code compresses to a small fraction.
+
+Files are written through a large buffer, and read back as a stream of
+lines, decompressing as they are read.
+"""
+
+import gzip
+import io
+
+# Bytes buffered before each write to the file or compressor
+WRITE_BUFFER = 2**20
+READ_BUFFER = 2**18
+
+# Default compression levels, gzip's and zstd's own defaults
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compression(filename):
+    """ Compression of a G-code file, from its name.
+
+    :param filename: G-code file name
+    :type: string
+    :return: "gzip", "zstd", or None for plain text
+    :rtype: string
+    """
+
+    if filename.endswith(".gz"):
+        return "gzip"
+    if filename.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def open_gcode(filename, mode="r", level=None):
+    """ Open a G-code file for reading or writing, compressed according to
+    its name, see compression().
+
+    Raises IOError if the file can't be opened, and ImportError for a zstd
+    file if the zstandard package isn't installed.
+
+    :param filename: G-code file name
+    :type: string
+    :param mode: "r" to read, "w" to write
+    :type: string
+    :param level: Compression level, GZIP_LEVEL or ZSTD_LEVEL if not given
+    :type: int
+    :return: File to read lines from, or write text to; close it when done
+    :rtype: file
+    """
+
+    if mode not in ("r", "w"):
+        raise ValueError("G-code file mode must be 'r' or 'w': " + str(mode))
+    kind = compression(filename)
+
+    if kind is None:
+        if mode == "r":
+            return open(filename, "r", READ_BUFFER)
+        return open(filename, "w", WRITE_BUFFER)
+
+    if kind == "gzip":
+        raw = gzip.GzipFile(filename, mode + "b",
+                            GZIP_LEVEL if level is None else level)
+    else:
+        try:
+            import zstandard  # Only needed for .zst files
+        except ImportError:
+            raise ImportError("zstd compressed G-code needs the zstandard "
+                              "package: " + filename)
+        fh = open(filename, mode + "b")
+        if mode == "r":
+            raw = zstandard.ZstdDecompressor().stream_reader(fh)
+        else:
+            raw = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL if level is None else level).stream_writer(fh)
+        raw = _ZstdFile(raw, fh, mode)
+
+    if mode == "r":
+        return io.BufferedReader(raw, READ_BUFFER)
+    return io.BufferedWriter(raw, WRITE_BUFFER)
+
+
+class _ZstdFile(io.RawIOBase):
+    """ A zstandard stream reader or writer as a raw file, so it can be
+    buffered. Closing it ends the compressed frame when writing, and closes
+    the file under it."""
+
+    def __init__(self, stream, fh, mode):
+        self.stream = stream
+        self.fh = fh
+        self.mode = mode
+
+
+    def readable(self):
+        return self.mode == "r"
+
+
+    def writable(self):
+        return self.mode == "w"
+
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def write(self, b):
+        self.stream.write(b.tobytes() if isinstance(b, memoryview) else b)
+        return len(b)  # stream.write returns compressed bytes written
+
+
+    def close(self):
+        if self.closed:
+            return
+        io.RawIOBase.close(self)
+        self.stream.close()
+        self.fh.close()
@@ -1,5 +1,58 @@
+cdef extern from "sys/time.h":
+    struct timeval:
+        int tv_sec
+        int tv_usec
+
+# GCC atomics, for flags and counters shared with other processes
+cdef extern from *:
+    int ATOMIC_RELAXED "__ATOMIC_RELAXED"
+    int ATOMIC_ACQUIRE "__ATOMIC_ACQUIRE"
+    int ATOMIC_RELEASE "__ATOMIC_RELEASE"
+    long long atomic_load "__atomic_load_n"(long long *ptr, int order) nogil
+    void atomic_store "__atomic_store_n"(long long *ptr, long long val,
+                                         int order) nogil
+    void atomic_fence "__atomic_thread_fence"(int order) nogil
+
 cdef int USEC_PER_SEC
 
+# Return value of a move stopped by its StepClock abort flag
+cdef enum:
+    MOVE_ABORTED = -2
+
+# Arc step codes from arc_next
+cdef enum:
+    A_STEP = 1
+    A_FWD = 2
+    B_STEP = 4
+    B_FWD = 8
+
+# Live head state words, a seqlock written by the step loops, see
+# set_head_state() and telemetry.pyx
+cdef enum:
+    HEAD_SEQ = 0  # Odd while being written
+    HEAD_A = 1  # Position in steps
+    HEAD_B = 2
+    HEAD_CMD = 3  # Job command the move being stepped came from
+    HEAD_LASER = 4  # Laser firing
+    HEAD_SWITCHES = 5  # Switch values read on the last step
+    HEAD_WORDS = 6
+
+cdef struct ArcStepper:
+    # Midpoint circle stepper in A/B step space, see arc_next()
+    long long p, q  # Position relative to the arc center, steps
+    long long r2  # Radius squared, steps^2
+    long long end_p, end_q  # End position relative to the arc center
+    int turn  # +1 counterclockwise in A/B space, -1 clockwise
+    double swept, sweep  # Angle travelled so far, and in total (rad)
+    double min_angle  # Leave the arc when less than this is left to sweep
+    bint on_arc  # Still on the arc, else stepping straight to the end
+
+cdef struct StepClock:
+    # Step timing carried from step to step, and from move to move
+    timeval now  # End of the last step, busy wait mode
+    long long deadline  # Deadline of the last step, real-time mode (ns)
+    long long *abort  # Stop stepping when nonzero, NULL to never stop
+
 cdef int EN, STEP, DIR
 cdef int[:] list_of_mot_pins
 cdef int XMIN, XMAX, YMIN, YMAX, SAFE_FEET
@@ -11,6 +64,20 @@ cpdef void motor_enable()
 cpdef void motor_disable()
 cpdef void las_pulse(double time)
 cpdef int read_switches()
+cpdef void switch_events(bint enable)
 cpdef void delay_micros(long us)
 cpdef void delay_millis(long ms)
-cdef int move_laser(step_list, las_list, time_list)
+cpdef int set_realtime(bint enable, int cpu=*)
+cdef int move_laser(int a_delta, int b_delta, runs)
+cdef int move_arc(ArcStepper arc, runs)
+cdef void set_head_state(long long *head)
+cdef void head_command(long cmd)
+cdef void clock_start(StepClock *clock, long long *abort)
+cdef int step_line(int a_delta, int b_delta, int *runs, long n_runs,
+                   StepClock *clock)
+cdef int step_arc(ArcStepper *arc, int *runs, long n_runs, StepClock *clock)
+cdef ArcStepper arc_init(long long p, long long q, long long end_p,
+                         long long end_q, int turn)
+cdef int arc_next(ArcStepper *arc)
+cdef int home_axes(int x_dir, int y_dir, long max_steps, int period,
+                   bint stop_on, long *steps=*)
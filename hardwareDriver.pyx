@@ -6,15 +6,46 @@ GPIO functions. Uses the BCM2835 C library for GPIO access.
 __author__ = 'Kakit'
 
 import math
+import resource
 from cpython cimport array
+from libc.math cimport atan2, sqrt, M_PI
+from libc.stdlib cimport llabs
 
 # Define external functions
 cdef extern from "sys/time.h":
-    struct timeval:
-        int tv_sec
-        int tv_usec
     int gettimeofday(timeval *timer, void *)
 
+cdef extern from "time.h":
+    struct timespec:
+        long tv_sec
+        long tv_nsec
+    int CLOCK_MONOTONIC
+    int TIMER_ABSTIME
+    int clock_gettime(int clk_id, timespec *tp)
+    int clock_nanosleep(int clk_id, int flags, timespec *request,
+                        timespec *remain)
+
+# Real-time scheduling functions
+cdef extern from "sched.h":
+    struct sched_param:
+        int sched_priority
+    ctypedef struct cpu_set_t:
+        pass
+    int SCHED_FIFO
+    int SCHED_OTHER
+    int sched_setscheduler(int pid, int policy, sched_param *param)
+    int sched_get_priority_max(int policy)
+    int sched_getaffinity(int pid, size_t cpusetsize, cpu_set_t *mask)
+    int sched_setaffinity(int pid, size_t cpusetsize, cpu_set_t *mask)
+    void CPU_ZERO(cpu_set_t *cpuset)
+    void CPU_SET(int cpu, cpu_set_t *cpuset)
+
+cdef extern from "sys/mman.h":
+    int MCL_CURRENT
+    int MCL_FUTURE
+    int mlockall(int flags)
+    int munlockall()
+
 # Import bcm2835 c lib functions and vars
 cdef extern from "bcm2835.h":
     ctypedef int uint8_t
@@ -25,6 +56,13 @@ cdef extern from "bcm2835.h":
     int bcm2835_close()
     void bcm2835_set_debug(uint8_t debug) # Debug only, don't write GPIO, print
 
+    # Raw register access, for reading/writing all pins at once
+    uint32_t *bcm2835_gpio  # GPIO registers base, after bcm2835_init
+    uint32_t bcm2835_peri_read(uint32_t *paddr)
+    void bcm2835_peri_write(uint32_t *paddr, uint32_t value)
+    int _GPLEV0 "BCM2835_GPLEV0"  # Pin level register offset
+    int _GPEDS0 "BCM2835_GPEDS0"  # Pin event detect status register offset
+
     # GPIO functions
     void bcm2835_gpio_fsel(uint8_t pin, uint8_t mode) # Set pin I or O
     void bcm2835_gpio_write(uint8_t pin, uint8_t on) # Write on val to pin
@@ -85,6 +123,17 @@ cdef extern from "bcm2835.h":
 
 # Define vars
 cdef int USEC_PER_SEC = 1000000
+cdef long long NSEC_PER_USEC = 1000
+cdef long long NSEC_PER_SEC = 1000000000
+
+# Real-time mode, see set_realtime()
+cdef bint realtime = False
+cdef long long SPIN_NSEC = 100 * NSEC_PER_USEC  # Busy wait the last 100us
+cdef cpu_set_t saved_cpus
+cdef bint affinity_saved = False  # Pinned, saved_cpus to restore on disable
+
+# Head state words the step loops publish to, see set_head_state()
+cdef long long *head_state = NULL
 
 
 ############# PIN DEFINITIONS #############
@@ -111,6 +160,10 @@ MOT_B[DIR]      = _RPI_V2_GPIO_P1_12
 # Laser output
 LAS             = _RPI_V2_GPIO_P1_26  # ACTIVE HIGH
 
+# Output pin masks for bcm2835_gpio_set_multi/clr_multi
+cdef unsigned int step_pin_mask = (1 << MOT_A[STEP]) | (1 << MOT_B[STEP])
+cdef unsigned int las_pin_mask = 1 << LAS
+
 # All input switches
 cdef int XMIN       = 0
 cdef int XMAX       = 1
@@ -129,6 +182,15 @@ SWS[YMAX]   = _RPI_V2_GPIO_P1_19  # woops wires
 SWS[SAFE_FEET] = _RPI_V2_GPIO_P1_23  # woops active hi by accident
 # GND       = GPIO_25
 
+# GPLEV0/GPEDS0 bits of all switch pins, for reading them in one access
+cdef int switch_pin_mask = 0
+for pin in list_of_sw_pins:
+    assert SWS[pin] < 32
+    switch_pin_mask |= 1 << SWS[pin]
+
+# Poll switch presses latched in the edge detect registers, see switch_events()
+cdef bint use_events = False
+
 ############### External Interface Functions ##########################
 
 cpdef int gpio_init():
@@ -225,10 +287,18 @@ cpdef void las_pulse(double time):
 
     bcm2835_gpio_set(LAS)
     cdef timeval start, end
+    cdef long long deadline = mono_nsec()
+    cdef long long end_ns = deadline + <long long>(time * NSEC_PER_SEC)
     gettimeofday(&start, NULL)
     gettimeofday(&end, NULL)
     while time_diff(start, end) < time * USEC_PER_SEC:
-        gettimeofday(&end, NULL)
+        if realtime:  # Poll the safety feet every SPIN_NSEC
+            if deadline >= end_ns:
+                break
+            deadline = min(deadline + SPIN_NSEC, end_ns)
+            sleep_until(deadline)
+        else:
+            gettimeofday(&end, NULL)
         if read_switches_fast() & (0x1 << SAFE_FEET):
             break
     bcm2835_gpio_clr(LAS)
@@ -243,12 +313,34 @@ cpdef int read_switches():
             (i.e. 0b01001 => 9: YMAX, XMIN)
     :rtype: int
     """
-    cdef int retval = 0
 
-    for pin in list_of_sw_pins:
-        retval |= (0 if bcm2835_gpio_lev(SWS[pin]) else 1 )<< pin
+    return read_switches_fast()
 
-    return retval
+
+cpdef void switch_events(bint enable):
+    """ Enable or disable polling switches through the GPIO edge detect event
+    registers in move_laser.
+
+    Switch presses (falling edges, active low) latch in GPEDS0, so presses
+    shorter than a step are still caught. Presses from before a motion starts,
+    like homing's own, are cleared by clock_start(), and the first step of
+    each move reads the switch levels instead, for switches already pressed
+    at the start.
+
+    :param enable: 1 to enable, 0 to go back to reading switch levels
+    :type: bint
+    :return: void
+    """
+    global use_events
+
+    for pin in list_of_sw_pins:
+        if enable:
+            bcm2835_gpio_fen(SWS[pin])
+        else:
+            bcm2835_gpio_clr_fen(SWS[pin])
+    # Write 1s to clear any old events
+    bcm2835_peri_write(bcm2835_gpio + _GPEDS0 // 4, switch_pin_mask)
+    use_events = enable
 
 
 cpdef void delay_micros(long us):
@@ -259,6 +351,10 @@ cpdef void delay_micros(long us):
     """
 
     # bcm2835_delayMicroseconds(us)  # don't trust this too much
+    if realtime:
+        sleep_until(mono_nsec() + us * NSEC_PER_USEC)
+        return
+
     cdef timeval start, end
     gettimeofday(&start, NULL)
     gettimeofday(&end, NULL)
@@ -274,111 +370,659 @@ cpdef void delay_millis(long ms):
 
     bcm2835_delay(ms)  # whatever timing in ms range
 
+
+cpdef int set_realtime(bint enable, int cpu=-1):
+    """ Enable or disable real-time mode for the step timing loops.
+
+    Real-time mode runs this process under SCHED_FIFO at max priority, locks
+    its memory into RAM, and pins it to one CPU. The timing loops then wait on
+    absolute CLOCK_MONOTONIC deadlines, sleeping until SPIN_NSEC before each
+    deadline and busy waiting the rest, instead of busy waiting the whole
+    time on gettimeofday. Needs root.
+
+    :param enable: 1 to enable, 0 to go back to busy waiting
+    :type: bint
+    :param cpu: CPU to pin the process to, -1 to not change affinity. Ignored
+    on disable, which always restores the affinity from before pinning.
+    :type: int
+    :return: 0 if success, else 1
+    """
+    global realtime, affinity_saved
+
+    cdef sched_param param
+    cdef cpu_set_t cpus
+    if enable:
+        param.sched_priority = sched_get_priority_max(SCHED_FIFO)
+        if sched_setscheduler(0, SCHED_FIFO, &param) != 0:
+            return 1
+        if mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            set_realtime(False)
+            return 1
+        if cpu >= 0:
+            if not affinity_saved:
+                sched_getaffinity(0, sizeof(cpu_set_t), &saved_cpus)
+                affinity_saved = True
+            CPU_ZERO(&cpus)
+            CPU_SET(cpu, &cpus)
+            if sched_setaffinity(0, sizeof(cpu_set_t), &cpus) != 0:
+                set_realtime(False)
+                return 1
+        realtime = True
+    else:
+        if affinity_saved:
+            sched_setaffinity(0, sizeof(cpu_set_t), &saved_cpus)
+            affinity_saved = False
+        param.sched_priority = 0
+        sched_setscheduler(0, SCHED_OTHER, &param)
+        munlockall()
+        realtime = False
+    return 0
+
+
+cpdef timing_test(int period, long n):
+    """ Measure the timing jitter and CPU use of the step wait in the current
+    mode (see set_realtime), without touching GPIO.
+
+    :param period: Step time (us) to wait each iteration
+    :type: int
+    :param n: Number of iterations
+    :type: long
+    :return: Mean, max and standard deviation of the step interval error in
+    us, and the CPU usage as a fraction of wall time
+    :rtype: dict
+    """
+
+    cdef timeval then, now
+    cdef int delta = 0
+    cdef long long deadline = mono_nsec()
+    cdef long long last = deadline
+    cdef long long start = deadline
+    cdef long long stamp
+    errs = array.array('d', [0.0] * n)
+    cdef double[:] err_arr = errs
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_start = usage.ru_utime + usage.ru_stime
+    gettimeofday(&now, NULL)
+    cdef long i = 0
+    while i < n:
+        then.tv_sec, then.tv_usec = now.tv_sec, now.tv_usec
+        delta = 0
+        if realtime:
+            deadline = next_deadline(deadline, period)
+            sleep_until(deadline)
+        while delta < period and not realtime:
+            gettimeofday(&now, NULL)
+            delta = time_diff(then, now)
+
+        stamp = mono_nsec()
+        err_arr[i] = (stamp - last) / <double>NSEC_PER_USEC - period
+        last = stamp
+        i += 1
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = usage.ru_utime + usage.ru_stime - cpu_start
+    wall_time = (mono_nsec() - start) / <double>NSEC_PER_SEC
+
+    cdef double mean_err = 0, max_err = 0, var_err = 0
+    for i in range(n):
+        mean_err += err_arr[i] / n
+        max_err = max(max_err, abs(err_arr[i]))
+    for i in range(n):
+        var_err += (err_arr[i] - mean_err)**2 / n
+
+    return {"mean_err": mean_err,
+            "max_err": max_err,
+            "std_dev": math.sqrt(var_err),
+            "cpu_usage": cpu_time / wall_time}
+
+
+cpdef bench_step_loop(long n):
+    """ Microbenchmark the per-step overhead of the move_laser loop, with
+    zero step times and a new run every step. Disables the motors first so
+    nothing moves, and keeps the laser off. Run it after gpio_init with no
+    switches pressed, on the cutter or on the simulated build from
+    tests/fakehw.py.
+
+    :param n: Number of steps
+    :type: long
+    :return: Time per step in ns for a switch read alone, and for a whole
+    move_laser step
+    :rtype: dict
+    """
+
+    motor_disable()
+    runs = array.array('i', [1, 0, 0]) * n  # Laser off
+    n = len(runs) // 3
+
+    cdef long i
+    cdef long long start = mono_nsec()
+    for i in range(n):
+        read_switches_fast()
+    cdef long long sw_time = mono_nsec() - start
+
+    start = mono_nsec()
+    move_laser(n, n // 2, runs)
+    cdef long long step_time = mono_nsec() - start
+
+    return {"read_switches": sw_time / <double>n,
+            "move_laser": step_time / <double>n}
+
 # TODO Try out pigpio library DMA's for timing/motion
-cdef int move_laser(step_list, las_list, time_list):
+cdef int move_laser(int a_delta, int b_delta, runs):
     """ Perform the laser head step motion loop with precise timings.
 
-    :param step_list: List of [a,b] steps to take each increment. 0 or +/-1.
-    :type: list[n][2] <integer>
+    The line is stepped with Bresenham's algorithm inside the loop, and the
+    laser state and step period come from run-length encoded runs, so a
+    segment only takes memory per laser transition, not per step.
 
-    :param las_list: List of laser on/off value. 0 or 1.
-    :type: list[n] <integer>
+    Directions are set once before the first step. Steps and the laser are
+    set together on the rising edge of each step, so each edge is at most one
+    bcm2835_gpio_set_multi and one bcm2835_gpio_clr_multi write.
 
-    :param time_list: List of times (us) to spend at each position
-    :type: list[n] <integer>
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param runs: Flat (count, laser, period) runs: number of steps, laser
+    on/off (0 or 1), and time (us) to spend at each step. Counts add up to
+    max(|a_delta|, |b_delta|).
+    :type: array.array('i')
 
     :return: Returns associated switch values if endstops or safety feet
     are triggered, else returns 0. See read_switches() for details.
     :rtype: int
     """
 
-    # Convert to C arrays
-    cdef int list_len = len(las_list)
-    step_listA = zip(*step_list)[0]
-    step_listB = zip(*step_list)[1]
+    cdef int[:] run_arr = runs
+    cdef long n_runs = len(runs) // 3
+    cdef StepClock clock
 
-    cdef int[:] step_arrA = array.array('i', step_listA)
-    cdef int[:] step_arrB = array.array('i', step_listB)
-    cdef int[:] las_arr = array.array('i', las_list)
-    cdef int[:] time_arr = array.array('i', time_list)
+    if n_runs == 0:
+        return 0
+    clock_start(&clock, NULL)
+    return step_line(a_delta, b_delta, &run_arr[0], n_runs, &clock)
 
-    cdef timeval then, now
-    cdef int delta = 0
-    cdef int retval = 0
 
-    gettimeofday(&then, NULL)
-    gettimeofday(&now, NULL)
+cdef int move_arc(ArcStepper arc, runs):
+    """ Perform the laser head step motion loop for an arc, with precise
+    timings.
+
+    Steps come from the arc stepper one at a time inside the loop, see
+    arc_next(), and the laser state and step period from run-length encoded
+    runs, same as move_laser. The next step is found while the current step
+    pulse is high, and its directions set on the falling edge.
+
+    :param arc: Arc stepper at the start of the arc, see arc_init()
+    :type: ArcStepper
+    :param runs: Flat (count, laser, period) runs, same as move_laser. Counts
+    add up to the number of steps arc_next() gives.
+    :type: array.array('i')
+
+    :return: Returns associated switch values if endstops or safety feet
+    are triggered, else returns 0. See read_switches() for details.
+    :rtype: int
+    """
+
+    cdef int[:] run_arr = runs
+    cdef long n_runs = len(runs) // 3
+    cdef StepClock clock
+
+    if n_runs == 0:
+        return 0
+    clock_start(&clock, NULL)
+    return step_arc(&arc, &run_arr[0], n_runs, &clock)
+
+
+cdef void set_head_state(long long *head):
+    """ Publish the head position, laser and switches from every step of the
+    step loops in this process, and in processes forked after, to head state
+    words in shared memory. See HEAD_* and telemetry.pyx.
+
+    Positions are counted on from the last HEAD_A/HEAD_B written, so whoever
+    sets them must do it while nothing is stepping.
+
+    :param head: HEAD_WORDS words, NULL to stop publishing
+    :type: long long *
+    :return: void
+    """
+
+    global head_state
+    head_state = head
 
-    # # Diagnostics
-    # cdef int[:] deltaTimes = array.array('i', range(list_len))
-    # cdef int[:] opTimes = array.array('i', range(list_len))
 
-    cdef int i = 0
-    while i < list_len:
-        # # Diagnostic
-        # deltaTimes[i] = delta
+cdef void head_command(long cmd):
+    """ Publish the job command the next moves came from, see
+    set_head_state().
+
+    :param cmd: Command index in the job
+    :type: long
+    :return: void
+    """
+
+    if head_state == NULL:
+        return
+    cdef long long seq = head_state[HEAD_SEQ]
+    atomic_store(&head_state[HEAD_SEQ], seq + 1, ATOMIC_RELAXED)
+    atomic_fence(ATOMIC_RELEASE)  # Odd before any word changes
+    head_state[HEAD_CMD] = cmd
+    atomic_store(&head_state[HEAD_SEQ], seq + 2, ATOMIC_RELEASE)
+
+
+cdef void clock_start(StepClock *clock, long long *abort):
+    """ Start the step timing of a motion from now, see StepClock.
+
+    With switch events enabled, also clears the switch presses latched before
+    the motion, so they don't stop its first move.
+
+    :param clock: Step clock to start
+    :type: StepClock *
+    :param abort: Flag that stops stepping when set nonzero, NULL for none
+    :type: long long *
+    :return: void
+    """
+
+    if use_events:
+        # Write 1s to clear old events
+        bcm2835_peri_write(bcm2835_gpio + _GPEDS0 // 4, switch_pin_mask)
+    gettimeofday(&clock.now, NULL)
+    clock.deadline = mono_nsec()
+    clock.abort = abort
+
+
+cdef int step_line(int a_delta, int b_delta, int *runs, long n_runs,
+                   StepClock *clock):
+    """ Step loop of move_laser, timed from a step clock.
+
+    The first step is timed from the clock's last step, so moves stepped back
+    to back on the same clock run on without stopping between them.
+
+    :param a_delta: Number of steps to take on A axis
+    :type: int
+    :param b_delta: Number of steps to take on B axis
+    :type: int
+    :param runs: Flat (count, laser, period) runs, see move_laser
+    :type: int *
+    :param n_runs: Number of runs
+    :type: long
+    :param clock: Step clock, see clock_start()
+    :type: StepClock *
+
+    :return: Switch values if endstops or safety feet are triggered,
+    MOVE_ABORTED if the clock's abort flag was set, else 0
+    :rtype: int
+    """
+
+    cdef long n_major = max(abs(a_delta), abs(b_delta))
+    cdef long n_minor = min(abs(a_delta), abs(b_delta))
+
+    if n_major == 0:
+        return 0
+
+    # STEP bits of the motor stepping every step, and the one only stepping
+    # when the Bresenham error says so
+    cdef unsigned int a_mask = 1 << MOT_A[STEP]
+    cdef unsigned int b_mask = 1 << MOT_B[STEP]
+    cdef unsigned int major_mask = b_mask if abs(b_delta) > abs(a_delta) \
+        else a_mask
+    cdef unsigned int minor_mask = (a_mask | b_mask) & ~major_mask
+    cdef long error = n_minor - n_major
+    cdef int a_dir = 1 if a_delta > 0 else -1
+    cdef int b_dir = 1 if b_delta > 0 else -1
+
+    cdef timeval then
+    cdef int delta = 0
+    cdef int retval = 0
+    cdef unsigned int mask, las_mask = 0
+    cdef long r = 0, count = 0
+    cdef int period = 0
+    cdef long i = 0
+
+    # Laser off, directions of the motors that move. Motors that don't move
+    # keep their last direction.
+    bcm2835_gpio_clr_multi(las_pin_mask)
+    if a_delta != 0:
+        bcm2835_gpio_write(MOT_A[DIR], a_delta > 0)
+    if b_delta != 0:
+        bcm2835_gpio_write(MOT_B[DIR], b_delta > 0)
+
+    while True:
+        # Next run: laser and period for the next count steps
+        if count == 0:
+            if r == n_runs:
+                break
+            count = runs[3*r]
+            if runs[3*r + 1]:
+                las_mask = las_pin_mask
+            elif las_mask:
+                las_mask = 0
+                bcm2835_gpio_clr_multi(las_pin_mask)
+            period = runs[3*r + 2]
+            r += 1
+            continue
 
         # Reset times
-        then.tv_sec, then.tv_usec = now.tv_sec, now.tv_usec
+        then.tv_sec, then.tv_usec = clock.now.tv_sec, clock.now.tv_usec
         delta = 0
 
-        # Set laser
-        bcm2835_gpio_write(LAS, las_arr[i])
+        # Bresenham's algo, same as HManHelper._gen_step_list used to
+        mask = major_mask
+        if error >= 0:
+            mask |= minor_mask
+            error -= n_major
+        error += n_minor
+
+        # Rising edge: set laser, step steppers
+        bcm2835_gpio_set_multi(mask | las_mask)
         # bcm2835_gpio_write(LAS, 1 if las_arr[i] else 0)  # 8b power settings
 
-        # Move steppers
-        bcm2835_gpio_write(MOT_A[DIR], step_arrA[i] > 0)
-        bcm2835_gpio_write(MOT_B[DIR], step_arrB[i] > 0)
+        # Read switches in the middle of a step to prolong the width of a step
+        # pulse
+        if use_events and i > 0:
+            retval = read_switch_events()
+        else:
+            retval = read_switches_fast()
 
-        if step_arrA[i] != 0:
-            bcm2835_gpio_set(MOT_A[STEP])
-        if step_arrB[i] != 0:
-            bcm2835_gpio_set(MOT_B[STEP])
-        retval = read_switches_fast()  # Read switches in the middle of a step
-                                       # to prolong the width of a step pulse
-        bcm2835_gpio_clr(MOT_A[STEP])
-        bcm2835_gpio_clr(MOT_B[STEP])
+        # Falling edge: clear steps
+        bcm2835_gpio_clr_multi(step_pin_mask)
+        head_step(a_dir if mask & a_mask else 0,
+                  b_dir if mask & b_mask else 0, las_mask != 0, retval)
 
         #Check switches, quit if triggered
         if retval:
             # print "Switches triggered: " + bin(retval)
             break
-
-        # # Diagnostic
-        # gettimeofday(&now, NULL)
-        # delta = time_diff(then, now)
-        # opTimes[i] = delta
+        if clock.abort != NULL and atomic_load(clock.abort, ATOMIC_RELAXED):
+            retval = MOVE_ABORTED
+            break
 
         # Time idle
-        while delta < time_arr[i]:
-            gettimeofday(&now, NULL)
-            delta = time_diff(then, now)
+        if realtime:
+            clock.deadline = next_deadline(clock.deadline, period)
+            sleep_until(clock.deadline)
+        while delta < period and not realtime:
+            gettimeofday(&clock.now, NULL)
+            delta = time_diff(then, clock.now)
 
-        i += 1 #increment for loop
+        count -= 1
+        i += 1
 
-    bcm2835_gpio_clr(LAS)
+    bcm2835_gpio_clr_multi(las_pin_mask)
+    head_step(0, 0, False, retval if retval > 0 else 0)
+
+    return retval
+
+
+cdef int step_arc(ArcStepper *arc, int *runs, long n_runs, StepClock *clock):
+    """ Step loop of move_arc, timed from a step clock, see step_line().
+
+    :param arc: Arc stepper at the start of the arc, see arc_init()
+    :type: ArcStepper *
+    :param runs: Flat (count, laser, period) runs, see move_arc
+    :type: int *
+    :param n_runs: Number of runs
+    :type: long
+    :param clock: Step clock, see clock_start()
+    :type: StepClock *
+
+    :return: Switch values if endstops or safety feet are triggered,
+    MOVE_ABORTED if the clock's abort flag was set, else 0
+    :rtype: int
+    """
+
+    cdef timeval then
+    cdef int delta = 0
+    cdef int retval = 0
+    cdef unsigned int las_mask = 0
+    cdef long r = 0, count = 0
+    cdef int period = 0
+    cdef long i = 0
+    cdef int code = arc_next(arc)
+    cdef int next_code
+
+    # Laser off, directions for the first step
+    bcm2835_gpio_clr_multi(las_pin_mask)
+    set_step_dirs(code)
+
+    while code:
+        # Next run: laser and period for the next count steps
+        if count == 0:
+            if r == n_runs:
+                break
+            count = runs[3*r]
+            if runs[3*r + 1]:
+                las_mask = las_pin_mask
+            elif las_mask:
+                las_mask = 0
+                bcm2835_gpio_clr_multi(las_pin_mask)
+            period = runs[3*r + 2]
+            r += 1
+            continue
+
+        # Reset times
+        then.tv_sec, then.tv_usec = clock.now.tv_sec, clock.now.tv_usec
+        delta = 0
+
+        # Rising edge: set laser, step steppers
+        bcm2835_gpio_set_multi(step_code_mask(code) | las_mask)
+
+        # Read switches and find the next step in the middle of a step to
+        # prolong the width of a step pulse
+        if use_events and i > 0:
+            retval = read_switch_events()
+        else:
+            retval = read_switches_fast()
+        next_code = arc_next(arc)
 
-    # # Diagnostic
-    # errs = [deltaTimes[i+1] - time_list[i] for i in range(list_len-1)]
-    # meanErr = sum(errs) / float(len(errs))
-    # maxErr = max(errs)
-    # minErr = min(errs)
-    # std_dev = math.sqrt(sum([(x - meanErr)*(x - meanErr) for x
-    #                          in errs]) / float(len(errs)))
-    #
-    # mean_opTime = sum(opTimes) / list_len
-    # std_dev_opTime = math.sqrt(sum([(x - mean_opTime)**2 for x in opTimes])
-    #                     / float(list_len))
-    # max_opTime = max(opTimes)
-    # min_opTime = min(opTimes)
-    #
-    # print "meanErr: {}, maxErr: {}, minErr: {}, std_dev: {}".format(
-    #     meanErr, maxErr, minErr, std_dev)
-    # print "mean_opTime: {}, max_opTime: {}, min_opTime: {}, std_dev_opTime: {}"\
-    #     .format(mean_opTime, max_opTime, min_opTime, std_dev_opTime)
+        # Falling edge: clear steps, change directions for the next step
+        bcm2835_gpio_clr_multi(step_pin_mask)
+        set_step_dirs(next_code)
+        head_step((1 if code & A_FWD else -1) if code & A_STEP else 0,
+                  (1 if code & B_FWD else -1) if code & B_STEP else 0,
+                  las_mask != 0, retval)
+
+        #Check switches, quit if triggered
+        if retval:
+            break
+        if clock.abort != NULL and atomic_load(clock.abort, ATOMIC_RELAXED):
+            retval = MOVE_ABORTED
+            break
+
+        # Time idle
+        if realtime:
+            clock.deadline = next_deadline(clock.deadline, period)
+            sleep_until(clock.deadline)
+        while delta < period and not realtime:
+            gettimeofday(&clock.now, NULL)
+            delta = time_diff(then, clock.now)
+
+        code = next_code
+        count -= 1
+        i += 1
+
+    bcm2835_gpio_clr_multi(las_pin_mask)
+    head_step(0, 0, False, retval if retval > 0 else 0)
 
     return retval
 
+
+cdef ArcStepper arc_init(long long p, long long q, long long end_p,
+                         long long end_q, int turn):
+    """ Set up an arc stepper in A/B step space.
+
+    X = (A + B) / 2 and Y = (A - B) / 2, so a circle in X/Y is also a circle
+    in A/B, 1.414x larger and turning the other way (X/Y CCW is A/B CW).
+
+    The radius is set by the start position. If the end isn't on the same
+    circle, the last step or two walk straight to it. The arc is a full
+    circle if it ends where it starts.
+
+    :param p: Start A position relative to the arc center, steps
+    :type: long long
+    :param q: Start B position relative to the arc center, steps
+    :type: long long
+    :param end_p: End A position relative to the arc center, steps
+    :type: long long
+    :param end_q: End B position relative to the arc center, steps
+    :type: long long
+    :param turn: +1 for counterclockwise in A/B space, -1 for clockwise
+    :type: int
+    :return: Arc stepper at the start of the arc
+    :rtype: ArcStepper
+    """
+
+    cdef ArcStepper arc
+    arc.p, arc.q = p, q
+    arc.end_p, arc.end_q = end_p, end_q
+    arc.r2 = p*p + q*q
+    arc.turn = turn
+    arc.swept = 0
+    arc.sweep = turn * (atan2(end_q, end_p) - atan2(q, p))
+    while arc.sweep <= 0:
+        arc.sweep += 2 * M_PI
+    # About half a step of angle
+    arc.min_angle = 0.5 / sqrt(arc.r2) if arc.r2 > 0 else 0
+    arc.on_arc = arc.r2 > 0
+    return arc
+
+
+cdef int arc_next(ArcStepper *arc):
+    """ Find the next step along an arc, and move the stepper to it.
+
+    Midpoint circle algorithm: the position always moves one step along the
+    larger component of the arc tangent, and along the smaller component too
+    if that lands closer to the circle. Once the arc is within min_angle of
+    its sweep, steps go straight to the end position.
+
+    :param arc: Arc stepper, see arc_init()
+    :type: ArcStepper *
+    :return: Step code, A_STEP | B_STEP for which motors step, and A_FWD |
+    B_FWD for which step forwards. 0 when the arc is done.
+    :rtype: int
+    """
+
+    cdef long long p = arc.p, q = arc.q
+    cdef long long tp = -q * arc.turn, tq = p * arc.turn  # Tangent
+    cdef int dp = 0, dq = 0
+    cdef int minor
+
+    if arc.on_arc and arc.sweep - arc.swept < arc.min_angle:
+        arc.on_arc = False
+    if arc.on_arc:
+        if llabs(tp) >= llabs(tq):
+            dp = 1 if tp > 0 else -1
+            minor = (tq > 0) - (tq < 0)
+            if minor and llabs((p + dp)*(p + dp) + (q + minor)*(q + minor)
+                               - arc.r2) \
+                    < llabs((p + dp)*(p + dp) + q*q - arc.r2):
+                dq = minor
+        else:
+            dq = 1 if tq > 0 else -1
+            minor = (tp > 0) - (tp < 0)
+            if minor and llabs((p + minor)*(p + minor) + (q + dq)*(q + dq)
+                               - arc.r2) \
+                    < llabs(p*p + (q + dq)*(q + dq) - arc.r2):
+                dp = minor
+        arc.swept += arc.turn * atan2(p*(q + dq) - q*(p + dp),
+                                      p*(p + dp) + q*(q + dq))
+    else:
+        dp = (arc.end_p > p) - (arc.end_p < p)
+        dq = (arc.end_q > q) - (arc.end_q < q)
+        if dp == 0 and dq == 0:
+            return 0
+
+    arc.p += dp
+    arc.q += dq
+    return (A_STEP if dp else 0) | (A_FWD if dp > 0 else 0) \
+        | (B_STEP if dq else 0) | (B_FWD if dq > 0 else 0)
+
+
+cdef int home_axes(int x_dir, int y_dir, long max_steps, int period,
+                   bint stop_on, long *steps=NULL):
+    """ Move the laser head along X and Y at the same time in one continuous
+    motion, stopping each axis on the edge of its own min endstop.
+
+    Both axes step together until one of them reaches its edge, then the other
+    carries on alone. XMAX, YMAX and SAFE_FEET still stop the motion.
+
+    :param x_dir: X direction to move, +1 or -1, 0 to not move X
+    :type: int
+    :param y_dir: Y direction to move, +1 or -1, 0 to not move Y
+    :type: int
+    :param max_steps: Number of A/B steps to give up after
+    :type: long
+    :param period: Time (us) to spend at each step
+    :type: int
+    :param stop_on: 1 to stop an axis when its switch triggers, 0 to stop it
+    when its switch releases
+    :type: bint
+    :param steps: If given, set to the number of steps taken
+    :type: long *
+    :return: 0 if both axes reached their edges, -1 if max_steps ran out,
+    else the switch values if XMAX, YMAX or SAFE_FEET were triggered.
+    See read_switches() for details.
+    :rtype: int
+    """
+
+    cdef int stop_mask = (0x1 << XMAX) | (0x1 << YMAX) | (0x1 << SAFE_FEET)
+    cdef int sws = read_switches_fast()
+    cdef bint x_run = x_dir != 0 and ((sws >> XMIN) & 0x1) != stop_on
+    cdef bint y_run = y_dir != 0 and ((sws >> YMIN) & 0x1) != stop_on
+    cdef int a_step, b_step
+    cdef long i = 0
+    cdef timeval then, now
+    cdef int delta = 0
+    cdef long long deadline = mono_nsec()
+
+    if steps != NULL:
+        steps[0] = 0
+    gettimeofday(&now, NULL)
+    while x_run or y_run:
+        if i >= max_steps:
+            return -1
+
+        then.tv_sec, then.tv_usec = now.tv_sec, now.tv_usec
+        delta = 0
+
+        # X = (A + B) / 2, Y = (A - B) / 2
+        if x_run and y_run:
+            a_step, b_step = (x_dir + y_dir) / 2, (x_dir - y_dir) / 2
+        elif x_run:
+            a_step, b_step = x_dir, x_dir
+        else:
+            a_step, b_step = y_dir, -y_dir
+
+        bcm2835_gpio_write(MOT_A[DIR], a_step > 0)
+        bcm2835_gpio_write(MOT_B[DIR], b_step > 0)
+        if a_step != 0:
+            bcm2835_gpio_set(MOT_A[STEP])
+        if b_step != 0:
+            bcm2835_gpio_set(MOT_B[STEP])
+        sws = read_switches_fast()
+        bcm2835_gpio_clr(MOT_A[STEP])
+        bcm2835_gpio_clr(MOT_B[STEP])
+        head_step(a_step, b_step, False, sws)
+
+        if steps != NULL:
+            steps[0] = i + 1
+        if sws & stop_mask:
+            return sws
+        if x_run and ((sws >> XMIN) & 0x1) == stop_on:
+            x_run = False
+        if y_run and ((sws >> YMIN) & 0x1) == stop_on:
+            y_run = False
+
+        if realtime:
+            deadline = next_deadline(deadline, period)
+            sleep_until(deadline)
+        while delta < period and not realtime:
+            gettimeofday(&now, NULL)
+            delta = time_diff(then, now)
+
+        i += 1
+
+    return 0
+
 ################## INTERNAL HELPER FUNCTIONS ################
 
 cdef inline int time_diff(timeval start, timeval end):
@@ -387,18 +1031,112 @@ cdef inline int time_diff(timeval start, timeval end):
     return (end.tv_sec - start.tv_sec)*USEC_PER_SEC \
             + (end.tv_usec - start.tv_usec)
 
+cdef inline void head_step(int a_step, int b_step, bint laser, int switches):
+    """ Publish a step to the head state words, if set, see
+    set_head_state(). a_step and b_step are -1, 0 or +1."""
+
+    if head_state == NULL:
+        return
+    cdef long long seq = head_state[HEAD_SEQ]
+    atomic_store(&head_state[HEAD_SEQ], seq + 1, ATOMIC_RELAXED)
+    atomic_fence(ATOMIC_RELEASE)  # Odd before any word changes
+    head_state[HEAD_A] += a_step
+    head_state[HEAD_B] += b_step
+    head_state[HEAD_LASER] = laser
+    head_state[HEAD_SWITCHES] = switches
+    atomic_store(&head_state[HEAD_SEQ], seq + 2, ATOMIC_RELEASE)
+
+cdef inline long long mono_nsec():
+    """ Read CLOCK_MONOTONIC in nanoseconds."""
+
+    cdef timespec now
+    clock_gettime(CLOCK_MONOTONIC, &now)
+    return now.tv_sec * NSEC_PER_SEC + now.tv_nsec
+
+cdef inline long long next_deadline(long long deadline, int period):
+    """ Absolute deadline one period (us) after the last. If the last deadline
+    was already missed, count from now instead of bunching up steps to catch
+    up."""
+
+    cdef long long now = mono_nsec()
+    if now > deadline:
+        deadline = now
+    return deadline + period * NSEC_PER_USEC
+
+cdef void sleep_until(long long deadline):
+    """ Wait until an absolute CLOCK_MONOTONIC time in nanoseconds. Sleeps
+    until SPIN_NSEC before the deadline, then busy waits the rest."""
+
+    cdef timespec wake
+    cdef long long wake_ns = deadline - SPIN_NSEC
+    if wake_ns > mono_nsec():
+        wake.tv_sec = wake_ns // NSEC_PER_SEC
+        wake.tv_nsec = wake_ns % NSEC_PER_SEC
+        clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &wake, NULL)
+    while mono_nsec() < deadline:
+        pass
+
 cdef int read_switches_fast():
     """ Read values of XY endstop switches and safety feet.
 
-    This is the cdef only version, for faster reads.
+    This is the cdef only version, for faster reads. Reads all switch pins
+    in one GPLEV0 register access, and only decodes them if any switch is
+    triggered.
 
     :return: Bitwise 5-bit value for XMIN, XMAX, YMIN, YMAX, SAFE_FEET (LSB)
             (i.e. 0b01001 => 9: YMAX, XMIN)
     :rtype: int
     """
-    cdef int retval = 0
+    cdef int lev = bcm2835_peri_read(bcm2835_gpio + _GPLEV0 // 4)
 
-    for pin in list_of_sw_pins:
-        retval |= (0 if bcm2835_gpio_lev(SWS[pin]) else 1 )<< pin
+    # Active low, all high means nothing triggered
+    if (lev & switch_pin_mask) == switch_pin_mask:
+        return 0
+    return decode_switches(~lev)
+
+
+cdef int read_switch_events():
+    """ Check for switch presses latched in the edge detect event register,
+    and clear them. Only reads switch levels if there were any.
+
+    :return: Bitwise 5-bit value of switches pressed since the last call or
+    still pressed. See read_switches() for details.
+    :rtype: int
+    """
+    cdef int eds = bcm2835_peri_read(bcm2835_gpio + _GPEDS0 // 4) \
+                   & switch_pin_mask
+
+    if eds == 0:
+        return 0
+    bcm2835_peri_write(bcm2835_gpio + _GPEDS0 // 4, eds)  # Write 1 to clear
+    return decode_switches(eds) | read_switches_fast()
+
+
+cdef inline int decode_switches(int bits):
+    """ Convert a 32 bit GPIO register value to the 5-bit switch value, one
+    bit per switch that has its pin bit set."""
+
+    cdef int retval = 0
+    cdef int sw
+    for sw in range(SAFE_FEET + 1):
+        if (bits >> SWS[sw]) & 0x1:
+            retval |= 0x1 << sw
 
     return retval
+
+
+cdef inline unsigned int step_code_mask(int code):
+    """ STEP pin mask of an arc step code, see arc_next()."""
+
+    return ((1 << MOT_A[STEP]) if code & A_STEP else 0) \
+        | ((1 << MOT_B[STEP]) if code & B_STEP else 0)
+
+
+cdef inline void set_step_dirs(int code):
+    """ Set the DIR pins of the motors that step in an arc step code. Motors
+    that don't step keep their last direction."""
+
+    if code & A_STEP:
+        bcm2835_gpio_write(MOT_A[DIR], (code & A_FWD) != 0)
+    if code & B_STEP:
+        bcm2835_gpio_write(MOT_B[DIR], (code & B_FWD) != 0)
@@ -0,0 +1,300 @@
+"""
+ipsDither.pyx
+Cython accelerated image filter and dithering kernels for ipsRaster.
+
+pix: 8 bit greyscale pixel array, 0 black - 255 white
+"""
+
+cimport cython
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+# Error diffusion kernels: (dx, dy, weight) taps to the right and below the
+# current pixel, and the divisor of the weights. Atkinson only diffuses 6/8
+# of the error on purpose, for more contrast.
+DIFFUSION_KERNELS = {
+    "floyd": ([(1, 0, 7), (-1, 1, 3), (0, 1, 5), (1, 1, 1)], 16),
+    "atkinson": ([(1, 0, 1), (2, 0, 1), (-1, 1, 1), (0, 1, 1), (1, 1, 1),
+                  (0, 2, 1)], 8),
+    "stucki": ([(1, 0, 8), (2, 0, 4),
+                (-2, 1, 2), (-1, 1, 4), (0, 1, 8), (1, 1, 4), (2, 1, 2),
+                (-2, 2, 1), (-1, 2, 2), (0, 2, 4), (1, 2, 2), (2, 2, 1)], 42)
+}
+
+# Same as ImageFilter.SMOOTH_MORE, divisor 100
+cdef float SMOOTH_MORE[25]
+SMOOTH_MORE[:] = [1, 1, 1, 1, 1,
+                  1, 5, 5, 5, 1,
+                  1, 5, 44, 5, 1,
+                  1, 5, 5, 5, 1,
+                  1, 1, 1, 1, 1]
+
+# Min rows per thread for ordered dithering, below which threads cost more
+# than they save
+ORDERED_BAND = 256
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef filter_chain(const unsigned char[:, :] pix):
+    """ Edge enhance and smooth a greyscale image for dithering, in two
+    passes over the image.
+
+    Same result as raster_dither's PIL filter chain: CONTOUR then SMOOTH_MORE
+    for the edges, SMOOTH_MORE for the source, brightness leveling by the
+    smoothed mean, and multiplying the two together. Pixel rounding and
+    borders follow PIL's.
+
+    :param pix: Greyscale image
+    :type: uint8 array[rows][cols]
+    :return: Filtered image
+    :rtype: numpy.ndarray[rows][cols] of uint8
+    """
+
+    cdef Py_ssize_t rows = pix.shape[0], cols = pix.shape[1]
+    out = np.empty((rows, cols), dtype=np.uint8)
+    edges = np.empty((rows, cols), dtype=np.uint8)
+    cdef unsigned char[:, :] out_v = out, edges_v = edges
+    # Last 5 rows of the contour image, row y at y % 5
+    cdef unsigned char[:, :] contour = np.empty((5, cols), dtype=np.uint8)
+    cdef float kernel[25]
+    cdef Py_ssize_t y, x, i
+    cdef long long total = 0
+    cdef float factor, level
+
+    # PIL's kernels are floats divided by the divisor, and each row of the
+    # kernel is summed on its own before adding; see _smooth_row
+    for i in range(25):
+        kernel[i] = SMOOTH_MORE[i] / <float>100
+
+    # First pass: smooth the source and the contour image, row by row
+    for y in range(min(2, rows)):
+        _contour_row(pix, contour[y % 5], y)
+    for y in range(rows):
+        if y + 2 < rows:
+            _contour_row(pix, contour[(y + 2) % 5], y + 2)
+        _smooth_row(pix, out_v[y], y, y, rows, kernel)
+        _smooth_row(contour, edges_v[y], y % 5, y, rows, kernel)
+        for x in range(cols):
+            total += out_v[y, x]
+
+    # Brightness leveling for dark images
+    # TODO Make a proper gamma curve thing
+    factor = 1
+    if rows and cols:
+        level = total / <double>(rows * cols)
+        if level < 100:
+            factor = 1.75
+        elif level < 120:
+            factor = 1.2
+
+    # Second pass: level, and recombine edges
+    for y in range(rows):
+        for x in range(cols):
+            level = factor * out_v[y, x]
+            out_v[y, x] = (_clip8(level) * edges_v[y, x]) // 255
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef error_diffusion(const unsigned char[:, :] pix, kernel="floyd"):
+    """ Dither a greyscale image to black and white by serpentine error
+    diffusion: rows go alternately left to right and right to left, which
+    avoids the diagonal "worm" patterns of always going one way.
+
+    :param pix: Greyscale image
+    :type: uint8 array[rows][cols]
+    :param kernel: Error diffusion kernel, from DIFFUSION_KERNELS: "floyd"
+    (Floyd-Steinberg), "atkinson" or "stucki"
+    :type: string
+    :return: Dithered image, 0 or 255 per pixel
+    :rtype: numpy.ndarray[rows][cols] of uint8
+    """
+
+    # Errors are kept as integer sums of error * weight, and divided when
+    # used, by multiplying by a 16 bit fixed point reciprocal. The same row
+    # taps, w1 and w2, are carried in locals instead of the error buffer,
+    # which keeps each pixel from waiting on the last one's store.
+    taps, divisor = DIFFUSION_KERNELS[kernel]
+    cdef int recip = (65536 + divisor // 2) // divisor
+    cdef int w1 = 0, w2 = 0  # Same row, 1 and 2 pixels ahead
+    cdef int n_taps = 0
+    cdef int tap_dx[12]
+    cdef int tap_dy[12]
+    cdef int tap_w[12]
+    cdef int t
+    for dx, dy, weight in taps:
+        if dy == 0:
+            if dx == 1:
+                w1 = weight
+            else:
+                w2 = weight
+            continue
+        tap_dx[n_taps] = dx
+        tap_dy[n_taps] = dy
+        tap_w[n_taps] = weight
+        n_taps += 1
+
+    cdef Py_ssize_t rows = pix.shape[0], cols = pix.shape[1]
+    out = np.empty((rows, cols), dtype=np.uint8)
+    cdef unsigned char[:, :] out_v = out
+    # Error diffused into the next 3 rows, row y at y % 3, 2 pixels of
+    # padding on each side
+    cdef int[:, :] err = np.zeros((3, cols + 4), dtype=np.intc)
+    cdef int *tap_err[12]  # Error row of each tap, at x = 0
+    cdef int *row_err
+    cdef Py_ssize_t y, x, k
+    cdef int step
+    cdef int val, error, carry1, carry2
+    cdef unsigned char pix_out
+
+    with nogil:
+        for y in range(rows):
+            step = 1 if y % 2 == 0 else -1
+            row_err = &err[y % 3, 2]
+            for t in range(n_taps):
+                tap_err[t] = &err[(y + tap_dy[t]) % 3, 2 + step * tap_dx[t]]
+            carry1 = carry2 = 0
+            for k in range(cols):
+                x = k if step == 1 else cols - 1 - k
+                val = pix[y, x] + (((row_err[x] + carry1) * recip) >> 16)
+                pix_out = 255 if val >= 128 else 0
+                out_v[y, x] = pix_out
+                error = val - pix_out
+                carry1 = carry2 + error * w1
+                carry2 = error * w2
+                for t in range(n_taps):
+                    tap_err[t][x] += error * tap_w[t]
+            err[y % 3, :] = 0
+
+    return out
+
+
+def ordered_dither(pix, order=4):
+    """ Dither a greyscale image to black and white with a Bayer ordered
+    dither matrix. Each pixel is compared against a tiled threshold map, with
+    no error carried between pixels, so bands of rows are done in parallel
+    threads; numpy releases the GIL while comparing.
+
+    :param pix: Greyscale image
+    :type: uint8 array[rows][cols]
+    :param order: Bayer matrix size, a power of 2
+    :type: int
+    :return: Dithered image, 0 or 255 per pixel
+    :rtype: numpy.ndarray[rows][cols] of uint8
+    """
+
+    pix = np.asarray(pix, dtype=np.uint8)
+    rows, cols = pix.shape
+    thresholds = _bayer_thresholds(order)
+    out = np.empty((rows, cols), dtype=np.uint8)
+
+    def band(start):
+        end = min(start + band_rows, rows)
+        # Threshold map tiled over the band, rows lined up with the image
+        tile = np.tile(thresholds, ((end - start) // order + 2,
+                                    cols // order + 1))
+        tile = tile[start % order:start % order + end - start, :cols]
+        np.multiply(pix[start:end] > tile, 255, out=out[start:end],
+                    casting="unsafe")
+
+    threads = min(cpu_count(), rows // ORDERED_BAND)
+    if threads <= 1:
+        band_rows = rows
+        band(0)
+        return out
+
+    band_rows = -(-rows // threads)
+    pool = ThreadPool(threads)
+    try:
+        pool.map(band, range(0, rows, band_rows))
+    finally:
+        pool.close()
+    return out
+
+
+cdef _bayer_thresholds(int order):
+    """ Bayer ordered dither threshold map, built up by doubling from 2x2.
+
+    :param order: Matrix size, a power of 2
+    :type: int
+    :return: Thresholds between 0 and 255, evenly spread
+    :rtype: numpy.ndarray[order][order] of float
+    """
+
+    if order < 2 or order & (order - 1):
+        raise ValueError("Bayer order must be a power of 2: " + str(order))
+    matrix = np.zeros((1, 1))
+    while len(matrix) < order:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) * 256. / (order * order) - 0.5
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _contour_row(const unsigned char[:, :] pix, unsigned char[:] out,
+                       Py_ssize_t y):
+    """ Row y of ImageFilter.CONTOUR of pix. Border pixels are copied."""
+
+    cdef Py_ssize_t rows = pix.shape[0], cols = pix.shape[1], x
+    cdef int ss
+    if y == 0 or y == rows - 1 or cols < 3:
+        out[:] = pix[y]
+        return
+    out[0] = pix[y, 0]
+    out[cols - 1] = pix[y, cols - 1]
+    for x in range(1, cols - 1):
+        ss = 255 + 9 * pix[y, x] \
+            - pix[y - 1, x - 1] - pix[y - 1, x] - pix[y - 1, x + 1] \
+            - pix[y, x - 1] - pix[y, x] - pix[y, x + 1] \
+            - pix[y + 1, x - 1] - pix[y + 1, x] - pix[y + 1, x + 1]
+        out[x] = 0 if ss < 0 else (255 if ss > 255 else ss)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _smooth_row(const unsigned char[:, :] src, unsigned char[:] out,
+                      Py_ssize_t row, Py_ssize_t y, Py_ssize_t rows,
+                      float *kernel):
+    """ Row y of ImageFilter.SMOOTH_MORE of a rows tall image, given as
+    src[row] and the rows around it. src is either the whole image (row = y)
+    or a ring of its last 5 rows (row = y % 5). Pixels within 2 of the border
+    are copied.
+    """
+
+    cdef Py_ssize_t n = src.shape[0], cols = out.shape[0], x, i
+    cdef Py_ssize_t r[5]
+    cdef float ss
+    # Row index of y+2 down to y-2, same order PIL sums them
+    for i in range(5):
+        r[i] = (row + n + 2 - i) % n
+    if y < 2 or y >= rows - 2 or cols < 5:
+        out[:] = src[row]
+        return
+    out[0], out[1] = src[row, 0], src[row, 1]
+    out[cols - 2], out[cols - 1] = src[row, cols - 2], src[row, cols - 1]
+    for x in range(2, cols - 2):
+        ss = 0.5  # Rounds to nearest when truncated
+        for i in range(5):
+            ss += src[r[i], x - 2] * kernel[5*i] \
+                + src[r[i], x - 1] * kernel[5*i + 1] \
+                + src[r[i], x] * kernel[5*i + 2] \
+                + src[r[i], x + 1] * kernel[5*i + 3] \
+                + src[r[i], x + 2] * kernel[5*i + 4]
+        out[x] = _clip8(ss)
+
+
+cdef inline unsigned char _clip8(float val):
+    """ Clip and truncate to a pixel value, same as PIL."""
+
+    if val <= 0:
+        return 0
+    if val >= 255:
+        return 255
+    return <unsigned char>val
@@ -9,15 +9,22 @@ pix: pixel value
 
 __author__ = 'kakit'
 
-from PIL import Image, ImageFilter, ImageStat, ImageEnhance, ImageChops
+from PIL import Image
 import numpy as np
 
+import gcodeFile
+import ipsDither as ipsD
 
-def raster_dither(in_file, scaling=10, pad=(0, 0), blackwhite=False):
+DITHER_ENGINES = ("pil", "floyd", "atkinson", "stucki", "bayer")
+
+
+def raster_dither(in_file, scaling=10, pad=(0, 0), blackwhite=False,
+                  dither="pil"):
     """ Convert an image to dithered greyscale, and pad it to the position
     given to ready for sending to the laser as a power/speed bitmap.
 
     Raises an IOError if image file could not be opened.
+    Raises a ValueError if the dithering engine is not known.
 
     :param in_file: Relative file path and name of input image
     :type: string
@@ -28,6 +35,10 @@ def raster_dither(in_file, scaling=10, pad=(0, 0), blackwhite=False):
     :param blackwhite: Set as True if image is already black and white for
                        engraving
     :type: bool
+    :param dither: Dithering engine, one of DITHER_ENGINES: "pil" (PIL's
+                   Floyd-Steinberg), "floyd", "atkinson", "stucki" (serpentine
+                   error diffusion), or "bayer" (ordered)
+    :type: string
     :return: Image converted to raster bitmap
     """
     # Get image, convert
@@ -35,26 +46,27 @@ def raster_dither(in_file, scaling=10, pad=(0, 0), blackwhite=False):
     # Pad
     # Output
 
+    if dither not in DITHER_ENGINES:
+        raise ValueError("Unknown dithering engine: " + str(dither))
+
     # Main processing blocks, filters
     with Image.open(in_file) as pic:
         if not blackwhite:
             pic = pic.convert(mode="L")  # To greyscale
 
-            edges = pic.filter(ImageFilter.CONTOUR)  # Pick out edges
-            edges = edges.filter(ImageFilter.SMOOTH_MORE)  # Smooth edge noise
-
-            pic = pic.filter(ImageFilter.SMOOTH_MORE)  # Smooth source noise
+            # Edges, smoothing and brightness leveling in one go, same as
+            # CONTOUR, SMOOTH_MORE, brightness enhance and multiply
+            pix = ipsD.filter_chain(np.asarray(pic))
 
-            # Brightness leveling for dark images
-            # TODO Make a proper gamma curve thing
-            brightness = ImageStat.Stat(pic).mean
-            if brightness[0] < 100:
-                pic = ImageEnhance.Brightness(pic).enhance(1.75)
-            elif brightness[0] < 120:
-                pic = ImageEnhance.Brightness(pic).enhance(1.2)
-
-            pic = ImageChops.multiply(pic, edges)  # Recombine edges
-            pic = pic.convert("1")  # Uses Floyd-Steinberg dithering by default
+            if dither == "pil":
+                # Uses Floyd-Steinberg dithering by default
+                pic = Image.fromarray(pix).convert("1")
+            else:
+                if dither == "bayer":
+                    pix = ipsD.ordered_dither(pix)
+                else:
+                    pix = ipsD.error_diffusion(pix, dither)
+                pic = Image.fromarray(pix).convert("1", dither=Image.NONE)
 
         # Pad out from corner
         if pad != (0, 0):
@@ -79,12 +91,21 @@ def gen_gcode(filename, pic, settings):
     # cut_feed: Lasing speed in mm/min
     # bed_xmax: Maximum x position in mm
     # bed_ymax: Maximum y position in mm
+    # step_cal: Motor steps per mm (optional, default 10)
 
     # not enabled yet
     # setup_cmds: List of G-code commands to prefix main cutting commands (home,
     #             init, test, etc), list of strings
     # cleanup_cmds: List of G-code commands to follow main cutting commands
 
+    Rows are engraved on the motor step grid, so no two passes cover the same
+    physical row, see _step_rows. Image rows that share a step row are merged
+    into one pass, covering all of their dark pixels, and image rows that
+    cover several step rows get a pass on each. Row ends are also rounded out
+    to whole steps.
+
+    The G-code is compressed if filename ends in .gz or .zst, see gcodeFile.
+
     Raises IOError if file could not be opened/written to.
     Raises KeyError if missing a settings dictionary value.
 
@@ -103,6 +124,7 @@ def gen_gcode(filename, pic, settings):
     cut_feed = settings["cut_feed"]
     bed_xmax = settings["bed_xmax"]
     bed_ymax = settings["bed_ymax"]
+    step_cal = settings.get("step_cal", 10)
     # TODO enable setup_cmds, cleanup_cmds
     # setup_cmds = settings["setup_cmds"]
     setup_cmds = ["; G-code autogenerated by IPS Raster block",
@@ -117,39 +139,76 @@ def gen_gcode(filename, pic, settings):
                     "G28 ; Home",
                     "; End IPS Raster Autogenerated G-code"]
 
-    outfile = open(filename, mode='w')
+    outfile = gcodeFile.open_gcode(filename, "w")
     pix_arr = np.array(pic)
 
     # Setup cmds
     outfile.write("\n".join(setup_cmds))
 
-    # TODO Debug etching at different DPI than native (Doesn't do every line)
-    for row_i, row in enumerate(pix_arr):
-        cmds = []
-        if float(row_i) / scaling > bed_ymax:  # check y limits
-            continue
-        if len(np.where(row < 255)[
-                   0]) == 0:  # If no pixels to etch, skip this row
+    # First and last pixel to etch in each row, all rows at once
+    dark = pix_arr < 255
+    cols = dark.shape[1]
+    has_dark = dark.any(axis=1)
+    first_col = np.where(has_dark, dark.argmax(axis=1), cols)
+    last_col = np.where(has_dark, cols - 1 - dark[:, ::-1].argmax(axis=1), -1)
+
+    # One pass per step row, merging rows that land on the same one
+    rows, step_row = _step_rows(len(pix_arr), scaling, step_cal)
+    first_col, last_col = first_col[rows], last_col[rows]
+    starts = np.flatnonzero(np.r_[True, step_row[1:] != step_row[:-1]])
+    first_col = np.minimum.reduceat(first_col, starts)
+    last_col = np.maximum.reduceat(last_col, starts)
+
+    for k, first_col_i, last_col_i in zip(step_row[starts], first_col,
+                                          last_col):
+        y = float(k) / step_cal
+        if first_col_i == cols or y > bed_ymax:  # No pixels, or y limits
             continue
-        # Move to start of row/first non-zero column
-        first_col_i = np.where(row < 255)[0][0]
-        first_col_i -= 1 if first_col_i > 0 else 0
-        cmds.append("\nG0 X{} Y{} F{}".format(float(first_col_i) / scaling,
-                                              float(row_i) / scaling,
-                                              travel_feed))
-        # Only go to last non-zero column
-        last_col_i = np.where(row < 255)[0][-1]
-        last_col_i += 1 if last_col_i + 1 < len(row) else 0
-        if float(last_col_i) / scaling > bed_xmax:  # check x limits
-            last_col_i = bed_xmax
-        cmds.append("\nG1 X{} Y{} F{}".format(float(last_col_i) / scaling,
-                                              float(row_i) / scaling,
-                                              cut_feed))
-        # TODO check horizontal banding if delta_y is not larger than step size
-
-        outfile.writelines(cmds)
+        # From a pixel before the first to etch, to the end of the last one,
+        # in whole steps
+        x_start = np.floor(max(first_col_i - 1, 0) * step_cal / scaling)
+        x_end = np.ceil((last_col_i + 1) * step_cal / scaling)
+        x_end = min(x_end, np.floor(bed_xmax * step_cal))  # check x limits
+        outfile.write("\nG0 X{} Y{} F{}".format(x_start / step_cal, y,
+                                                travel_feed))
+        outfile.write("\nG1 X{} Y{} F{}".format(x_end / step_cal, y,
+                                                cut_feed))
 
     # Clean up commands
     outfile.write("\n" + "\n".join(cleanup_cmds))
 
     outfile.close()
+
+
+def _step_rows(n_rows, scaling, step_cal):
+    """ Find the motor step rows to engrave each image row on.
+
+    A pure Y move of one step is one step on each motor, so step rows are
+    1/step_cal mm apart. Each image row gets every step row inside it, so the
+    laser reads that row from the mask, and coarse images (scaling below
+    step_cal) leave no gaps. Image rows with no step row inside them, when
+    scaling is finer than step_cal, get the nearest step row and share it with
+    a neighbour.
+
+    :param n_rows: Number of image rows
+    :type: int
+    :param scaling: Image dots per mm
+    :type: double
+    :param step_cal: Motor steps per mm
+    :type: double
+    :return: Image row and step row of each pass, step rows never decreasing
+    :rtype: (numpy.ndarray of int, numpy.ndarray of int)
+    """
+
+    ratio = float(step_cal) / scaling  # Step rows per image row
+    i = np.arange(n_rows)
+    # Step rows from the top edge of the image row up to its bottom edge
+    lo = np.ceil(i * ratio - 1e-6)
+    hi = np.ceil((i + 1) * ratio - 1e-6) - 1
+    first = np.where(lo <= hi, lo, np.floor((i + 0.5) * ratio + 0.5))
+    count = np.maximum(hi - lo + 1, 1).astype(int)
+
+    # Passes of each image row, from its first step row
+    rows = np.repeat(i, count)
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+    return rows, (np.repeat(first, count) + offset).astype(int)
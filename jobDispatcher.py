@@ -0,0 +1,208 @@
+"""
+jobDispatcher.py
+For running one shared queue of G-code jobs on several laser cutters.
+
+Each cutter gets its own worker process with its own GcodeInterface, so each
+has its own hardwareDriver state and GPIO access. Whenever a cutter is free,
+it is given the longest job left by estimated time, which keeps the cutters
+finishing close together. Workers that die are restarted.
+"""
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+import time
+
+import batchRunner
+from GcodeInterface import GcodeInterface
+
+
+class JobDispatcher(object):
+    """ A shared job queue, and one worker process per laser cutter.
+
+    Machines are given as factories: functions with no arguments that return
+    the machine's GcodeInterface. A factory is only called in its machine's
+    worker process, so each cutter's GPIO is only touched by its own worker.
+    For testing, factories can return dry run interfaces, or real ones with
+    hardwareDriver built against a simulated bcm2835 library.
+
+    A job whose worker dies while running it is marked failed, not rerun:
+    the material may already be partly cut. The restarted worker starts
+    unhomed, so the next job must home before it moves.
+    """
+
+    def __init__(self, machines, max_restarts=3):
+        """ Start a worker process for each machine.
+
+        :param machines: Machine name: function returning its GcodeInterface
+        :type: dict[string: function]
+        :param max_restarts: Number of times a machine's worker is restarted
+        after dying before the machine is dropped
+        :type: int
+        """
+
+        self.machines = machines
+        self.max_restarts = max_restarts
+        self.pending = []  # [estimate, job id, job], longest last
+        self.jobs = []  # Result dict per job id
+        self.results = Queue()  # (machine, job id, error, seconds)
+        self.workers = {}  # machine: {"proc", "tasks", "job", "restarts"}
+        for name in machines:
+            self.workers[name] = {"job": None, "restarts": 0}
+            self._start_worker(name)
+
+
+    def submit(self, job):
+        """ Add a job to the queue, estimating its time.
+
+        Raises the same exceptions as estimate_gcode if the job can't be read.
+
+        :param job: G-code file name, or (G-code file name, mask image file
+        name, mask dots per mm), same as run_batch
+        :type: string or (string, string, double)
+        :return: Job id, index of the job's result in run()
+        :rtype: int
+        """
+
+        gcode, mask_file = job, None
+        if not isinstance(job, basestring):
+            gcode, mask_file, scaling = job
+        est = GcodeInterface(dry_run=True)
+        if mask_file is not None:
+            from PIL import Image
+            est.set_las_mask(Image.open(mask_file).convert("L"), scaling)
+        estimate = est.estimate_gcode(gcode)["total"]
+
+        job_id = len(self.jobs)
+        self.jobs.append({"job": job, "estimate": estimate, "machine": None,
+                          "status": "pending", "error": None, "time": None})
+        self.pending.append([estimate, job_id, job])
+        self.pending.sort()
+        return job_id
+
+
+    def run(self):
+        """ Run queued jobs until the queue is empty and every machine is
+        idle, or until no machines are left.
+
+        :return: Result of every job submitted, by job id: job, estimated time
+        (s), machine it ran on, status ("done", "failed" or "pending"), error
+        message, and time it took (s)
+        :rtype: list[dict]
+        """
+
+        while True:
+            self._assign()
+            if all(w["job"] is None for w in self.workers.values()):
+                break  # Nothing left to run, or nothing left to run it on
+            try:
+                name, job_id, error, seconds = self.results.get(timeout=0.1)
+            except Empty:
+                self._check_workers()
+                continue
+
+            # Result of a worker that died and has already been restarted
+            result = self.jobs[job_id]
+            if result["status"] != "running":
+                continue
+            self.workers[name]["job"] = None
+            result["status"] = "failed" if error else "done"
+            result["error"], result["time"] = error, seconds
+
+        return self.jobs
+
+
+    def close(self):
+        """ Stop all the worker processes.
+
+        :return: void
+        """
+
+        for w in self.workers.values():
+            w["tasks"].put(None)
+        for w in self.workers.values():
+            w["proc"].join(5)
+            if w["proc"].is_alive():
+                w["proc"].terminate()
+        self.workers = {}
+
+
+    def _assign(self):
+        """ Give the longest pending job to each idle machine."""
+
+        for name in sorted(self.workers):
+            w = self.workers[name]
+            if not self.pending:
+                return
+            if w["job"] is None:
+                estimate, job_id, job = self.pending.pop()
+                w["job"] = job_id
+                self.jobs[job_id]["machine"] = name
+                self.jobs[job_id]["status"] = "running"
+                w["tasks"].put((job_id, job))
+
+
+    def _check_workers(self):
+        """ Fail the job of any worker that died, and restart it, or drop its
+        machine once it has used up max_restarts."""
+
+        for name in sorted(self.workers):
+            w = self.workers[name]
+            if w["proc"].is_alive():
+                continue
+
+            error = "Worker exited with code " + str(w["proc"].exitcode)
+            if w["job"] is not None:
+                self.jobs[w["job"]].update(status="failed", error=error)
+                w["job"] = None
+            if w["restarts"] >= self.max_restarts:
+                print(name + " dropped: " + error)
+                del self.workers[name]
+                continue
+            w["restarts"] += 1
+            print(name + " restarted: " + error)
+            self._start_worker(name)
+
+
+    def _start_worker(self, name):
+        """ Start a machine's worker process, with its own task queue."""
+
+        w = self.workers[name]
+        w["tasks"] = Queue()
+        w["proc"] = Process(target=_worker, name=name,
+                            args=(name, self.machines[name], w["tasks"],
+                                  self.results))
+        w["proc"].daemon = True
+        w["proc"].start()
+
+
+def _worker(name, factory, tasks, results):
+    """ Run jobs from a task queue on one machine until given None. Runs in
+    the machine's worker process.
+
+    :param name: Machine name
+    :type: string
+    :param factory: Function returning the machine's GcodeInterface
+    :type: function
+    :param tasks: (job id, job) to run
+    :type: Queue
+    :param results: (machine name, job id, error message or None, seconds)
+    for each job
+    :type: Queue
+    :return: void
+    """
+
+    gman = factory()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, job = task
+        start = time.time()
+        try:
+            batchRunner.run_job(gman, job)
+        except Exception as e:
+            gman.M1()  # STOP
+            results.put((name, job_id, type(e).__name__ + ": " + str(e),
+                         time.time() - start))
+        else:
+            results.put((name, job_id, None, time.time() - start))
@@ -0,0 +1,190 @@
+"""
+motionProcess.py
+For stepping the laser head in its own real-time process, so planning the next
+moves never stops the head, and stepping never stops the planner.
+
+The planner (the process running GcodeInterface) queues planned moves in a
+shared memory ring buffer, see motionRing.pyx, and carries on with the next
+command. The motion process steps them back to back, pinned to its own CPU.
+"""
+
+from multiprocessing import Process
+import signal
+import time
+
+import hardwareDriver as hd
+import motionRing
+
+# Planner poll time when waiting on the motion process
+WAIT_POLL = 0.0005  # s
+# Time to wait for the motion process to start or exit
+START_TIMEOUT = 5  # s
+
+
+class MotionProcess(object):
+    """ A motion process, and the ring of moves queued for it.
+
+    Only the motion process steps while it runs. Anything else that drives
+    the GPIO outputs from the planner, like homing, must wait() first.
+
+    A move that triggers a switch, or is aborted, drops every move queued
+    after it. Its status is returned by the next queue_line(), queue_arc()
+    or wait(), once the dropped moves are cleared out.
+    """
+
+    def __init__(self, cpu=-1, realtime=True, capacity=2**20):
+        """ Map the ring and start the motion process. Needs gpio_init first;
+        the motion process uses the GPIO mapping it inherits.
+
+        Raises IOError if real-time mode could not be set up.
+
+        :param cpu: CPU to pin the motion process to in real-time mode, -1
+        to leave affinity alone
+        :type: int
+        :param realtime: Run the motion process in real-time mode, see
+        hd.set_realtime
+        :type: bool
+        :param capacity: Ring size in 4 byte words, see MotionRing
+        :type: int
+        """
+
+        self.ring = motionRing.MotionRing(capacity)
+        self.proc = Process(target=_motion_main, name="motion",
+                            args=(self.ring, cpu, realtime))
+        self.proc.daemon = True
+        self.proc.start()
+
+        start = time.time()
+        while self.ring.state() == motionRing.STATE_STARTING:
+            if not self.proc.is_alive() \
+                    or time.time() - start > START_TIMEOUT:
+                self.close()
+                raise IOError("Motion process did not start")
+            time.sleep(WAIT_POLL)
+        if self.ring.state() == motionRing.STATE_NO_REALTIME:
+            self.close()
+            raise IOError("Real-time mode not set up correctly; "
+                          "Do you have root?")
+
+
+    def queue_line(self, a_delta, b_delta, runs, cmd=0):
+        """ Queue a straight line move, waiting for room in the ring if it's
+        full.
+
+        :param a_delta: Number of steps to take on A axis
+        :type: int
+        :param b_delta: Number of steps to take on B axis
+        :type: int
+        :param runs: Flat (count, laser, period) runs, see hd.move_laser
+        :type: array.array('i')
+        :param cmd: Job command the move came from, see MotionRing.push_line
+        :type: int
+        :return: 0 if queued, else the status of an earlier move that failed,
+        see MotionRing.status(); this move was not queued
+        :rtype: int
+        """
+
+        while True:
+            status = self._check()
+            if status != 0 or self.ring.push_line(a_delta, b_delta, runs,
+                                                  cmd):
+                return status
+            time.sleep(WAIT_POLL)
+
+
+    def queue_arc(self, p, q, end_p, end_q, turn, runs, cmd=0):
+        """ Queue an arc move, waiting for room in the ring if it's full.
+        Same as queue_line, see MotionRing.push_arc for the arc.
+
+        :rtype: int
+        """
+
+        while True:
+            status = self._check()
+            if status != 0 or self.ring.push_arc(p, q, end_p, end_q, turn,
+                                                 runs, cmd):
+                return status
+            time.sleep(WAIT_POLL)
+
+
+    def wait(self):
+        """ Wait for every queued move to finish.
+
+        Raises IOError if the motion process died.
+
+        :return: 0 if all moves finished, else the status of the move that
+        failed, see MotionRing.status()
+        :rtype: int
+        """
+
+        while not self.ring.empty():
+            if not self.proc.is_alive():
+                raise IOError("Motion process exited with code "
+                              + str(self.proc.exitcode))
+            time.sleep(WAIT_POLL)
+        status = self.ring.status()
+        self.ring.clear_status()
+        return status
+
+
+    def abort(self):
+        """ Stop the head within a step, and drop all queued moves.
+
+        :return: void
+        """
+
+        self.ring.abort()
+        if self.proc.is_alive():
+            self.wait()
+        self.ring.clear_status()
+
+
+    def close(self):
+        """ Finish the queued moves and stop the motion process.
+
+        :return: void
+        """
+
+        if self.proc.is_alive():
+            self.wait()
+            self.ring.push_exit()  # Ring is empty, always fits
+            self.proc.join(START_TIMEOUT)
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+
+    def _check(self):
+        """ Status of a failed move, once the moves after it are dropped.
+        Raises IOError if the motion process died. """
+
+        if self.ring.status() != 0:
+            return self.wait()
+        if not self.proc.is_alive():
+            raise IOError("Motion process exited with code "
+                          + str(self.proc.exitcode))
+        return 0
+
+
+def _motion_main(ring, cpu, realtime):
+    """ Motion process: set up real-time mode, then step queued moves until
+    told to exit.
+
+    Ctrl-C is left to the planner, which aborts the queued moves; the motion
+    process only stops between blocks or through the abort flag.
+
+    :param ring: Ring of queued moves
+    :type: MotionRing
+    :param cpu: CPU to pin to, -1 to leave affinity alone
+    :type: int
+    :param realtime: Run in real-time mode
+    :type: bool
+    :return: void
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if realtime and hd.set_realtime(1, cpu) != 0:
+        ring.set_state(motionRing.STATE_NO_REALTIME)
+        return
+    ring.set_state(motionRing.STATE_RUNNING)
+    ring.run()
+    ring.set_state(motionRing.STATE_EXITED)
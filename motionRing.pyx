@@ -0,0 +1,336 @@
+"""
+motionRing.pyx
+A lock-free shared memory ring buffer of planned moves, written by the planner
+process and stepped by the motion process. See motionProcess.py.
+
+There is one writer and one reader. The planner only writes the head, and the
+motion process only writes the tail, so neither ever waits on a lock. Each
+side publishes its counter with a release store after it is done with the
+blocks, and reads the other's with an acquire load before touching them.
+"""
+
+cimport hardwareDriver as hd
+from libc.string cimport memcpy
+from cpython cimport array
+
+cdef extern from "sys/mman.h":
+    int PROT_READ
+    int PROT_WRITE
+    int MAP_SHARED
+    int MAP_ANONYMOUS
+    void *MAP_FAILED
+    void *mmap(void *addr, size_t length, int prot, int flags, int fd,
+               long offset)
+    int munmap(void *addr, size_t length)
+
+cdef extern from "unistd.h":
+    int getppid()
+    int usleep(unsigned int usec)
+
+# Header words (long long) at the start of the shared memory
+cdef enum:
+    RING_HEAD = 0  # Block words ever written by the planner
+    RING_TAIL = 1  # Block words ever consumed by the motion process
+    RING_STATUS = 2  # Switches that stopped a move, see status()
+    RING_ABORT = 3  # Nonzero: stop stepping and drop queued moves
+    RING_STATE = 4  # Motion process state, see state()
+    RING_HEADER = 8  # Header size
+
+# Blocks: type, size in words, job command the move came from (for
+# telemetry, see hd.head_command()), args, then flat (count, laser, period)
+# runs
+cdef enum:
+    BLOCK_LINE = 1  # a_delta, b_delta
+    BLOCK_ARC = 2  # p, q, end_p, end_q, turn, see hd.arc_init()
+    BLOCK_WRAP = 3  # Rest of the ring is unused, next block is at the start
+    BLOCK_EXIT = 4  # Motion process exits
+    BLOCK_HEADER = 3
+    LINE_ARGS = 2
+    ARC_ARGS = 5
+
+# Motion process states
+STATE_STARTING = 0
+STATE_RUNNING = 1  # Stepping in real-time mode if asked for
+STATE_NO_REALTIME = 2  # Real-time mode failed, exiting
+STATE_EXITED = 3
+
+IDLE_USEC = 100  # Poll time for new blocks when the ring is empty
+
+
+cdef class MotionRing:
+    """ Ring buffer of planned moves in anonymous shared memory, shared with
+    processes forked after it is made.
+
+    Moves are queued with push_line()/push_arc(), and stepped in order by
+    run(), back to back on one step clock, so the head doesn't stop between
+    moves as long as the planner keeps ahead.
+    """
+
+    cdef long long *header
+    cdef int *data
+    cdef long capacity  # Block words
+    cdef size_t size  # Bytes mapped
+
+    def __cinit__(self, long capacity=2**20):
+        """ Map an empty ring.
+
+        :param capacity: Ring size in 4 byte words. A move takes 3 words per
+        laser/timing run, plus a few.
+        :type: long
+        """
+
+        self.capacity = capacity
+        self.size = RING_HEADER * sizeof(long long) + capacity * sizeof(int)
+        cdef void *buf = mmap(NULL, self.size, PROT_READ | PROT_WRITE,
+                              MAP_SHARED | MAP_ANONYMOUS, -1, 0)
+        if buf == MAP_FAILED:
+            raise MemoryError("Could not map the motion ring")
+        self.header = <long long *>buf
+        self.data = <int *>(self.header + RING_HEADER)  # Zeroed by mmap
+
+
+    def __dealloc__(self):
+        if self.header != NULL:
+            munmap(self.header, self.size)
+
+
+    cpdef bint push_line(self, int a_delta, int b_delta, runs,
+                         int cmd=0) except -1:
+        """ Queue a straight line move, see hd.move_laser.
+
+        :param a_delta: Number of steps to take on A axis
+        :type: int
+        :param b_delta: Number of steps to take on B axis
+        :type: int
+        :param runs: Flat (count, laser, period) runs
+        :type: array.array('i')
+        :param cmd: Job command the move came from, published while it's
+        stepped
+        :type: int
+        :return: True if queued, False if the ring is too full for it now
+        :rtype: bool
+        """
+
+        cdef int args[LINE_ARGS]
+        args[0], args[1] = a_delta, b_delta
+        return self._push(BLOCK_LINE, cmd, args, LINE_ARGS, runs)
+
+
+    cpdef bint push_arc(self, long p, long q, long end_p, long end_q,
+                        int turn, runs, int cmd=0) except -1:
+        """ Queue an arc move, see hd.arc_init() and hd.move_arc.
+
+        :param p: Start A position relative to the arc center, steps
+        :type: long
+        :param q: Start B position relative to the arc center, steps
+        :type: long
+        :param end_p: End A position relative to the arc center, steps
+        :type: long
+        :param end_q: End B position relative to the arc center, steps
+        :type: long
+        :param turn: +1 for counterclockwise in A/B space, -1 for clockwise
+        :type: int
+        :param runs: Flat (count, laser, period) runs
+        :type: array.array('i')
+        :param cmd: Job command the move came from, see push_line
+        :type: int
+        :return: True if queued, False if the ring is too full for it now
+        :rtype: bool
+        """
+
+        cdef int args[ARC_ARGS]
+        args[0], args[1], args[2], args[3], args[4] = p, q, end_p, end_q, turn
+        return self._push(BLOCK_ARC, cmd, args, ARC_ARGS, runs)
+
+
+    cpdef bint push_exit(self) except -1:
+        """ Queue a block telling run() to return, after the moves before it.
+
+        :return: True if queued, False if the ring is full now
+        :rtype: bool
+        """
+
+        return self._push(BLOCK_EXIT, 0, NULL, 0, array.array('i'))
+
+
+    cpdef bint empty(self):
+        """ Check if every queued move has been stepped or dropped.
+
+        :rtype: bool
+        """
+
+        return hd.atomic_load(&self.header[RING_TAIL], hd.ATOMIC_ACQUIRE) \
+            == self.header[RING_HEAD]
+
+
+    cpdef int status(self):
+        """ Switch values of the move that triggered a switch, or
+        hd.MOVE_ABORTED if abort() stopped one. Once set, queued moves are
+        dropped instead of stepped until clear_status().
+
+        :rtype: int
+        """
+
+        return hd.atomic_load(&self.header[RING_STATUS], hd.ATOMIC_ACQUIRE)
+
+
+    cpdef clear_status(self):
+        """ Clear status() and the abort flag, so queued moves are stepped
+        again. Only call when empty().
+
+        :return: void
+        """
+
+        hd.atomic_store(&self.header[RING_STATUS], 0, hd.ATOMIC_RELEASE)
+        hd.atomic_store(&self.header[RING_ABORT], 0, hd.ATOMIC_RELEASE)
+
+
+    cpdef abort(self):
+        """ Stop the move being stepped within a step, and drop the queued
+        moves. Stays set until clear_status().
+
+        :return: void
+        """
+
+        hd.atomic_store(&self.header[RING_ABORT], 1, hd.ATOMIC_RELEASE)
+
+
+    cpdef int state(self):
+        """ Motion process state: STATE_STARTING, STATE_RUNNING,
+        STATE_NO_REALTIME or STATE_EXITED.
+
+        :rtype: int
+        """
+
+        return hd.atomic_load(&self.header[RING_STATE], hd.ATOMIC_ACQUIRE)
+
+
+    cpdef set_state(self, int state):
+        """ Set the motion process state, see state().
+
+        :return: void
+        """
+
+        hd.atomic_store(&self.header[RING_STATE], state, hd.ATOMIC_RELEASE)
+
+
+    cpdef int run(self):
+        """ Step queued moves in order until an exit block, or until the
+        planner process is gone. Runs in the motion process, see
+        motionProcess.py.
+
+        Moves are stepped back to back on one step clock, so the first step
+        of a move is timed from the last step of the move before. The clock
+        restarts when the ring runs empty. Each move's job command is
+        published before it's stepped, see hd.head_command().
+
+        :return: 0 when told to exit, 1 if the planner process died
+        :rtype: int
+        """
+
+        cdef hd.StepClock clock
+        cdef hd.ArcStepper arc
+        cdef long long head, tail = self.header[RING_TAIL]
+        cdef int *block
+        cdef int *args
+        cdef int kind, size, retval
+        cdef bint idle = True
+        cdef int planner = getppid()
+
+        while True:
+            head = hd.atomic_load(&self.header[RING_HEAD], hd.ATOMIC_ACQUIRE)
+            if tail == head:
+                # Nothing queued, the head has stopped
+                if getppid() != planner:
+                    return 1
+                idle = True
+                usleep(IDLE_USEC)
+                continue
+
+            block = self.data + tail % self.capacity
+            kind = block[0]
+            if kind == BLOCK_WRAP:
+                # Only a type word, which can be the last word of the ring
+                tail += self.capacity - tail % self.capacity
+                hd.atomic_store(&self.header[RING_TAIL], tail,
+                                hd.ATOMIC_RELEASE)
+                continue
+            size = block[1]
+            if kind == BLOCK_EXIT:
+                hd.atomic_store(&self.header[RING_TAIL], tail + size,
+                                hd.ATOMIC_RELEASE)
+                return 0
+
+            # Moves after one that failed are dropped
+            retval = 0
+            if hd.atomic_load(&self.header[RING_STATUS], hd.ATOMIC_ACQUIRE) \
+                    == 0:
+                if idle:
+                    hd.clock_start(&clock, &self.header[RING_ABORT])
+                    idle = False
+                hd.head_command(block[2])
+                args = block + BLOCK_HEADER
+                if hd.atomic_load(&self.header[RING_ABORT],
+                                  hd.ATOMIC_RELAXED):
+                    retval = hd.MOVE_ABORTED
+                elif kind == BLOCK_LINE:
+                    retval = hd.step_line(args[0], args[1], args + LINE_ARGS,
+                                          (size - BLOCK_HEADER - LINE_ARGS)
+                                          // 3, &clock)
+                else:
+                    arc = hd.arc_init(args[0], args[1], args[2], args[3],
+                                      args[4])
+                    retval = hd.step_arc(&arc, args + ARC_ARGS,
+                                         (size - BLOCK_HEADER - ARC_ARGS)
+                                         // 3, &clock)
+            if retval != 0:
+                hd.atomic_store(&self.header[RING_STATUS], retval,
+                                hd.ATOMIC_RELEASE)
+
+            tail += size
+            hd.atomic_store(&self.header[RING_TAIL], tail, hd.ATOMIC_RELEASE)
+
+
+    cdef bint _push(self, int kind, int cmd, int *args, int n_args,
+                    runs) except -1:
+        """ Write a block at the head of the ring, and publish it.
+
+        Raises a ValueError if the block is bigger than half the ring.
+
+        :return: True if queued, False if the ring is too full for it now
+        :rtype: bool
+        """
+
+        cdef int[:] run_arr = runs
+        cdef long n_words = len(runs)
+        cdef long size = BLOCK_HEADER + n_args + n_words
+        if size > self.capacity // 2:
+            raise ValueError("Move too long for the motion ring: "
+                             + str(n_words // 3) + " runs")
+
+        # Blocks don't wrap around the end of the ring; a wrap block skips
+        # the rest of it instead. It's only the type word, so it fits in the
+        # last word.
+        cdef long long head = self.header[RING_HEAD]
+        cdef long long tail = hd.atomic_load(&self.header[RING_TAIL],
+                                             hd.ATOMIC_ACQUIRE)
+        cdef long pos = head % self.capacity
+        cdef long skip = self.capacity - pos if pos + size > self.capacity \
+            else 0
+        if head + skip + size - tail > self.capacity:
+            return False
+        if skip:
+            self.data[pos] = BLOCK_WRAP
+            head += skip
+            pos = 0
+
+        cdef int *block = self.data + pos
+        block[0], block[1], block[2] = kind, size, cmd
+        if n_args:
+            memcpy(block + BLOCK_HEADER, args, n_args * sizeof(int))
+        if n_words:
+            memcpy(block + BLOCK_HEADER + n_args, &run_arr[0],
+                   n_words * sizeof(int))
+        hd.atomic_store(&self.header[RING_HEAD], head + size,
+                        hd.ATOMIC_RELEASE)
+        return True
@@ -0,0 +1,315 @@
+"""
+planFile.pyx
+Fully planned jobs in a binary plan file, so the planning can be done once on
+any machine, and the Pi only steps it.
+
+A plan is made by running a job in plan mode (GcodeInterface.plan_gcode),
+which needs no GPIO: every move is planned into its steps and laser/timing
+runs as usual, and recorded instead of stepped. Replaying the plan
+(HardwareManager.replay_plan) steps the recorded runs straight away, with no
+parsing, bounds checking or run generation.
+
+File layout, little endian:
+    MAGIC, PLAN_VERSION (uint32)
+    Machine fingerprint: step_cal, cut_spd, travel_spd, bed_xmax, bed_ymax
+    (double), the settings the plan was made with
+    Number of block words (int64), then the blocks (int32 words)
+
+Blocks are laid out like the motion ring's, see motionRing.pyx, without its
+command word: type, size in words, args, then flat (count, laser, period)
+runs for moves.
+"""
+
+import struct
+import sys
+from cpython cimport array
+cimport hardwareDriver as hd
+
+MAGIC = b"SNEPLAN\0"
+PLAN_VERSION = 1
+_HEADER = struct.Struct("<8sI5dq")
+FINGERPRINT = ("step_cal", "cut_spd", "travel_spd", "bed_xmax", "bed_ymax")
+
+# Blocks: type, size in words, args, then flat (count, laser, period) runs
+cdef enum:
+    PLAN_LINE = 1  # a_delta, b_delta
+    PLAN_ARC = 2  # p, q, end_p, end_q, turn, see hd.arc_init()
+    PLAN_HOME = 3  # Home, see HardwareManager.home_xy
+    PLAN_MOTORS = 4  # 1 to enable, 0 to disable
+    PLAN_POSITION = 5  # x, y in um, set without moving (G92)
+    LINE_ARGS = 2
+    ARC_ARGS = 5
+
+UM_PER_MM = 1000
+
+
+cdef class PlanWriter:
+    """ Plan being recorded, from a job run in plan mode. Set as hman.plan,
+    HManHelper and HardwareManager record every move and hardware command to
+    it instead of running them.
+    """
+
+    cdef readonly object fingerprint
+    cdef readonly array.array words
+    cdef readonly long n_moves
+
+    def __init__(self, hman):
+        """ Start an empty plan, for the settings hman has now.
+
+        :param hman: Hardware Manager object the job is planned on
+        :type: HardwareManager
+        """
+
+        self.fingerprint = tuple(float(getattr(hman, name))
+                                 for name in FINGERPRINT)
+        self.words = array.array('i')
+        self.n_moves = 0
+
+
+    cpdef int add_line(self, int a_delta, int b_delta, runs) except -1:
+        """ Record a straight line move, see hd.move_laser.
+
+        :param a_delta: Number of steps to take on A axis
+        :type: int
+        :param b_delta: Number of steps to take on B axis
+        :type: int
+        :param runs: Flat (count, laser, period) runs
+        :type: array.array('i')
+        :return: 0, same as a move that finished
+        :rtype: int
+        """
+
+        self.words.extend((PLAN_LINE, 2 + LINE_ARGS + len(runs), a_delta,
+                           b_delta))
+        self.words.extend(runs)
+        self.n_moves += 1
+        return 0
+
+
+    cpdef int add_arc(self, long p, long q, long end_p, long end_q, int turn,
+                      runs) except -1:
+        """ Record an arc move, see hd.arc_init() and hd.move_arc.
+
+        :param runs: Flat (count, laser, period) runs
+        :type: array.array('i')
+        :return: 0, same as a move that finished
+        :rtype: int
+        """
+
+        self.words.extend((PLAN_ARC, 2 + ARC_ARGS + len(runs), p, q, end_p,
+                           end_q, turn))
+        self.words.extend(runs)
+        self.n_moves += 1
+        return 0
+
+
+    cpdef add_home(self):
+        """ Record homing.
+
+        :return: void
+        """
+
+        self.words.extend((PLAN_HOME, 2))
+
+
+    cpdef add_motors(self, bint en):
+        """ Record enabling or disabling the motors.
+
+        :param en: 1 to enable, 0 to disable
+        :type: bint
+        :return: void
+        """
+
+        self.words.extend((PLAN_MOTORS, 3, en))
+
+
+    cpdef add_position(self, double x, double y):
+        """ Record setting the position without moving.
+
+        :param x: New X position in mm
+        :type: double
+        :param y: New Y position in mm
+        :type: double
+        :return: void
+        """
+
+        self.words.extend((PLAN_POSITION, 4, int(round(x * UM_PER_MM)),
+                           int(round(y * UM_PER_MM))))
+
+
+    def write(self, filename):
+        """ Write the plan to a file.
+
+        Raises IOError if the file can't be written.
+
+        :param filename: Plan file name
+        :type: string
+        :return: void
+        """
+
+        words = self.words
+        if sys.byteorder == "big":
+            words = array.array('i', words)
+            words.byteswap()
+        with open(filename, "wb") as outfile:
+            outfile.write(_HEADER.pack(MAGIC, PLAN_VERSION, *self.fingerprint
+                                       + (len(words),)))
+            words.tofile(outfile)
+
+
+cdef class Plan:
+    """ A plan read from a plan file, see read_plan(). """
+
+    cdef readonly object fingerprint
+    cdef readonly array.array words
+
+    def __init__(self, fingerprint, words):
+        self.fingerprint = fingerprint
+        self.words = words
+
+
+    def check(self, hman):
+        """ Check the plan was made with hman's settings, since its steps and
+        timings were planned for them.
+
+        Raises a RuntimeError naming the first setting that doesn't match.
+
+        :param hman: Hardware Manager object to replay the plan on
+        :type: HardwareManager
+        :return: void
+        """
+
+        for name, planned in zip(FINGERPRINT, self.fingerprint):
+            if float(getattr(hman, name)) != planned:
+                raise RuntimeError("Plan was made for {} {}, machine has {}"
+                                   .format(name, planned,
+                                           getattr(hman, name)))
+
+
+    cpdef int replay(self, hman) except? -3:
+        """ Run the plan on hman, see HardwareManager.replay_plan.
+
+        Consecutive moves are stepped back to back on one step clock, or
+        queued for the motion process if one is running. In dry run mode,
+        move times are added to hman.dry_run_times instead.
+
+        Raises IOError if a block is corrupt.
+
+        :param hman: Hardware Manager object
+        :type: HardwareManager
+        :return: 0 if successful, -1 for a move while not homed or with the
+        motors disabled, else the switch values that stopped a move or homing
+        :rtype: int
+        """
+
+        cdef int[:] words = self.words
+        cdef long n_words = len(self.words)
+        cdef long pos = 0, n_runs, k
+        cdef int kind, size, n_args, a_delta, b_delta, retval
+        cdef int *block
+        cdef hd.StepClock clock
+        cdef hd.ArcStepper arc
+        cdef bint idle = True
+        cdef bint dry_run = hman.dry_run
+        motion = hman.motion
+
+        while pos < n_words:
+            if pos + 2 > n_words or words[pos + 1] < 2 \
+                    or pos + words[pos + 1] > n_words:
+                raise IOError("Corrupt plan block at word " + str(pos))
+            block = &words[pos]
+            kind, size = block[0], block[1]
+            pos += size
+
+            if kind == PLAN_HOME:
+                retval = hman.home_xy()
+                idle = True
+                if retval != 0:
+                    return retval
+                continue
+            if kind == PLAN_MOTORS:
+                hman.mots_en(block[2])
+                idle = True
+                continue
+            if kind == PLAN_POSITION:
+                hman.x = block[2] / float(UM_PER_MM)
+                hman.y = block[3] / float(UM_PER_MM)
+                continue
+            if kind != PLAN_LINE and kind != PLAN_ARC:
+                raise IOError("Unknown plan block type " + str(kind))
+
+            # Moves
+            if not hman.homed or not hman.mots_enabled:
+                return -1
+            n_args = LINE_ARGS if kind == PLAN_LINE else ARC_ARGS
+            n_runs = (size - 2 - n_args) // 3
+            if kind == PLAN_LINE:
+                a_delta, b_delta = block[2], block[3]
+            else:
+                a_delta, b_delta = block[4] - block[2], block[5] - block[3]
+
+            if dry_run:
+                for k in range(2 + n_args, 2 + n_args + 3 * n_runs, 3):
+                    hman.dry_run_times["cut" if block[k + 1] else "travel"] \
+                        += block[k] * block[k + 2] / float(hd.USEC_PER_SEC)
+                retval = 0
+            elif motion is not None:
+                runs = words[pos - size + 2 + n_args:pos]
+                if kind == PLAN_LINE:
+                    retval = motion.queue_line(a_delta, b_delta, runs)
+                else:
+                    retval = motion.queue_arc(block[2], block[3], block[4],
+                                              block[5], block[6], runs)
+            elif n_runs == 0:
+                retval = 0
+            else:
+                if idle:
+                    hd.clock_start(&clock, NULL)
+                    idle = False
+                if kind == PLAN_LINE:
+                    retval = hd.step_line(a_delta, b_delta,
+                                          block + 2 + LINE_ARGS, n_runs,
+                                          &clock)
+                else:
+                    arc = hd.arc_init(block[2], block[3], block[4], block[5],
+                                      block[6])
+                    retval = hd.step_arc(&arc, block + 2 + ARC_ARGS, n_runs,
+                                         &clock)
+            if retval != 0:
+                return retval
+
+            hman.x += 0.5*(a_delta + b_delta) / hman.step_cal
+            hman.y += 0.5*(a_delta - b_delta) / hman.step_cal
+
+        return 0
+
+
+def read_plan(filename):
+    """ Read a plan file.
+
+    Raises IOError if the file can't be read, isn't a plan file, is from
+    another PLAN_VERSION, or is cut short.
+
+    :param filename: Plan file name
+    :type: string
+    :return: The plan
+    :rtype: Plan
+    """
+
+    with open(filename, "rb") as infile:
+        header = infile.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise IOError("Not a plan file: " + filename)
+        fields = _HEADER.unpack(header)
+        if fields[1] != PLAN_VERSION:
+            raise IOError("Plan file version " + str(fields[1])
+                          + ", expected " + str(PLAN_VERSION) + ": "
+                          + filename)
+        words = array.array('i')
+        try:
+            words.fromfile(infile, fields[-1])
+        except EOFError:
+            raise IOError("Plan file cut short: " + filename)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return Plan(fields[2:-1], words)
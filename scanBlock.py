@@ -5,24 +5,36 @@ For getting image input from the camera of the laser cutter bed.
 Handles image capture and
 """
 
-import picamera as picam
 from PIL import Image
+import numpy as np
+from multiprocessing import Pool
 import time
 import io
 
 
-def scan_bed(gman, area):
+def scan_bed(gman, area, cam=None, workers=2):
     """ Take a series of images of the workpiece and return a whole image.
 
     Performs a scanning routine, taking multiple images and stitches together
     a whole picture. Does not handle limiting the size of the image to the bed.
 
+    Frames are captured raw (YUV), and decoding them is handed off to a pool of
+    worker processes, so the head is already moving to the next position while
+    the last frame is converted. Tiles are visited in serpentine order, and
+    the settle time before each capture scales with how long the move took.
+
     :param gman: Gcode interface to laser cutter hardware
     :type: GcodeInterface
     :param area: The size of the scan in mm, either a linear dimension
     (squared), (length, width) of the area to scan, or a 4-tuple of (xmin,
     ymin, xmax, ymax)
     :type: double, 2-tuple <double>, or 4-tuple <double>
+    :param cam: Camera to capture with, anything with picamera's resolution
+    and capture(output, format). Left open for the caller to close. Opens
+    and closes the PiCamera if not given.
+    :type: picamera.PiCamera
+    :param workers: Number of frame decoding processes
+    :type: int
     :return: Picture of the workpiece
     :rtype: PIL.Image.Image
     """
@@ -33,7 +45,8 @@ def scan_bed(gman, area):
     cam_feed = 100 * 60  # image taking feedrate (mm/min)
     resolution = (160, 120)  # Camera image resolution
     cam_rot = 90
-    delay = .1  # Seconds to wait before taking picture
+    settle_time = (.02, .1)  # (min, max) Seconds to wait before taking picture
+    settle_ratio = .5  # Seconds to settle per second of moving
     overlap = (.1, .15)  # Fraction overlap on x, y between pictures.
     # Depends on cam_fov setting.
     offset = (30, 0)  # Camera center offset from (0,0)
@@ -56,11 +69,15 @@ def scan_bed(gman, area):
         else:  # lol what is this
             raise ValueError("Invalid area parameter")
 
-    pics_arr = []
-    # with picam.PiCamera() as cam:
+    frames = []
+    own_cam = cam is None  # Only close a camera opened here
+    pool = None
     try:
-        cam = picam.PiCamera()
         # Init
+        if own_cam:
+            import picamera as picam  # Only on the Pi, and slow to import
+            cam = picam.PiCamera()
+        pool = Pool(workers)
         cam.resolution = resolution
         # cam.start_preview(alpha=128)  # debug
 
@@ -69,115 +86,230 @@ def scan_bed(gman, area):
 
         gman.G90()
         # TODO Account for laser being offset from cutting spot
-        for j in range(int((ymax - ymin) / cam_fov[1]) + 1):
-            pics_arr.append([])
-            for i in range(int((xmax - xmin) / cam_fov[0]) + 1):
-                stream = io.BytesIO()
-                gman.G0((i + .5) * cam_fov[0], (j + .5) * cam_fov[1], cam_feed)
-                time.sleep(delay)  # wait for motion to stop, camera adjust
-                cam.capture(stream, format='jpeg')
-                stream.seek(0)
-                pic_ji = Image.open(stream).convert(mode='L')
-                pics_arr[j].append(pic_ji.transpose(Image.ROTATE_90))
-                # TODO Remove rotate 90 deg when camera is changed
-        cam.close()
+        for i, j in _tile_order(int((xmax - xmin) / cam_fov[0]) + 1,
+                                int((ymax - ymin) / cam_fov[1]) + 1):
+            stream = io.BytesIO()
+            x, y = (i + .5) * cam_fov[0], (j + .5) * cam_fov[1]
+            move_time = ((x - gman.x)**2 + (y - gman.y)**2)**.5 \
+                        / (cam_feed / 60.)
+            gman.G0(x, y, cam_feed)
+            # wait for motion to stop, camera adjust
+            time.sleep(min(settle_time[1],
+                           settle_time[0] + settle_ratio * move_time))
+            cam.capture(stream, format='yuv')
+            # Decode while the head moves on to the next picture
+            frames.append((i, j, pool.apply_async(
+                _decode_frame, (stream.getvalue(), resolution, cam_rot))))
+        if own_cam:
+            cam.close()
+        pool.close()
+
+        tiles = [(i, j, Image.fromarray(frame.get())) for i, j, frame in frames]
+        pool.join()
         # rotate resolution 90 deg too
-        pic = _scan_stitch(pics_arr, resolution[::-1], overlap[::-1])
+        pic = _scan_stitch(tiles, resolution[::-1], overlap[::-1])
         # TODO Crop pic to given area and pad
         return pic
     except Exception:  # TODO check this catches any errors on closing
         print "Exception happened"
-        cam.close()
+        if pool is not None:
+            pool.terminate()
+        if own_cam and cam is not None:
+            cam.close()
         raise
 
 
+def _tile_order(n_cols, n_rows):
+    """ Serpentine order to visit the tiles of a scan in. Even rows go left to
+    right, odd rows right to left, so no row starts with a travel back across
+    the whole scan.
+
+    :param n_cols: Number of tiles in x
+    :type: int
+    :param n_rows: Number of tiles in y
+    :type: int
+    :return: (column, row) indices in visiting order
+    :rtype: list[(int, int)]
+    """
+    order = []
+    for j in range(n_rows):
+        cols = range(n_cols) if j % 2 == 0 else reversed(range(n_cols))
+        order.extend((i, j) for i in cols)
+    return order
+
+
+def _decode_frame(raw, resolution, rotation):
+    """ Convert a raw YUV420 capture to a rotated greyscale picture.
+
+    picamera pads raw captures to a multiple of 32 columns and 16 rows. The Y
+    plane comes first, and is already the greyscale picture.
+
+    :param raw: Raw YUV capture data
+    :type: string
+    :param resolution: Camera (width, height) the capture was taken at
+    :type: (int, int)
+    :param rotation: Rotation CCW in degrees, a multiple of 90
+    :type: int
+    :return: Greyscale picture
+    :rtype: numpy.ndarray
+    """
+    width, height = resolution
+    raw_width = (width + 31) // 32 * 32
+    raw_height = (height + 15) // 16 * 16
 
-def _scan_stitch(pics_arr, resolution, overlap):
-    """ Combine an array of Images together into one PIL Image
+    y_plane = np.frombuffer(raw, dtype=np.uint8, count=raw_width * raw_height)
+    pic = y_plane.reshape(raw_height, raw_width)[:height, :width]
+    # TODO Remove rotate 90 deg when camera is changed
+    return np.ascontiguousarray(np.rot90(pic, rotation // 90))
 
-    Relies on knowing the location of each image being taken, doesn't actually
-    do proper image stitching feature recognition
 
-    :param pics_arr:
+def _scan_stitch(tiles, resolution, overlap, register=True):
+    """ Combine a set of tile Images together into one PIL Image
+
+    Places tiles from the location each image was taken at, refined by
+    _register_tiles unless register is False. Doesn't do any feature
+    recognition.
+
+    Tiles are accumulated into one preallocated canvas, weighted by a linear
+    feather ramp across each overlap, then normalized by the accumulated
+    weights. Cost is linear in the total number of pixels.
+
+    :param tiles: Pictures with their tile positions, in any order, as
+    (column i, row j, picture)
+    :type: list[(int, int, PIL.Image.Image)]
+    :param resolution: (width, height) of each picture in pixels
+    :type: (int, int)
+    :param overlap: Fraction overlap on x, y between pictures
+    :type: (double, double)
+    :param register: Refine tile positions with phase correlation
+    :type: bool
     :return: Single picture of scanning bed area
+    :rtype: PIL.Image.Image
     """
     # TODO Apply geometric lens anti transform
-    # (not real image stitching, naive)
-    # size = int(resolution * (n - (n-1) overlap))
-    # pic = Image.new("L", (int(resolution[0] *
-    #                          (len(pics_arr[0]) - 1) * (1 - overlap[0])),
-    #                       int(resolution[1] *
-    #                          (len(pics_arr[1]) - 1) * (1 - overlap[1]))
-    #                       ),
-    #                 color="white")
-    pic = Image.new("L", (resolution[0] * len(pics_arr),
-                          resolution[1] * (len(pics_arr[0]) - 1)))
-
-    # Blend by row, then add to whole picture
-    for j, row in enumerate(pics_arr):
-        row_pic = Image.new("L", (pic.size[0], resolution[1]))
-        for i, col in enumerate(row):
-            sample = row[i]
-
-            left = int(i * resolution[0] * (1 - overlap[0]))
-
-            pad = Image.new("L", row_pic.size)
-            pad.paste(sample, (left, 0))
-
-            mask = Image.new("L", row_pic.size, 0)
-            mask.paste(255, (left, 0, left + sample.size[0], sample.size[1]))
-            if i > 0:
-                mask.paste(127, (left, 0, int(left + sample.size[0] * overlap[0]),
-                            sample.size[1]))
-
-            row_pic.paste(pad, mask=mask)
-
-        top = int(j * resolution[1] * (1 - overlap[1]))
-        pad = Image.new("L", pic.size)
-        pad.paste(row_pic, (0, top))
-
-        mask = Image.new("L", pic.size, 0)
-        mask.paste(255, (0, top, row_pic.size[0], top + row_pic.size[1]))
-        if j > 0:
-            mask.paste(127, (0, top, row_pic.size[0],
-                             int(top + row_pic.size[1] * overlap[0])))
-
-        # pic = Image.composite(pic, )
-        pic.paste(pad, mask=mask)
-
-    return pic
-
-#    # Doesn't work, doesn't account for corners
-    # for j, col in enumerate(pics_arr):
-    #     for i, row in enumerate(col):
-    #         # pic.paste(pics_arr[j][i], (i*resolution[1] * (1 - overlap),
-    #         #                            j*resolution[0]) * (1 - overlap))
-    #         # Put new image to correct position
-    #         # coordinates for new image
-    #         sample = pics_arr[j][i]
-    #
-    #         top = int(i * resolution[0] * (1 - overlap[0]))
-    #         left = int(j * resolution[1] * (1 - overlap[1]))
-    #         pad = Image.new("L", pic.size)
-    #         pad.paste(sample, (left, top))
-    #
-    #         # Set blend mask: 255 for keep, 127 for overlap, 0 for new
-    #         mask = Image.new("L", pic.size, 255)
-    #         # grey box size of img
-    #         mask.paste(127, (left, top, left + sample.size[0],
-    #                          top + sample.size[1]))
-    #
-    #         # Hard mask box, extends all the way down/right
-    #         left_offset = left if j == 0 \
-    #             else left + int(resolution[0] * overlap[0])
-    #         top_offset = top if i == 0 \
-    #             else top + int(resolution[1] * overlap[1])
-    #         mask.paste(0, (left_offset, top_offset,
-    #                        int(left_offset + sample.size[0] * (1 - overlap[0])),
-    #                        int(top_offset + sample.size[1] * (1 - overlap[1]))
-    #                        )
-    #                    )
-    #
-    #         pic = Image.composite(pic, pad, mask)
-    # return pic
+    width, height = resolution
+    if register:
+        positions = _register_tiles(tiles, resolution, overlap)
+    else:
+        step_x = int(width * (1 - overlap[0]))
+        step_y = int(height * (1 - overlap[1]))
+        positions = dict(((i, j), (j * step_y, i * step_x))
+                         for i, j, sample in tiles)
+    min_top = min(top for top, left in positions.values())
+    min_left = min(left for top, left in positions.values())
+
+    canvas = np.zeros((max(top for top, left in positions.values())
+                       - min_top + height,
+                       max(left for top, left in positions.values())
+                       - min_left + width), dtype=np.float32)
+    weights = np.zeros(canvas.shape, dtype=np.float32)
+    feather = _feather_weights(resolution, overlap)
+
+    for i, j, sample in tiles:
+        top = positions[(i, j)][0] - min_top
+        left = positions[(i, j)][1] - min_left
+        canvas[top:top + height, left:left + width] += \
+            np.asarray(sample, dtype=np.float32) * feather
+        weights[top:top + height, left:left + width] += feather
+
+    canvas /= np.maximum(weights, 1e-6)
+    return Image.fromarray(canvas.round().astype(np.uint8), mode="L")
+
+
+def _feather_weights(resolution, overlap):
+    """ Linear blending weights for one tile, ramping up from the edges across
+    the overlap width, and 1 in the middle.
+
+    :param resolution: (width, height) of each picture in pixels
+    :type: (int, int)
+    :param overlap: Fraction overlap on x, y between pictures
+    :type: (double, double)
+    :return: Weight map of shape (height, width)
+    :rtype: numpy.ndarray
+    """
+    ramps = []
+    for size, frac in zip(resolution, overlap):
+        ramp_len = max(1, int(size * frac))
+        px = np.arange(size, dtype=np.float32)
+        ramps.append(np.minimum(1, np.minimum(px + 1, size - px) / ramp_len))
+    return np.outer(ramps[1], ramps[0])
+
+
+def _register_tiles(tiles, resolution, overlap, min_peak=.2):
+    """ Find the pixel position of each tile on the stitched picture.
+
+    Starts from the commanded positions and the nominal overlap, then refines
+    each tile against its left and upper neighbours with FFT phase correlation
+    of the overlapping strips only. Tiles are placed in raster order, so drift
+    or backlash doesn't accumulate into seams.
+
+    :param tiles: Pictures with their tile positions, as (column i, row j,
+    picture)
+    :type: list[(int, int, PIL.Image.Image)]
+    :param resolution: (width, height) of each picture in pixels
+    :type: (int, int)
+    :param overlap: Fraction overlap on x, y between pictures
+    :type: (double, double)
+    :param min_peak: Correlation peak height below which a match is ignored
+    and the nominal offset is used
+    :type: double
+    :return: (top, left) pixel position for each (i, j)
+    :rtype: dict
+    """
+    width, height = resolution
+    step_x = int(width * (1 - overlap[0]))
+    step_y = int(height * (1 - overlap[1]))
+    pics = dict(((i, j), np.asarray(sample, dtype=np.float32))
+                for i, j, sample in tiles)
+
+    positions = {}
+    for i, j in sorted(pics, key=lambda ij: (ij[1], ij[0])):
+        pic = pics[(i, j)]
+        guesses = []
+        if (i - 1, j) in positions and step_x < width:
+            dy, dx = _phase_correlate(pics[(i - 1, j)][:, step_x:],
+                                      pic[:, :width - step_x], min_peak)
+            top, left = positions[(i - 1, j)]
+            guesses.append((top + dy, left + step_x + dx))
+        if (i, j - 1) in positions and step_y < height:
+            dy, dx = _phase_correlate(pics[(i, j - 1)][step_y:, :],
+                                      pic[:height - step_y, :], min_peak)
+            top, left = positions[(i, j - 1)]
+            guesses.append((top + step_y + dy, left + dx))
+
+        if guesses:
+            positions[(i, j)] = (
+                int(round(sum(g[0] for g in guesses) / float(len(guesses)))),
+                int(round(sum(g[1] for g in guesses) / float(len(guesses)))))
+        else:
+            positions[(i, j)] = (j * step_y, i * step_x)
+
+    return positions
+
+
+def _phase_correlate(ref, moved, min_peak):
+    """ Find the translation of one strip relative to another of the same size
+    with FFT phase correlation.
+
+    Shifts are limited to half the strip size in each direction.
+
+    :param ref: Reference strip
+    :type: numpy.ndarray
+    :param moved: Strip to find the offset of
+    :type: numpy.ndarray
+    :param min_peak: Correlation peak height below which (0, 0) is returned
+    :type: double
+    :return: (dy, dx) to add to moved's nominal position to line up with ref
+    :rtype: (int, int)
+    """
+    window = np.outer(np.hanning(ref.shape[0]), np.hanning(ref.shape[1]))
+    cross = np.fft.rfft2((ref - ref.mean()) * window) \
+        * np.conj(np.fft.rfft2((moved - moved.mean()) * window))
+    cross /= np.maximum(np.abs(cross), 1e-9)
+    corr = np.fft.irfft2(cross, ref.shape)
 
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    if corr[peak] < min_peak:
+        return 0, 0
+    # Wrap to signed shifts
+    return tuple(p - n if p > n // 2 else p for p, n in zip(peak, corr.shape))
@@ -21,6 +21,22 @@ extensions = [
     Extension("HManHelper",
               ["HManHelper.pyx"]
               )
+    ,
+    Extension("ipsDither",
+              ["ipsDither.pyx"]
+              )
+    ,
+    Extension("motionRing",
+              ["motionRing.pyx"]
+              )
+    ,
+    Extension("telemetry",
+              ["telemetry.pyx"]
+              )
+    ,
+    Extension("planFile",
+              ["planFile.pyx"]
+              )
 ]
 setup(
     ext_modules=cythonize(extensions)
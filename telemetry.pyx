@@ -0,0 +1,265 @@
+"""
+telemetry.pyx
+Live machine state in a small shared memory record, written by the job
+executor and read by monitoring tools in other processes, without locks.
+
+The record has two parts. Job progress and settings are written by the
+planner after each command. The head position, laser and switches are
+written by whichever process is stepping, on every step, see
+hardwareDriver.set_head_state(), so they stay live through long moves, arcs
+and homing, and show where the head is, not where the queued moves end.
+
+Each part is a seqlock: the writer makes its sequence number odd, writes the
+fields, then makes it even again. Readers copy the fields between two reads
+of the sequence number, and retry if it changed or was odd, so neither side
+ever waits on the other.
+"""
+
+cimport hardwareDriver as hd
+
+import os
+import time
+
+cdef extern from "fcntl.h":
+    int O_RDONLY
+    int O_RDWR
+    int O_CREAT
+    int open(const char *path, int flags, int mode)
+
+cdef extern from "unistd.h":
+    int close(int fd)
+    int ftruncate(int fd, long length)
+    int usleep(unsigned int usec)
+
+cdef extern from "sys/mman.h":
+    int PROT_READ
+    int PROT_WRITE
+    int MAP_SHARED
+    void *MAP_FAILED
+    void *mmap(void *addr, size_t length, int prot, int flags, int fd,
+               long offset)
+    int munmap(void *addr, size_t length)
+
+# GCC atomics
+cdef extern from *:
+    int ATOMIC_RELAXED "__ATOMIC_RELAXED"
+    int ATOMIC_ACQUIRE "__ATOMIC_ACQUIRE"
+    int ATOMIC_RELEASE "__ATOMIC_RELEASE"
+    long long atomic_load "__atomic_load_n"(long long *ptr, int order) nogil
+    void atomic_store "__atomic_store_n"(long long *ptr, long long val,
+                                         int order) nogil
+    void atomic_fence "__atomic_thread_fence"(int order) nogil
+
+TELEMETRY_PATH = "/dev/shm/sketchnetch_state"
+TELEMETRY_VERSION = 2
+
+# Record fields, 8 byte words
+cdef enum:
+    SEQ = 0  # Odd while being written
+    VERSION = 1  # TELEMETRY_VERSION, 0 until first written
+    PID = 2  # Planner process
+    STAMP = 3  # Time of the last update, unix time (double)
+    STEP_CAL = 4  # steps/mm (double)
+    CMD = 5  # Commands of the job run so far
+    N_CMDS = 6  # Commands in the job
+    FLAGS = 7  # FLAG_* bits
+    HEAD = 8  # Head state, hd.HEAD_* words from here
+    N_FIELDS = HEAD + hd.HEAD_WORDS
+
+FLAG_LASER = 0x1  # Laser enabled (M3)
+FLAG_HOMED = 0x2
+FLAG_MOTORS = 0x4  # Motors enabled
+FLAG_RUNNING = 0x8  # Job running
+
+# Read attempts before giving up on a writer stuck mid-write, and attempts
+# spent spinning before sleeping between them, to let a writer that was
+# preempted mid-write finish
+READ_TRIES = 1000
+READ_SPINS = 100
+
+
+cdef class TelemetryRecord:
+    """ A seqlock record of machine state in a file mapped into memory,
+    normally in /dev/shm. One process writes it with publish() and
+    publish_head(), and the step loops with publish_steps(); any number read
+    it with read().
+    """
+
+    cdef long long *rec
+    cdef bint writer
+    cdef bint stepping  # Step loops publish to this record
+
+    def __cinit__(self, path=TELEMETRY_PATH, bint writer=False):
+        """ Map a telemetry record.
+
+        Raises IOError if the record can't be opened or mapped.
+
+        :param path: Record file. The writer creates it if needed.
+        :type: string
+        :param writer: True to map it for publish(), False to only read()
+        :type: bool
+        """
+
+        cdef size_t size = N_FIELDS * sizeof(long long)
+        path = path.encode("utf-8") if isinstance(path, unicode) else path
+        cdef int fd = open(path, O_RDWR | O_CREAT if writer else O_RDONLY,
+                           0o644)
+        if fd < 0:
+            raise IOError("Could not open telemetry record " + path)
+        if writer and ftruncate(fd, size) != 0:
+            close(fd)
+            raise IOError("Could not size telemetry record " + path)
+        cdef void *buf = mmap(NULL, size,
+                              PROT_READ | PROT_WRITE if writer else PROT_READ,
+                              MAP_SHARED, fd, 0)
+        close(fd)
+        if buf == MAP_FAILED:
+            raise IOError("Could not map telemetry record " + path)
+        self.rec = <long long *>buf
+        self.writer = writer
+
+
+    def __dealloc__(self):
+        if self.stepping:
+            hd.set_head_state(NULL)
+        if self.rec != NULL:
+            munmap(self.rec, N_FIELDS * sizeof(long long))
+
+
+    cpdef publish(self, long cmd, long n_cmds, int flags, double step_cal):
+        """ Update the job part of the record.
+
+        :param cmd: Commands of the job run so far
+        :type: long
+        :param n_cmds: Commands in the job
+        :type: long
+        :param flags: FLAG_* bits
+        :type: int
+        :param step_cal: steps/mm, to turn head steps into mm
+        :type: double
+        :return: void
+        """
+
+        if not self.writer:
+            raise IOError("Telemetry record not opened for writing")
+        cdef long long seq = self.rec[SEQ]
+        atomic_store(&self.rec[SEQ], seq + 1, ATOMIC_RELAXED)
+        atomic_fence(ATOMIC_RELEASE)  # Odd before any field changes
+
+        self.rec[VERSION] = TELEMETRY_VERSION
+        self.rec[PID] = os.getpid()
+        (<double *>&self.rec[STAMP])[0] = time.time()
+        (<double *>&self.rec[STEP_CAL])[0] = step_cal
+        self.rec[CMD] = cmd
+        self.rec[N_CMDS] = n_cmds
+        self.rec[FLAGS] = flags
+
+        atomic_store(&self.rec[SEQ], seq + 2, ATOMIC_RELEASE)
+
+
+    cpdef publish_head(self, long a, long b, long cmd, int switches):
+        """ Update the head part of the record, with the laser off. Only call
+        while nothing is stepping; the step loops count on from here.
+
+        :param a: A position in steps
+        :type: long
+        :param b: B position in steps
+        :type: long
+        :param cmd: Job command the next moves come from
+        :type: long
+        :param switches: Switch values, see hardwareDriver.read_switches()
+        :type: int
+        :return: void
+        """
+
+        if not self.writer:
+            raise IOError("Telemetry record not opened for writing")
+        cdef long long *head = self.rec + HEAD
+        cdef long long seq = head[hd.HEAD_SEQ]
+        atomic_store(&head[hd.HEAD_SEQ], seq + 1, ATOMIC_RELAXED)
+        atomic_fence(ATOMIC_RELEASE)  # Odd before any field changes
+
+        head[hd.HEAD_A] = a
+        head[hd.HEAD_B] = b
+        head[hd.HEAD_CMD] = cmd
+        head[hd.HEAD_LASER] = 0
+        head[hd.HEAD_SWITCHES] = switches
+
+        atomic_store(&head[hd.HEAD_SEQ], seq + 2, ATOMIC_RELEASE)
+
+
+    cpdef publish_steps(self):
+        """ Have the step loops of this process, and of motion processes
+        forked after this, publish every step to the head part of the record,
+        see hardwareDriver.set_head_state().
+
+        :return: void
+        """
+
+        if not self.writer:
+            raise IOError("Telemetry record not opened for writing")
+        hd.set_head_state(self.rec + HEAD)
+        self.stepping = True
+
+
+    cpdef read(self):
+        """ Read a consistent copy of each part of the record.
+
+        Raises IOError if a writer stayed mid-write for READ_TRIES tries,
+        about 0.1s, e.g. if it died there.
+
+        :return: pid, stamp (unix time), x, y (mm), cmd, n_cmds, progress
+        (fraction of commands run), laser (enabled), homed, motors, running,
+        firing (bools), head_cmd (job command being stepped), switches; None
+        if nothing was published yet
+        :rtype: dict
+        """
+
+        cdef long long copy[N_FIELDS]
+        self._copy(copy, SEQ, HEAD)
+        self._copy(copy, HEAD + hd.HEAD_SEQ, hd.HEAD_WORDS)
+
+        if copy[VERSION] == 0:
+            return None
+        if copy[VERSION] != TELEMETRY_VERSION:
+            raise IOError("Telemetry record version " + str(copy[VERSION])
+                          + ", expected " + str(TELEMETRY_VERSION))
+        flags = copy[FLAGS]
+        cdef double step_cal = (<double *>&copy[STEP_CAL])[0]
+        cdef long long a = copy[HEAD + hd.HEAD_A], b = copy[HEAD + hd.HEAD_B]
+        return {"pid": copy[PID],
+                "stamp": (<double *>&copy[STAMP])[0],
+                "x": 0.5*(a + b) / step_cal if step_cal else 0.,
+                "y": 0.5*(a - b) / step_cal if step_cal else 0.,
+                "cmd": copy[CMD],
+                "n_cmds": copy[N_CMDS],
+                "progress": copy[CMD] / float(copy[N_CMDS]) if copy[N_CMDS]
+                else 0.,
+                "laser": bool(flags & FLAG_LASER),
+                "homed": bool(flags & FLAG_HOMED),
+                "motors": bool(flags & FLAG_MOTORS),
+                "running": bool(flags & FLAG_RUNNING),
+                "firing": bool(copy[HEAD + hd.HEAD_LASER]),
+                "head_cmd": copy[HEAD + hd.HEAD_CMD],
+                "switches": copy[HEAD + hd.HEAD_SWITCHES]}
+
+
+    cdef _copy(self, long long *copy, int start, int n):
+        """ Copy the n words of one seqlock part of the record, sequence
+        number first, once they're consistent. Raises IOError if its writer
+        stays mid-write, see read(). """
+
+        cdef long long seq
+        cdef int i, tries
+        for tries in range(READ_TRIES):
+            if tries >= READ_SPINS:
+                usleep(1)
+            seq = atomic_load(&self.rec[start], ATOMIC_ACQUIRE)
+            if seq & 1:
+                continue
+            for i in range(start + 1, start + n):
+                copy[i] = self.rec[i]
+            atomic_fence(ATOMIC_ACQUIRE)  # Fields read before checking
+            if atomic_load(&self.rec[start], ATOMIC_RELAXED) == seq:
+                return
+        raise IOError("Telemetry record busy")
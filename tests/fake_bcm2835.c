@@ -0,0 +1,246 @@
+/*
+ * fake_bcm2835.c
+ * A simulated bcm2835 library, for testing hardwareDriver without a Pi. See
+ * fakehw.py, which builds it and the Cython modules against it.
+ *
+ * Simulates the H-bot head and its switches. Each rising STEP edge moves the
+ * motor's A or B step count by one in its DIR direction, while the motors are
+ * enabled (EN low). Switches are active low, like the real ones. XMIN is
+ * pressed while x2 <= its edge, and released once x2 is more than its
+ * hysteresis past it, where x2 = A + B is twice the X position in steps; YMIN
+ * the same with y2 = A - B. XMAX, YMAX and SAFE_FEET are only pressed by
+ * fake_press(). Falling edges latch in GPEDS0 for pins with fen enabled.
+ *
+ * The head position is logged each time the switches are read after it
+ * moved, which the step loops do once per step. Laser pulses are counted.
+ */
+
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include "bcm2835.h"
+
+/* Pins, see hardwareDriver.pyx */
+#define A_EN 2
+#define A_STEP 3
+#define A_DIR 4
+#define B_EN 14
+#define B_STEP 15
+#define B_DIR 18
+#define LAS 7
+#define XMIN 27
+#define XMAX 22
+#define YMIN 9
+#define YMAX 10
+#define SAFE_FEET 11
+
+/* Register word offsets */
+#define GPSET0 (0x1c / 4)
+#define GPCLR0 (0x28 / 4)
+#define GPLEV0 (0x34 / 4)
+#define GPEDS0 (0x40 / 4)
+
+#define LOG_SIZE 1000000
+
+static uint32_t regs[64];
+volatile uint32_t *bcm2835_gpio = 0;
+
+static uint32_t out;  /* Output pin levels */
+static uint32_t fen;  /* Pins with falling edge detect enabled */
+static uint32_t forced;  /* Pins held pressed by fake_press */
+static long pos_a, pos_b;
+static long x_edge, x_hyst, y_edge, y_hyst;
+static int x_pressed, y_pressed;
+
+static long n_log;
+static long log_a[LOG_SIZE], log_b[LOG_SIZE];
+static long long log_t[LOG_SIZE];
+static int log_las[LOG_SIZE];
+static int moved;
+static long laser_pulses;  /* Rising edges of LAS */
+
+
+static long long mono_nsec(void)
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec * 1000000000LL + now.tv_nsec;
+}
+
+
+/* Recompute the pin levels from the outputs and the head position, latching
+ * falling edges */
+static void update(void)
+{
+    long x2 = pos_a + pos_b, y2 = pos_a - pos_b;
+    uint32_t old = regs[GPLEV0], lev, pressed;
+
+    if (x2 <= x_edge)
+        x_pressed = 1;
+    else if (x2 > x_edge + x_hyst)
+        x_pressed = 0;
+    if (y2 <= y_edge)
+        y_pressed = 1;
+    else if (y2 > y_edge + y_hyst)
+        y_pressed = 0;
+
+    pressed = forced | (x_pressed ? 1u << XMIN : 0)
+              | (y_pressed ? 1u << YMIN : 0);
+    lev = out;
+    lev |= ((1u << XMIN) | (1u << XMAX) | (1u << YMIN) | (1u << YMAX)
+            | (1u << SAFE_FEET)) & ~pressed;
+    regs[GPLEV0] = lev;
+    regs[GPEDS0] |= old & ~lev & fen;
+}
+
+
+static void log_position(void)
+{
+    if (!moved || n_log >= LOG_SIZE)
+        return;
+    log_a[n_log] = pos_a;
+    log_b[n_log] = pos_b;
+    log_t[n_log] = mono_nsec();
+    log_las[n_log] = (out >> LAS) & 1;
+    n_log++;
+    moved = 0;
+}
+
+
+static void set_out(uint32_t mask)
+{
+    uint32_t rising = mask & ~out;
+    out |= mask;
+    laser_pulses += (rising >> LAS) & 1;
+    if ((rising >> A_STEP) & 1 && !((out >> A_EN) & 1)) {
+        pos_a += (out >> A_DIR) & 1 ? 1 : -1;
+        moved = 1;
+    }
+    if ((rising >> B_STEP) & 1 && !((out >> B_EN) & 1)) {
+        pos_b += (out >> B_DIR) & 1 ? 1 : -1;
+        moved = 1;
+    }
+    update();
+}
+
+
+static void clr_out(uint32_t mask)
+{
+    out &= ~mask;
+    update();
+}
+
+
+/* Library functions used by hardwareDriver */
+
+int bcm2835_init(void)
+{
+    bcm2835_gpio = regs;
+    update();
+    return 1;
+}
+
+int bcm2835_close(void) { return 1; }
+void bcm2835_set_debug(uint8_t debug) { (void)debug; }
+
+uint32_t bcm2835_peri_read(volatile uint32_t *paddr)
+{
+    if (paddr == regs + GPLEV0 || paddr == regs + GPEDS0)
+        log_position();
+    return *paddr;
+}
+
+void bcm2835_peri_write(volatile uint32_t *paddr, uint32_t value)
+{
+    if (paddr == regs + GPEDS0)
+        regs[GPEDS0] &= ~value;  /* Write 1 to clear */
+    else if (paddr == regs + GPSET0)
+        set_out(value);
+    else if (paddr == regs + GPCLR0)
+        clr_out(value);
+    else
+        *paddr = value;
+}
+
+void bcm2835_gpio_fsel(uint8_t pin, uint8_t mode) { (void)pin; (void)mode; }
+void bcm2835_gpio_set(uint8_t pin) { set_out(1u << pin); }
+void bcm2835_gpio_clr(uint8_t pin) { clr_out(1u << pin); }
+void bcm2835_gpio_set_multi(uint32_t mask) { set_out(mask); }
+void bcm2835_gpio_clr_multi(uint32_t mask) { clr_out(mask); }
+
+void bcm2835_gpio_write(uint8_t pin, uint8_t on)
+{
+    if (on)
+        set_out(1u << pin);
+    else
+        clr_out(1u << pin);
+}
+
+uint8_t bcm2835_gpio_lev(uint8_t pin) { return (regs[GPLEV0] >> pin) & 1; }
+void bcm2835_gpio_set_pud(uint8_t pin, uint8_t pud) { (void)pin; (void)pud; }
+uint8_t bcm2835_gpio_eds(uint8_t pin) { return (regs[GPEDS0] >> pin) & 1; }
+void bcm2835_gpio_set_eds(uint8_t pin) { regs[GPEDS0] &= ~(1u << pin); }
+void bcm2835_gpio_fen(uint8_t pin) { fen |= 1u << pin; }
+void bcm2835_gpio_clr_fen(uint8_t pin) { fen &= ~(1u << pin); }
+void bcm2835_gpio_ren(uint8_t pin) { (void)pin; }
+void bcm2835_gpio_clr_ren(uint8_t pin) { (void)pin; }
+void bcm2835_gpio_hen(uint8_t pin) { (void)pin; }
+void bcm2835_gpio_clr_hen(uint8_t pin) { (void)pin; }
+void bcm2835_gpio_len(uint8_t pin) { (void)pin; }
+void bcm2835_gpio_clr_len(uint8_t pin) { (void)pin; }
+void bcm2835_delay(unsigned int millis) { usleep(millis * 1000); }
+void bcm2835_delayMicroseconds(unsigned int micros) { usleep(micros); }
+
+
+/* Test interface */
+
+/* Put the head at A, B steps, with the home switch edges at 0 and no
+ * hysteresis, nothing else pressed, and an empty log */
+void fake_reset(long a, long b)
+{
+    pos_a = a;
+    pos_b = b;
+    x_edge = x_hyst = y_edge = y_hyst = 0;
+    x_pressed = y_pressed = 0;
+    forced = 0;
+    regs[GPEDS0] = 0;
+    n_log = 0;
+    moved = 0;
+    laser_pulses = 0;
+    update();
+}
+
+/* Move the XMIN and YMIN edges, in x2 = A + B and y2 = A - B */
+void fake_set_home_switches(long x_edge_, long x_hyst_, long y_edge_,
+                            long y_hyst_)
+{
+    x_edge = x_edge_;
+    x_hyst = x_hyst_;
+    y_edge = y_edge_;
+    y_hyst = y_hyst_;
+    update();
+}
+
+/* Hold a switch pin pressed, or let go of it */
+void fake_press(int pin, int pressed)
+{
+    if (pressed)
+        forced |= 1u << pin;
+    else
+        forced &= ~(1u << pin);
+    update();
+}
+
+long fake_a(void) { return pos_a; }
+long fake_b(void) { return pos_b; }
+long fake_log_len(void) { return n_log; }
+long fake_laser_pulses(void) { return laser_pulses; }
+
+void fake_log_entry(long i, long *a, long *b, long long *t_ns, int *las)
+{
+    *a = log_a[i];
+    *b = log_b[i];
+    *t_ns = log_t[i];
+    *las = log_las[i];
+}
@@ -0,0 +1,52 @@
+"""
+fakecutter.py
+Simulated laser cutters for the job dispatcher, see factory(). Import after
+fakehw.load(), since GcodeInterface needs hardwareDriver.
+"""
+
+import functools
+import os
+import time
+
+from GcodeInterface import GcodeInterface
+
+
+class SimulatedCutter(GcodeInterface):
+    """ A dry run GcodeInterface that takes as long to run a program as it
+    is estimated to, scaled by time_scale, and can be made to crash. """
+
+    def __init__(self, time_scale, crashes=None):
+        """ Make a simulated cutter.
+
+        :param time_scale: Seconds slept per estimated second of a program
+        :type: double
+        :param crashes: Number of programs left to crash on, shared by all
+        the cutters. Crashing exits the worker process at the start of the
+        program, as if the cutter's process died.
+        :type: multiprocessing.Value('i')
+        """
+
+        GcodeInterface.__init__(self, dry_run=True)
+        self.time_scale = time_scale
+        self.crashes = crashes
+
+
+    def run_program(self, program):
+        if self.crashes is not None:
+            with self.crashes.get_lock():
+                crash = self.crashes.value > 0
+                if crash:
+                    self.crashes.value -= 1
+            if crash:
+                os._exit(1)
+
+        before = sum(self.dry_run_times.values())
+        GcodeInterface.run_program(self, program)
+        time.sleep((sum(self.dry_run_times.values()) - before)
+                   * self.time_scale)
+
+
+def factory(time_scale=0.1, crashes=None):
+    """ Machine factory for JobDispatcher, see SimulatedCutter. """
+
+    return functools.partial(SimulatedCutter, time_scale, crashes)
@@ -0,0 +1,165 @@
+"""
+fakehw.py
+The Cython modules built against a simulated bcm2835 library
+(fake_bcm2835.c), so the real motion code can run and be checked without a
+Pi.
+
+load() builds them into a temporary directory, once per version of the
+sources, and puts that first on sys.path, so hardwareDriver and everything
+that imports it run on the simulated machine. It needs a C compiler and
+Cython, and skips the calling test without them.
+"""
+
+import ctypes
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from fakes import REPO_DIR
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_SOURCE = os.path.join(TESTS_DIR, "fake_bcm2835.c")
+
+# Copied to the build directory
+SOURCES = ["setup.py", "bcm2835.h", "hardwareDriver.pyx", "hardwareDriver.pxd",
+           "HManHelper.pyx", "ipsDither.pyx", "motionRing.pyx",
+           "telemetry.pyx", "planFile.pyx"]
+
+_fake = None
+
+
+class FakeBcm2835(object):
+    """ Test side of the simulated library, see fake_bcm2835.c. Positions
+    are motor steps, and switch edges are in x2 = A + B and y2 = A - B,
+    twice the X and Y positions in steps. """
+
+    def __init__(self, lib):
+        self.lib = lib
+        lib.fake_reset.argtypes = [ctypes.c_long, ctypes.c_long]
+        lib.fake_set_home_switches.argtypes = [ctypes.c_long] * 4
+        lib.fake_press.argtypes = [ctypes.c_int, ctypes.c_int]
+        lib.fake_a.restype = lib.fake_b.restype = ctypes.c_long
+        lib.fake_log_len.restype = ctypes.c_long
+        lib.fake_laser_pulses.restype = ctypes.c_long
+
+
+    def reset(self, a=0, b=0):
+        """ Put the head at a, b steps, with default switches and an empty
+        log. """
+
+        self.lib.fake_reset(a, b)
+
+
+    def set_home_switches(self, x_edge, x_hyst, y_edge, y_hyst):
+        self.lib.fake_set_home_switches(x_edge, x_hyst, y_edge, y_hyst)
+
+
+    def press(self, pin, pressed=True):
+        self.lib.fake_press(pin, pressed)
+
+
+    def position(self):
+        """ Head position as (a, b) steps. """
+
+        return self.lib.fake_a(), self.lib.fake_b()
+
+
+    def laser_pulses(self):
+        """ Number of times the laser was turned on since reset(). """
+
+        return self.lib.fake_laser_pulses()
+
+
+    def log(self):
+        """ Head positions logged once per step.
+
+        :return: (a, b, time in ns, laser on) for each step
+        :rtype: list of tuples
+        """
+
+        a, b = ctypes.c_long(), ctypes.c_long()
+        t_ns, las = ctypes.c_longlong(), ctypes.c_int()
+        entries = []
+        for i in range(self.lib.fake_log_len()):
+            self.lib.fake_log_entry(ctypes.c_long(i), ctypes.byref(a),
+                                    ctypes.byref(b), ctypes.byref(t_ns),
+                                    ctypes.byref(las))
+            entries.append((a.value, b.value, t_ns.value, las.value))
+        return entries
+
+
+def _build(build_dir):
+    """ Build the fake library and the Cython modules in build_dir. """
+
+    tmp_dir = tempfile.mkdtemp(prefix=build_dir + "-")
+    try:
+        subprocess.check_call(["cc", "-shared", "-fPIC", "-O2",
+                               "-I" + REPO_DIR, "-o",
+                               os.path.join(tmp_dir, "libbcm2835.so"),
+                               FAKE_SOURCE])
+        for name in SOURCES:
+            shutil.copy(os.path.join(REPO_DIR, name), tmp_dir)
+        env = dict(os.environ, CFLAGS="-w",
+                   LDFLAGS="-L{0} -Wl,-rpath,{1}".format(tmp_dir, build_dir))
+        proc = subprocess.Popen([sys.executable, "setup.py", "build_ext",
+                                 "--inplace"], cwd=tmp_dir, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError("Building against fake_bcm2835 failed:\n"
+                               + output.decode(errors="replace")[-3000:])
+        try:
+            os.rename(tmp_dir, build_dir)
+        except OSError:
+            if not os.path.isdir(build_dir):  # Not just built by another run
+                raise
+            shutil.rmtree(tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load():
+    """ Build the modules against the simulated machine if needed, and put
+    them first on sys.path. Call before importing hardwareDriver or any
+    module that uses it.
+
+    :return: The simulated library
+    :rtype: FakeBcm2835
+    """
+
+    global _fake
+    if _fake is not None:
+        return _fake
+    try:
+        import Cython
+    except ImportError:
+        raise unittest.SkipTest("Cython isn't installed")
+    if not any(os.access(os.path.join(path, "cc"), os.X_OK)
+               for path in os.environ.get("PATH", "").split(os.pathsep)):
+        raise unittest.SkipTest("No C compiler")
+
+    digest = hashlib.sha1(sys.version.encode() + Cython.__version__.encode())
+    for path in [FAKE_SOURCE] + [os.path.join(REPO_DIR, name)
+                                 for name in SOURCES]:
+        with open(path, "rb") as infile:
+            digest.update(infile.read())
+    build_dir = os.path.join(tempfile.gettempdir(),
+                             "lasercutter-fakehw-" + digest.hexdigest()[:12])
+    if not os.path.isdir(build_dir):
+        _build(build_dir)
+
+    for name in ("hardwareDriver", "HManHelper", "motionRing", "planFile",
+                 "telemetry", "ipsDither"):
+        if name in sys.modules and not getattr(
+                sys.modules[name], "__file__", "").startswith(build_dir):
+            raise RuntimeError(name + " was imported before fakehw.load()")
+    sys.path.insert(0, build_dir)
+    _fake = FakeBcm2835(ctypes.CDLL(os.path.join(build_dir,
+                                                 "libbcm2835.so")))
+    return _fake
@@ -0,0 +1,111 @@
+"""
+fakes.py
+Stand-ins for the laser cutter's hardware, for testing without a Pi.
+
+Importing this puts the repository root on sys.path, so tests run from
+anywhere with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(1, REPO_DIR)
+
+
+class FakeGantry(object):
+    """ Just enough of a GcodeInterface for scanBlock: tracks the head
+    position through G28/G90/G0, and logs the moves. """
+
+    def __init__(self):
+        self.homed = False
+        self.x, self.y = 0.0, 0.0
+        self.moves = []
+
+
+    def G28(self):
+        self.homed = True
+        self.x, self.y = 0.0, 0.0
+
+
+    def G90(self):
+        pass
+
+
+    def G0(self, X=None, Y=None, F=None):
+        self.x = self.x if X is None else X
+        self.y = self.y if Y is None else Y
+        self.moves.append((self.x, self.y))
+
+
+class FakeCamera(object):
+    """ A picamera stand-in that "sees" part of a known scene picture around
+    the head position, and captures it as a raw YUV420 frame the way
+    picamera does: Y plane padded to 32 columns and 16 rows, then the U and V
+    planes.
+
+    The sensor is mounted rotated, so the captured frame is the view turned
+    clockwise by rotation degrees; scanBlock turns it back.
+
+    Views can be offset by a few pixels at some head positions, like a head
+    that stops slightly off where it was sent.
+    """
+
+    def __init__(self, scene, gantry, px_per_mm, rotation=90, offsets=None):
+        """ Point a fake camera at a scene.
+
+        :param scene: Greyscale bed picture, row 0 at Y = 0
+        :type: numpy.ndarray
+        :param gantry: Anything with the head position as x and y in mm
+        :type: FakeGantry
+        :param px_per_mm: Scene pixels per mm in X and Y
+        :type: (double, double)
+        :param rotation: Sensor rotation, a multiple of 90 degrees
+        :type: int
+        :param offsets: Scene (rows, columns) offset of the view at some head
+        positions, by (x, y) in mm
+        :type: dict[(double, double): (int, int)]
+        """
+
+        self.scene = scene
+        self.gantry = gantry
+        self.px_per_mm = px_per_mm
+        self.rotation = rotation
+        self.offsets = offsets or {}
+        self.resolution = (160, 120)
+        self.captures = []  # Head position of each capture
+        self.closed = False
+
+
+    def view_corner(self, x, y):
+        """ Scene (top, left) pixel of the view with the head at x, y. """
+
+        dy, dx = self.offsets.get((x, y), (0, 0))
+        return (int(round(y * self.px_per_mm[1])) + dy,
+                int(round(x * self.px_per_mm[0])) + dx)
+
+
+    def capture(self, output, format="jpeg"):
+        assert format == "yuv" and not self.closed
+        width, height = self.resolution
+        view_w, view_h = (height, width) if self.rotation % 180 \
+            else (width, height)
+        top, left = self.view_corner(self.gantry.x, self.gantry.y)
+        view = self.scene[top:top + view_h, left:left + view_w]
+        assert view.shape == (view_h, view_w), "View off the scene"
+
+        raw_width = (width + 31) // 32 * 32
+        raw_height = (height + 15) // 16 * 16
+        y_plane = np.zeros((raw_height, raw_width), dtype=np.uint8)
+        y_plane[:height, :width] = np.rot90(view, -(self.rotation // 90))
+        chroma = np.full(raw_width * raw_height // 2, 128, dtype=np.uint8)
+        output.write(y_plane.tobytes() + chroma.tobytes())
+        self.captures.append((self.gantry.x, self.gantry.y))
+
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,71 @@
+"""
+Tests for GcodeInterface, in dry run mode.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakehw
+
+
+class ParseGcodeTest(unittest.TestCase):
+
+    def setUp(self):
+        fakehw.load()
+        import GcodeInterface
+        self.gman = GcodeInterface.GcodeInterface(dry_run=True)
+        self.tmp_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _gcode(self, text):
+        filename = os.path.join(self.tmp_dir, "job.gcode")
+        with open(filename, "w") as outfile:
+            outfile.write(text)
+        return filename
+
+
+    def test_profile_written(self):
+        profile_file = os.path.join(self.tmp_dir, "profile.json")
+        self.gman.parse_gcode(self._gcode("G28\nG0 X10 Y10\n"), profile_file)
+        self.assertTrue(os.path.exists(profile_file))
+
+
+    def test_profile_written_for_failed_job(self):
+        profile_file = os.path.join(self.tmp_dir, "profile.json")
+        with self.assertRaises(RuntimeError):
+            self.gman.parse_gcode(self._gcode("G28\nG0 X1000\n"),
+                                  profile_file)
+        self.assertTrue(os.path.exists(profile_file))
+
+
+    def test_profile_error_keeps_job_error(self):
+        profile_file = os.path.join(self.tmp_dir, "missing", "profile.json")
+        with self.assertRaises(RuntimeError):
+            self.gman.parse_gcode(self._gcode("G28\nG0 X1000\n"),
+                                  profile_file)
+        with self.assertRaises(IOError):
+            self.gman.parse_gcode(self._gcode("G28\nG0 X10\n"),
+                                  profile_file)
+
+
+    def test_arc_end_on_circle(self):
+        self.gman.parse_gcode(self._gcode("G28\nG0 X10 Y10\n"
+                                          "G2 X20 Y10 I5\n"
+                                          "G3 X10 Y10 I-5.002 J0\n"))
+        self.assertAlmostEqual(self.gman.x, 10)
+
+
+    def test_arc_end_off_circle(self):
+        with self.assertRaises(RuntimeError):
+            self.gman.parse_gcode(self._gcode("G28\nG0 X10 Y10\n"
+                                              "G2 X20 Y10 I4 J0\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests for hardwareDriver, on the simulated machine.
+"""
+
+import os
+import unittest
+
+import fakehw
+
+
+def _allowed_cpus():
+    """ CPUs this process may run on, from /proc. """
+
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("Cpus_allowed_list:"):
+                break
+    cpus = set()
+    for span in line.split(":")[1].strip().split(","):
+        first, _, last = span.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class RealtimeTest(unittest.TestCase):
+
+    def setUp(self):
+        fakehw.load()
+        import hardwareDriver
+        self.hd = hardwareDriver
+        if os.geteuid() != 0:
+            self.skipTest("Real-time mode needs root")
+        if len(_allowed_cpus()) < 2:
+            self.skipTest("Pinning needs more than one CPU")
+
+
+    def test_disable_restores_affinity(self):
+        cpus = _allowed_cpus()
+        self.assertEqual(self.hd.set_realtime(1, max(cpus)), 0)
+        try:
+            self.assertEqual(_allowed_cpus(), {max(cpus)})
+        finally:
+            self.hd.set_realtime(0)  # Default cpu, -1
+        self.assertEqual(_allowed_cpus(), cpus)
+
+
+class BenchStepLoopTest(unittest.TestCase):
+
+    def test_nothing_moves_or_fires(self):
+        fake = fakehw.load()
+        import hardwareDriver
+        fake.reset(a=300, b=100)
+        self.assertEqual(hardwareDriver.gpio_init(), 0)
+        times = hardwareDriver.bench_step_loop(1000)
+        self.assertEqual(sorted(times), ["move_laser", "read_switches"])
+        self.assertEqual(fake.position(), (300, 100))
+        self.assertEqual(fake.laser_pulses(), 0)
+
+
+class SwitchEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = fakehw.load()
+        import GcodeInterface
+        import HManHelper
+        import hardwareDriver
+        self.hd = hardwareDriver
+        self.HMH = HManHelper
+        self.fake.reset(a=300, b=100)
+        self.gman = GcodeInterface.GcodeInterface()
+        self.hd.switch_events(1)
+
+
+    def tearDown(self):
+        self.hd.switch_events(0)
+        del self.gman
+
+
+    def test_move_after_homing(self):
+        # Homing presses both switches, which must not stop the moves after
+        # it, starting with its own back off
+        self.assertEqual(self.gman.home_xy(), 0)
+        start = self.fake.position()
+        self.assertEqual(self.HMH.laser_cut(self.gman, 5, 5, "blank"), 0)
+        a, b = self.fake.position()
+        self.assertEqual((a - start[0], b - start[1]),
+                         (2 * 5 * self.gman.step_cal, 0))
+
+
+    def test_press_during_move(self):
+        self.assertEqual(self.gman.home_xy(), 0)
+        self.assertEqual(self.HMH.laser_cut(self.gman, 10, 0, "blank"), 0)
+        a, b = self.fake.position()
+        # XMIN now 3 mm back, pressed mid-move on the way back
+        edge = a + b - 2 * 3 * self.gman.step_cal
+        self.fake.set_home_switches(edge, 0, -1000, 0)
+        self.assertNotEqual(self.HMH.laser_cut(self.gman, -10, 0, "blank"),
+                            0)
+        a, b = self.fake.position()
+        self.assertEqual(a + b, edge)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests for the homing cycle, HManHelper.home_xy, on the simulated machine.
+"""
+
+import unittest
+
+import fakehw
+
+
+class HomingTest(unittest.TestCase):
+
+    # Switch edges in x2 = A + B and y2 = A - B steps. The switches have
+    # different hysteresis, so X releases on its first step back, and Y on
+    # its fourth.
+    X_HYST, Y_HYST = 0, 6
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = fakehw.load()
+        import HManHelper
+        cls.HMH = HManHelper
+
+
+    def setUp(self):
+        import GcodeInterface
+        self.fake.reset(a=300, b=100)  # X = 20 mm, Y = 10 mm
+        self.fake.set_home_switches(0, self.X_HYST, 0, self.Y_HYST)
+        self.gman = GcodeInterface.GcodeInterface()
+
+
+    def tearDown(self):
+        del self.gman
+
+
+    def test_home_position(self):
+        self.assertEqual(self.gman.home_xy(), 0)
+        self.assertTrue(self.gman.homed)
+        self.assertEqual((self.gman.x, self.gman.y), (0, 0))
+
+        # (0,0) is HOME_OFFSET out from the release edges, one step past
+        # each edge's hysteresis
+        offset = 2 * self.HMH.HOME_OFFSET * self.gman.step_cal
+        x2, y2 = self._x2_y2(self.fake.position())
+        self.assertEqual(x2, self.X_HYST + 1 + offset)
+        self.assertEqual(y2, self.Y_HYST + 1 + offset)
+
+
+    def test_align_in_one_continuous_approach(self):
+        self.assertEqual(self.gman.home_xy(), 0)
+        approach = self._last_approach(self.fake.log())
+
+        # Both axes step together until X triggers, then Y carries on alone
+        # (2 y2 per step) and stops on its own edge
+        path = [self._x2_y2(entry) for entry in approach]
+        offset = 2 * self.HMH.HOME_OFFSET * self.gman.step_cal
+        x_start = self.X_HYST + 1 + offset
+        self.assertEqual(path[0], (x_start, self.Y_HYST + 1 + offset))
+        self.assertEqual(path[x_start], (0, self.Y_HYST))
+        self.assertEqual(path[x_start:], [(0, y2) for y2 in
+                                          range(self.Y_HYST, -1, -2)])
+
+        # At ALIGN_SPD the whole way, with no stop between the axes
+        period = 1e9 / (self.HMH.ALIGN_SPD * self.gman.step_cal)
+        steps = approach[1:]
+        for prev, entry in zip(steps, steps[1:]):
+            self.assertAlmostEqual(entry[2] - prev[2], period,
+                                   delta=0.5 * period)
+
+
+    @staticmethod
+    def _x2_y2(entry):
+        return entry[0] + entry[1], entry[0] - entry[1]
+
+
+    def _last_approach(self, log):
+        """ Steps of the last run in the log that moves toward both
+        switches, the alignment re-approach, after the position it
+        started from. """
+
+        end = None
+        for i in range(len(log) - 1, 0, -1):
+            x2, y2 = self._x2_y2(log[i])
+            prev_x2, prev_y2 = self._x2_y2(log[i - 1])
+            toward = x2 <= prev_x2 and y2 <= prev_y2
+            if end is None and toward:
+                end = i + 1
+            elif end is not None and not toward:
+                return log[i:end]
+        self.fail("No approach in the step log")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Tests for ipsRaster.gen_gcode's engraving passes.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import fakehw
+
+
+class GenGcodeTest(unittest.TestCase):
+
+    def setUp(self):
+        fakehw.load()
+        import ipsRaster
+        self.ipsRaster = ipsRaster
+        self.tmp_dir = tempfile.mkdtemp()
+        # A dark run in each row, further right each row
+        self.pix = np.full((4, 12), 255, dtype=np.uint8)
+        for row in range(4):
+            self.pix[row, 2 * row + 1:2 * row + 4] = 0
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _passes(self, scaling):
+        """ (y, x start, x end) of each cutting pass, in mm. """
+
+        filename = os.path.join(self.tmp_dir, "raster.gcode")
+        self.ipsRaster.gen_gcode(filename, Image.fromarray(self.pix),
+                                 {"scaling": scaling, "travel_feed": 6000,
+                                  "cut_feed": 180, "bed_xmax": 250,
+                                  "bed_ymax": 280, "step_cal": 10})
+        with open(filename) as infile:
+            moves = re.findall(r"^G([01]) X(\S+) Y(\S+)", infile.read(),
+                               re.MULTILINE)
+        passes = []
+        for (g0, x0, y0), (g1, x1, y1) in zip(moves[::2], moves[1::2]):
+            self.assertEqual((g0, g1, y0), ("0", "1", y1))
+            passes.append((float(y0), float(x0), float(x1)))
+        return passes
+
+
+    def test_coarse_rows_on_every_step_row(self):
+        # 5 dots/mm on 10 steps/mm: each image row covers 2 step rows
+        passes = self._passes(5)
+        self.assertEqual([y for y, x0, x1 in passes],
+                         [k / 10. for k in range(8)])
+        for y, x0, x1 in passes:
+            # Pixel before the row's first dark one to the end of its last,
+            # of the mask row the laser reads there
+            row = int(y * 5 + 1e-6)
+            self.assertAlmostEqual(x0, 0.2 * (2 * row))
+            self.assertAlmostEqual(x1, 0.2 * (2 * row + 4))
+
+
+    def test_fine_rows_merged(self):
+        # 20 dots/mm on 10 steps/mm: image rows 1 and 2 share a step row
+        passes = self._passes(20)
+        self.assertEqual(passes, [(0., 0., 0.2), (0.1, 0.1, 0.4),
+                                  (0.2, 0.3, 0.5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
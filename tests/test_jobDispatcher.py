@@ -0,0 +1,84 @@
+"""
+Tests for jobDispatcher, on simulated cutters.
+"""
+
+from multiprocessing import Value
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakehw
+
+
+class JobDispatcherTest(unittest.TestCase):
+
+    # X travel of each job, out and back. Run first come first served, the
+    # machines would finish further apart than test_balanced_by_estimate
+    # allows.
+    LENGTHS = [90, 60, 40, 30, 200, 150, 120]
+
+    def setUp(self):
+        fakehw.load()
+        import fakecutter
+        import jobDispatcher
+        self.factory = fakecutter.factory
+        self.JobDispatcher = jobDispatcher.JobDispatcher
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gcode = []
+        for i, length in enumerate(self.LENGTHS):
+            filename = os.path.join(self.tmp_dir, "job{}.gcode".format(i))
+            with open(filename, "w") as outfile:
+                outfile.write("G28\nG0 X{0} Y10\nG0 X0 Y0\n".format(length))
+            self.gcode.append(filename)
+        self.dispatcher = None
+
+
+    def tearDown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _run(self, crashes=None):
+        self.dispatcher = self.JobDispatcher(
+            {"m1": self.factory(0.1, crashes),
+             "m2": self.factory(0.1, crashes)})
+        for filename in self.gcode:
+            self.dispatcher.submit(filename)
+        return self.dispatcher.run()
+
+
+    def test_balanced_by_estimate(self):
+        results = self._run()
+        self.assertTrue(all(r["status"] == "done" for r in results))
+
+        # Longest jobs first, one each, then each free machine takes the
+        # longest left, so the machines finish no more than the second
+        # shortest job apart
+        by_length = sorted(results, key=lambda r: r["estimate"])
+        self.assertNotEqual(by_length[-1]["machine"],
+                            by_length[-2]["machine"])
+        totals = {"m1": 0., "m2": 0.}
+        for r in results:
+            totals[r["machine"]] += r["estimate"]
+        self.assertLessEqual(abs(totals["m1"] - totals["m2"]),
+                             by_length[1]["estimate"])
+
+
+    def test_crashed_worker_restarted(self):
+        results = self._run(crashes=Value('i', 1))
+
+        failed = [r for r in results if r["status"] == "failed"]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0]["error"], "Worker exited with code 1")
+        self.assertEqual(
+            self.dispatcher.workers[failed[0]["machine"]]["restarts"], 1)
+        self.assertEqual(sum(w["restarts"] for w in
+                             self.dispatcher.workers.values()), 1)
+        self.assertEqual(len([r for r in results if r["status"] == "done"]),
+                         len(self.LENGTHS) - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests for motionRing, stepped in this process on the simulated machine.
+"""
+
+from array import array
+import unittest
+
+import fakehw
+
+PERIOD = 50  # us
+
+
+def _runs(*counts):
+    """ Laser off runs of count steps each. """
+
+    return array('i', [x for count in counts for x in (count, 0, PERIOD)])
+
+
+class MotionRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = fakehw.load()
+        import hardwareDriver
+        import motionRing
+        self.motionRing = motionRing
+        self.fake.reset()
+        self.assertEqual(hardwareDriver.gpio_init(), 0)
+        hardwareDriver.motor_enable()
+
+
+    def test_moves_stepped_in_order(self):
+        ring = self.motionRing.MotionRing(1024)
+        self.assertTrue(ring.empty())
+        for a_delta, b_delta in [(10, 0), (0, -5), (-4, 4)]:
+            self.assertTrue(ring.push_line(a_delta, b_delta,
+                                           _runs(max(abs(a_delta),
+                                                     abs(b_delta)))))
+        self.assertTrue(ring.push_exit())
+        self.assertFalse(ring.empty())
+
+        self.assertEqual(ring.run(), 0)
+        self.assertTrue(ring.empty())
+        self.assertEqual(ring.status(), 0)
+        self.assertEqual(self.fake.position(), (6, -1))
+        self.assertEqual(len(self.fake.log()), 10 + 5 + 4)
+
+
+    def test_wrap_on_last_word(self):
+        # Blocks are 3 words of type, size and command, 2 of line args and 3
+        # per run. 20 + 20 + 20 words of lines and a 3 word exit fill all but
+        # the last word of a 64 word ring.
+        ring = self.motionRing.MotionRing(64)
+        for counts in [(1, 2, 3, 4, 5), (5, 4, 3, 2, 1), (2, 2, 2, 2, 2)]:
+            self.assertTrue(ring.push_line(sum(counts), 0, _runs(*counts)))
+        self.assertTrue(ring.push_exit())
+        # No room until those are stepped
+        self.assertFalse(ring.push_line(1, 0, _runs(1)))
+        self.assertEqual(ring.run(), 0)
+        self.assertEqual(self.fake.position(), (15 + 15 + 10, 0))
+
+        # A wrap block on the last word, then this move from the start
+        self.assertTrue(ring.push_line(0, 7, _runs(3, 4)))
+        self.assertTrue(ring.push_exit())
+        self.assertEqual(ring.run(), 0)
+        self.assertTrue(ring.empty())
+        self.assertEqual(self.fake.position(), (40, 7))
+
+
+if __name__ == "__main__":
+    unittest.main()
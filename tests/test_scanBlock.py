@@ -0,0 +1,115 @@
+"""
+Tests for scanBlock.scan_bed, with a fake camera and gantry.
+"""
+
+import io
+import os
+from multiprocessing import Queue
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from fakes import FakeCamera, FakeGantry
+import scanBlock
+
+# Decoding processes, filled in by _logged_decode
+_decode_pids = Queue()
+
+
+def _logged_decode(raw, resolution, rotation):
+    _decode_pids.put(os.getpid())
+    return _decode_frame(raw, resolution, rotation)
+
+_decode_frame = scanBlock._decode_frame
+
+
+class ScanBedTest(unittest.TestCase):
+
+    # scan_bed's tile pitch is its 12 x 16 mm camera FoV. Pictures are
+    # stitched 102 x 144 px apart (120 x 160 px rotated frames, with 15% and
+    # 10% overlap), so the fake camera sees 8.5 x 9 px per mm.
+    PX_PER_MM = (8.5, 9.)
+
+    def setUp(self):
+        self.scene = np.random.RandomState(0).randint(
+            0, 256, (700, 600)).astype(np.uint8)
+        self.gantry = FakeGantry()
+        self.cam = FakeCamera(self.scene, self.gantry, self.PX_PER_MM)
+        scanBlock._decode_frame = _logged_decode
+
+
+    def tearDown(self):
+        scanBlock._decode_frame = _decode_frame
+
+
+    def test_scan_stitches_tiles(self):
+        pic = scanBlock.scan_bed(self.gantry, (24, 32), cam=self.cam)
+
+        # 3 x 3 tiles, serpentine, one capture per move
+        centers = [((i + .5) * 12, (j + .5) * 16)
+                   for j, cols in enumerate([(0, 1, 2), (2, 1, 0), (0, 1, 2)])
+                   for i in cols]
+        self.assertTrue(self.gantry.homed)
+        self.assertEqual(self.cam.captures, centers)
+        self.assertEqual(self.gantry.moves, centers)
+
+        # Stitched picture is exactly the scanned part of the scene
+        top, left = self.cam.view_corner(*centers[0])
+        expected = self.scene[top:top + 2 * 144 + 160,
+                              left:left + 2 * 102 + 120]
+        self.assertEqual(pic.size, expected.shape[::-1])
+        np.testing.assert_array_equal(np.asarray(pic), expected)
+
+
+    def test_registration_recovers_offsets(self):
+        # Middle column of tiles a few pixels off, staying inside the
+        # scanned area so the stitch is still the whole scene
+        offsets = {(1, 0): (0, 2), (1, 1): (-3, 2), (1, 2): (0, -1)}
+        centers = dict(((i, j), ((i + .5) * 12, (j + .5) * 16))
+                       for i in range(3) for j in range(3))
+        self.cam.offsets = dict((centers[ij], offsets[ij]) for ij in offsets)
+
+        tiles = []
+        for (i, j), (x, y) in sorted(centers.items()):
+            self.gantry.x, self.gantry.y = x, y
+            stream = io.BytesIO()
+            self.cam.capture(stream, format="yuv")
+            tiles.append((i, j, Image.fromarray(_decode_frame(
+                stream.getvalue(), self.cam.resolution, 90))))
+        positions = scanBlock._register_tiles(tiles, (120, 160), (.15, .1))
+        for ij in centers:
+            dy, dx = offsets.get(ij, (0, 0))
+            self.assertEqual(positions[ij], (ij[1] * 144 + dy,
+                                             ij[0] * 102 + dx))
+
+        top, left = self.cam.view_corner(*centers[(0, 0)])
+        expected = self.scene[top:top + 2 * 144 + 160,
+                              left:left + 2 * 102 + 120]
+        pic = scanBlock.scan_bed(self.gantry, (24, 32), cam=self.cam)
+        np.testing.assert_array_equal(np.asarray(pic), expected)
+        # Which placing tiles where they were sent doesn't get
+        unregistered = scanBlock._scan_stitch(tiles, (120, 160), (.15, .1),
+                                              register=False)
+        self.assertFalse(np.array_equal(np.asarray(unregistered), expected))
+
+
+    def test_frames_decoded_in_workers(self):
+        scanBlock.scan_bed(self.gantry, (24, 32), cam=self.cam, workers=2)
+        pids = [_decode_pids.get(timeout=5) for _ in self.cam.captures]
+        self.assertNotIn(os.getpid(), pids)
+
+
+    def test_callers_camera_left_open(self):
+        scanBlock.scan_bed(self.gantry, 10, cam=self.cam)
+        self.assertFalse(self.cam.closed)
+
+        # Also when the scan fails
+        self.gantry.G0 = None
+        with self.assertRaises(TypeError):
+            scanBlock.scan_bed(self.gantry, 10, cam=self.cam)
+        self.assertFalse(self.cam.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
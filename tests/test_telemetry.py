@@ -0,0 +1,89 @@
+"""
+Tests for the head state the step loops publish to the telemetry record, on
+the simulated machine.
+"""
+
+from array import array
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fakehw
+
+PERIOD = 50  # us
+
+
+class HeadStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = fakehw.load()
+        import hardwareDriver
+        import telemetry
+        self.fake.reset()
+        self.assertEqual(hardwareDriver.gpio_init(), 0)
+        hardwareDriver.motor_enable()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.record = telemetry.TelemetryRecord(
+            os.path.join(self.tmp_dir, "state"), writer=True)
+        self.record.publish(0, 3, telemetry.FLAG_RUNNING, 10)
+        self.record.publish_head(0, 0, 0, 0)
+        self.record.publish_steps()
+
+
+    def tearDown(self):
+        self.record = None  # Stops the step loops publishing to it
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_ring_publishes_steps(self):
+        import motionRing
+        ring = motionRing.MotionRing(1024)
+        self.assertTrue(ring.push_line(20, 0, array('i', [20, 1, PERIOD]),
+                                       cmd=1))
+        self.assertTrue(ring.push_line(0, 10, array('i', [10, 0, PERIOD]),
+                                       cmd=2))
+        self.assertTrue(ring.push_exit())
+        self.assertEqual(ring.run(), 0)
+
+        self.assertEqual(self.fake.position(), (20, 10))
+        state = self.record.read()
+        self.assertAlmostEqual(state["x"], 1.5)  # (A + B) / 2 / step_cal
+        self.assertAlmostEqual(state["y"], 0.5)
+        self.assertEqual(state["head_cmd"], 2)
+        self.assertFalse(state["firing"])
+        self.assertEqual(state["switches"], 0)
+        self.assertTrue(state["running"])
+
+
+    def test_live_during_a_move(self):
+        # One long cut in the motion process, about a second, read from here
+        # while it's stepped
+        from motionProcess import MotionProcess
+        motion = MotionProcess(realtime=False, capacity=2**12)
+        try:
+            self.assertEqual(motion.queue_line(1000, 0,
+                                               array('i', [1000, 1, 1000]),
+                                               cmd=5), 0)
+            start = time.time()
+            while True:
+                state = self.record.read()
+                if 0 < state["x"] < 50:
+                    break
+                self.assertLess(time.time() - start, 5)
+                time.sleep(0.01)
+            self.assertEqual(state["y"], state["x"])
+            self.assertTrue(state["firing"])
+            self.assertEqual(state["head_cmd"], 5)
+
+            self.assertEqual(motion.wait(), 0)
+            state = self.record.read()
+            self.assertEqual((state["x"], state["y"]), (50, 50))
+            self.assertFalse(state["firing"])
+        finally:
+            motion.close()
+
+
+if __name__ == "__main__":
+    unittest.main()